@@ -0,0 +1,10 @@
+"""Benchmarks of the dataflow machinery on synthetic notebooks
+
+Run ``python -m dfnotebook.benchmarks run`` to time notebooks of a given
+shape and size and save the results as JSON, and
+``python -m dfnotebook.benchmarks compare old.json new.json`` to compare
+two such files, e.g. from before and after a change.
+"""
+
+from .notebooks import SHAPES, REF_STYLES, Notebook, generate
+from .runner import BenchmarkKernel, run_benchmark, summarize
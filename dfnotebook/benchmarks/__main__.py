@@ -0,0 +1,111 @@
+import argparse
+import datetime
+import json
+import platform
+import sys
+
+from .notebooks import REF_STYLES, SHAPES, generate
+from .runner import TIMEOUT, run_benchmark
+
+# metrics shown by compare, and the summary field used for each
+_COMPARED = [
+    ("execute", "median"),
+    ("execute", "p95"),
+    ("update", "total"),
+    ("conversion_seconds", "median"),
+    ("reply_bytes", "mean"),
+    ("dfcode_seconds", None),
+    ("rss_end", None),
+]
+
+
+def _version():
+    try:
+        from dfnotebook import __version__
+    except ImportError:
+        return "unknown"
+    return __version__
+
+
+def run(args):
+    report = {
+        "dfnotebook": _version(),
+        "python": platform.python_version(),
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "benchmarks": [],
+    }
+    for shape in args.shape:
+        for n in args.cells:
+            for refs in args.refs:
+                nb = generate(shape, n, refs, seed=args.seed)
+                print("{} cells={} refs={} ...".format(shape, len(nb), refs),
+                      end=" ", flush=True)
+                result = run_benchmark(nb, args.kernel_args, args.timeout)
+                print("execute median {:.1f} ms, update {:.2f} s".format(
+                    result["execute"]["median"] * 1000, result["update"]["total"]))
+                report["benchmarks"].append(result)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=1)
+    print("Saved", args.output)
+
+
+def _metric(result, name, field):
+    value = result.get(name)
+    if field is not None and isinstance(value, dict):
+        value = value.get(field)
+    return value
+
+
+def compare(args):
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    key = lambda r: (r["shape"], r["cells"], r["refs"])
+    base_results = {key(r): r for r in base["benchmarks"]}
+    print("{} ({}) -> {} ({})".format(args.base, base["dfnotebook"],
+                                      args.new, new["dfnotebook"]))
+    for result in new["benchmarks"]:
+        old = base_results.get(key(result))
+        if old is None:
+            continue
+        print("{} cells={} refs={}".format(*key(result)))
+        for name, field in _COMPARED:
+            before = _metric(old, name, field)
+            after = _metric(result, name, field)
+            if not before or after is None:
+                continue
+            label = name + ("." + field if field else "")
+            print("  {:<28} {:>14.6g} {:>14.6g} {:>8.2f}x".format(
+                label, before, after, after / before))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m dfnotebook.benchmarks")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("run", help="Time synthetic notebooks and save the results")
+    p.add_argument("--shape", nargs="+", choices=SHAPES, default=["chain"])
+    p.add_argument("--cells", nargs="+", type=int, default=[100],
+                   help="Notebook sizes (up to a few thousand cells)")
+    p.add_argument("--refs", nargs="+", choices=REF_STYLES, default=["tag"],
+                   help="Reference by output tag names or by name$cell")
+    p.add_argument("--seed", type=int, default=0, help="Seed for random DAGs")
+    p.add_argument("--output", default="dfbench.json")
+    p.add_argument("--timeout", type=float, default=TIMEOUT,
+                   help="Seconds to wait for each kernel message")
+    p.add_argument("--kernel-args", nargs=argparse.REMAINDER, default=[],
+                   help="Extra kernel arguments, e.g. --IPKernelApp.metrics_port=9000")
+    p.set_defaults(func=run)
+
+    p = sub.add_parser("compare", help="Compare two result files")
+    p.add_argument("base")
+    p.add_argument("new")
+    p.set_defaults(func=compare)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
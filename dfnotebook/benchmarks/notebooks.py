@@ -0,0 +1,97 @@
+"""Synthetic dataflow notebooks
+
+Every generated cell defines one variable from the variables of its parent
+cells, so the shape of the dependency graph is exactly the one requested.
+References are written either as bare names that the kernel resolves
+through the output tags ("tag") or as explicit name$cell references
+("uuid").
+"""
+
+import random
+
+SHAPES = ["chain", "fanout", "fanin", "diamond", "random"]
+REF_STYLES = ["uuid", "tag"]
+
+
+class Notebook(object):
+    """Cells in notebook order with their code and parents"""
+
+    def __init__(self, shape, refs):
+        self.shape = shape
+        self.refs = refs
+        # cell id -> code, in notebook order
+        self.code = {}
+        self.parents = {}
+
+    def __len__(self):
+        return len(self.code)
+
+    @property
+    def cell_ids(self):
+        return list(self.code)
+
+    def output_tags(self):
+        return {cid: [_var(i)] for i, cid in enumerate(self.code)}
+
+    def add_cell(self, parents, value=1):
+        i = len(self.code)
+        cid = cell_id(i)
+        terms = [self._ref(p) for p in parents] or [str(value)]
+        self.code[cid] = "{} = {}".format(_var(i), " + ".join(terms))
+        self.parents[cid] = [cell_id(p) for p in parents]
+        return cid
+
+    def _ref(self, i):
+        if self.refs == "uuid":
+            return "{}${}".format(_var(i), cell_id(i))
+        return _var(i)
+
+    def sinks(self):
+        """Cells that no other cell depends on"""
+        used = {p for parents in self.parents.values() for p in parents}
+        return [cid for cid in self.code if cid not in used]
+
+
+def cell_id(i):
+    # execution counts are parsed from the ids as hex, so avoid 0
+    return "{:08x}".format(i + 1)
+
+
+def _var(i):
+    return "v{}".format(i)
+
+
+def generate(shape, n, refs="tag", seed=0, max_parents=3):
+    """A notebook of n cells with the dependency graph shape"""
+    if shape not in SHAPES:
+        raise ValueError("Unknown shape '{}', expected one of {}".format(shape, SHAPES))
+    if refs not in REF_STYLES:
+        raise ValueError("Unknown reference style '{}'".format(refs))
+    nb = Notebook(shape, refs)
+    if shape == "chain":
+        for i in range(n):
+            nb.add_cell([i - 1] if i else [])
+    elif shape == "fanout":
+        # one source read by every other cell
+        nb.add_cell([])
+        for i in range(1, n):
+            nb.add_cell([0])
+    elif shape == "fanin":
+        # n - 1 sources read by a single cell
+        for i in range(n - 1):
+            nb.add_cell([], value=i)
+        nb.add_cell(list(range(n - 1)))
+    elif shape == "diamond":
+        # stacked diamonds: a -> (b, c) -> d -> ...
+        nb.add_cell([])
+        while len(nb) + 3 <= n:
+            top = len(nb) - 1
+            nb.add_cell([top])
+            nb.add_cell([top])
+            nb.add_cell([top + 1, top + 2])
+    else:
+        rng = random.Random(seed)
+        for i in range(n):
+            k = rng.randint(0, min(i, max_parents))
+            nb.add_cell(sorted(rng.sample(range(i), k)))
+    return nb
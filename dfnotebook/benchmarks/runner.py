@@ -0,0 +1,219 @@
+"""Drive a dataflow kernel through a synthetic notebook and time it
+
+The kernel runs in a subprocess started from a temporary kernelspec, and is
+sent the same execute_request and dfcode comm messages as the frontend,
+including code deltas after the first request.
+"""
+
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+
+from jupyter_client.kernelspec import KernelSpecManager
+from jupyter_client.manager import KernelManager
+
+from dfnotebook.kernel.codesync import content_hash
+
+# seconds to wait for the kernel to start, and for each message
+STARTUP_TIMEOUT = 60
+TIMEOUT = 100
+
+
+def summarize(values):
+    values = sorted(values)
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "total": sum(values),
+        "mean": statistics.fmean(values),
+        "median": statistics.median(values),
+        "p95": values[min(len(values) - 1, int(len(values) * 0.95))],
+        "max": values[-1],
+    }
+
+
+class BenchmarkKernel(object):
+    """A dataflow kernel subprocess and a client that acts as the frontend"""
+
+    def __init__(self, extra_args=(), timeout=TIMEOUT):
+        self.extra_args = list(extra_args)
+        self.timeout = timeout
+        self.km = None
+        self.kc = None
+
+    def start(self):
+        self._spec_dir = tempfile.mkdtemp(prefix="dfbench-")
+        os.makedirs(os.path.join(self._spec_dir, "dfbench"))
+        with open(os.path.join(self._spec_dir, "dfbench", "kernel.json"), "w") as f:
+            json.dump({
+                "argv": [sys.executable, "-m", "dfnotebook.kernel",
+                         "-f", "{connection_file}"] + self.extra_args,
+                "display_name": "DFPython benchmark",
+                "language": "python",
+            }, f)
+        self.km = KernelManager(
+            kernel_name="dfbench",
+            kernel_spec_manager=KernelSpecManager(kernel_dirs=[self._spec_dir]),
+        )
+        self.km.start_kernel()
+        self.kc = self.km.client()
+        self.kc.start_channels()
+        self.kc.wait_for_ready(timeout=STARTUP_TIMEOUT)
+        self.revision = None
+        self.hashes = {}
+        return self
+
+    def stop(self):
+        if self.kc is not None:
+            self.kc.stop_channels()
+        if self.km is not None:
+            self.km.shutdown_kernel(now=True)
+        shutil.rmtree(self._spec_dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def memory(self):
+        """Resident memory of the kernel process in bytes, if known"""
+        try:
+            pid = self.km.provisioner.process.pid
+            with open("/proc/{}/status".format(pid)) as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) * 1024
+        except (AttributeError, OSError):
+            pass
+        return None
+
+    def _code_data(self, nb):
+        # mirrors encodeCodeSync in the frontend's cell executor
+        output_tags = nb.output_tags()
+        hashes = {cid: content_hash(cid, code, output_tags[cid])
+                  for cid, code in nb.code.items()}
+        if self.revision is None:
+            self.revision, self.hashes = 1, hashes
+            return {"code_dict": dict(nb.code), "output_tags": output_tags,
+                    "code_revision": 1}
+        changed = {cid: {"code": nb.code[cid], "output_tags": output_tags[cid],
+                         "hash": h}
+                   for cid, h in hashes.items() if self.hashes.get(cid) != h}
+        delta = {
+            "base_revision": self.revision,
+            "revision": self.revision + 1,
+            "changed": changed,
+            "deleted": [cid for cid in self.hashes if cid not in hashes],
+            "digest": sum(hashes.values()) & 0xFFFFFFFF,
+        }
+        self.revision, self.hashes = self.revision + 1, hashes
+        return {"code_delta": delta}
+
+    def _wait_idle(self, msg_id):
+        while True:
+            msg = self.kc.get_iopub_msg(timeout=self.timeout)
+            if (msg["parent_header"].get("msg_id") == msg_id
+                    and msg["msg_type"] == "status"
+                    and msg["content"]["execution_state"] == "idle"):
+                return
+
+    def execute(self, nb, cid):
+        """Run a cell and return its timing, the size of all its replies,
+        and the reply for the cell itself"""
+        data = {"uuid": cid, "input_tags": {}, "auto_update_flags": {},
+                "force_cached_flags": {}}
+        data.update(self._code_data(nb))
+        start = time.perf_counter()
+        # sent directly since KernelClient.execute only allows string expressions
+        msg = self.kc.session.msg("execute_request", {
+            "code": nb.code[cid], "silent": False, "store_history": True,
+            "user_expressions": {"__dfkernel_data__": data},
+            "allow_stdin": False, "stop_on_error": True,
+        })
+        self.kc.shell_channel.send(msg)
+        msg_id = msg["header"]["msg_id"]
+        # upstream cells executed for this request send their own replies
+        # with the same parent before the requested cell's reply
+        count, nbytes = int(cid, 16), 0
+        while True:
+            reply = self.kc.get_shell_msg(timeout=self.timeout)
+            if reply["parent_header"].get("msg_id") != msg_id:
+                continue
+            nbytes += len(json.dumps(reply["content"]))
+            if reply["content"].get("execution_count") == count:
+                break
+        latency = time.perf_counter() - start
+        self._wait_idle(msg_id)
+        if reply["content"].get("code_revision") is None:
+            # the kernel lost our revision; the next request resyncs
+            self.revision = None
+        return {
+            "latency": latency,
+            "reply_bytes": nbytes,
+            "reply": reply,
+        }
+
+    def dfcode(self, nb, all_refs):
+        """Round trip of the dfcode comm that reconverts the notebook"""
+        comm_id = uuid.uuid4().hex
+        dfmetadata = {
+            "code_dict": dict(nb.code),
+            "output_tags": nb.output_tags(),
+            "input_tags": {},
+            "all_refs": all_refs,
+            "executed_code": dict(nb.code),
+        }
+        session = self.kc.session
+        self.kc.shell_channel.send(session.msg(
+            "comm_open", {"comm_id": comm_id, "target_name": "dfcode", "data": {}}))
+        start = time.perf_counter()
+        self.kc.shell_channel.send(session.msg(
+            "comm_msg", {"comm_id": comm_id, "data": {"dfMetadata": dfmetadata}}))
+        while True:
+            msg = self.kc.get_iopub_msg(timeout=self.timeout)
+            if (msg["msg_type"] == "comm_msg"
+                    and msg["content"].get("comm_id") == comm_id):
+                return time.perf_counter() - start, msg["content"]["data"]
+
+
+def run_benchmark(nb, extra_args=(), timeout=TIMEOUT):
+    """Execute every cell, reconvert through the dfcode comm, then change
+    the first cell and execute every sink so the change propagates."""
+    result = {"shape": nb.shape, "cells": len(nb), "refs": nb.refs}
+    with BenchmarkKernel(extra_args, timeout) as kernel:
+        result["rss_start"] = kernel.memory()
+        cold, sizes, conversion, all_refs, errors = [], [], [], {}, 0
+        for cid in nb.cell_ids:
+            run = kernel.execute(nb, cid)
+            content = run["reply"]["content"]
+            errors += content["status"] != "ok"
+            cold.append(run["latency"])
+            sizes.append(run["reply_bytes"])
+            conversion.append(run["reply"]["metadata"].get("conversion_time", 0))
+            for ref_cid, refs in (content.get("identifier_refs") or {}).items():
+                all_refs[ref_cid] = {"ref": refs, "tag_refs": {}}
+        result["execute"] = summarize(cold)
+        result["reply_bytes"] = summarize(sizes)
+        result["conversion_seconds"] = summarize(conversion)
+        result["rss_after_execute"] = kernel.memory()
+
+        result["dfcode_seconds"], _ = kernel.dfcode(nb, all_refs)
+
+        first = nb.cell_ids[0]
+        nb.code[first] = nb.code[first].replace("=", "= 1 +", 1)
+        update = []
+        for cid in nb.sinks():
+            run = kernel.execute(nb, cid)
+            errors += run["reply"]["content"]["status"] != "ok"
+            update.append(run["latency"])
+        result["update"] = summarize(update)
+        result["rss_end"] = kernel.memory()
+        result["errors"] = errors
+    return result
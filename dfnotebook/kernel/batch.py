@@ -0,0 +1,348 @@
+"""Run a dataflow notebook without a frontend
+
+    python -m dfnotebook.kernel.batch analysis.ipynb --tags summary plot
+
+Only the cells that the requested names depend on are run, using the
+references recorded in each cell's dfmetadata when the notebook was last
+saved. The kernel executes the stale upstream cells of a requested cell
+itself, one at a time unless --parallel turns on parallel_upstream, so the
+runner only sends the requested cells. Outputs are written to a copy of the notebook
+and, optionally, to a results directory with one JSON file per cell.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from queue import Empty
+
+from jupyter_client.kernelspec import KernelSpecManager
+from jupyter_client.manager import KernelManager
+
+from .codesync import content_hash
+
+
+def truncate_cell_id(cell_id):
+    # same as truncateCellId in the frontend
+    return cell_id.replace("-", "")[:8]
+
+
+class NotebookGraph(object):
+    """The code cells of a notebook and the references between them"""
+
+    def __init__(self, nb):
+        self.nb = nb
+        # cell id -> cell, in notebook order
+        self.cells = {}
+        self.parents = {}
+        self.output_tags = {}
+        # cell tag -> cell id
+        self.input_tags = {}
+        for cell in nb["cells"]:
+            if cell["cell_type"] != "code" or "id" not in cell:
+                continue
+            cid = truncate_cell_id(cell["id"])
+            dfmetadata = cell["metadata"].get("dfmetadata") or {}
+            self.cells[cid] = cell
+            refs = (dfmetadata.get("inputVars") or {}).get("ref") or {}
+            self.parents[cid] = [pid for pid in refs if pid != cid]
+            self.output_tags[cid] = list(dfmetadata.get("outputVars") or [])
+            if dfmetadata.get("tag"):
+                self.input_tags[dfmetadata["tag"]] = cid
+
+    def code(self, cid):
+        source = self.cells[cid]["source"]
+        return source if isinstance(source, str) else "".join(source)
+
+    def has_references(self):
+        """Whether the notebook was saved after its cells were executed"""
+        return any(self.parents.values()) or any(self.output_tags.values())
+
+    def resolve(self, name):
+        """The cell for a cell id, cell tag, or output tag"""
+        if name in self.cells:
+            return name
+        if name in self.input_tags:
+            return self.input_tags[name]
+        defining = [cid for cid, tags in self.output_tags.items() if name in tags]
+        if not defining:
+            raise LookupError("No cell defines '{}'".format(name))
+        return defining[-1]
+
+    def sinks(self):
+        """Cells that no other cell references"""
+        used = {pid for parents in self.parents.values() for pid in parents}
+        return [cid for cid in self.cells if cid not in used]
+
+    def upstream(self, cids):
+        """cids and all of their ancestors"""
+        res = set()
+        frontier = list(cids)
+        while frontier:
+            cid = frontier.pop()
+            if cid in res or cid not in self.cells:
+                continue
+            res.add(cid)
+            frontier.extend(self.parents[cid])
+        return res
+
+
+def _output(msg):
+    """The nbformat output for an IOPub message, or None"""
+    msg_type = msg["msg_type"]
+    content = msg["content"]
+    if msg_type == "stream":
+        return {"output_type": "stream", "name": content["name"], "text": content["text"]}
+    if msg_type == "execute_result":
+        return {"output_type": "execute_result", "execution_count": content["execution_count"],
+                "data": content["data"], "metadata": content["metadata"]}
+    if msg_type == "display_data":
+        return {"output_type": "display_data", "data": content["data"],
+                "metadata": content["metadata"]}
+    if msg_type == "error":
+        return {"output_type": "error", "ename": content["ename"],
+                "evalue": content["evalue"], "traceback": content["traceback"]}
+    return None
+
+
+class BatchRunner(object):
+    """Executes cells of a NotebookGraph in a dataflow kernel subprocess"""
+
+    def __init__(self, graph, kernel_args=(), timeout=None, cwd=None):
+        self.graph = graph
+        self.kernel_args = list(kernel_args)
+        self.timeout = timeout
+        self.cwd = cwd
+        # cell id -> nbformat outputs, status, and reply content
+        self.outputs = {}
+        self.status = {}
+        self.replies = {}
+        # code revision the kernel has, and the hash of each cell in it
+        self.revision = None
+        self.hashes = {}
+
+    def start(self):
+        self._spec_dir = tempfile.mkdtemp(prefix="dfbatch-")
+        os.makedirs(os.path.join(self._spec_dir, "dfbatch"))
+        with open(os.path.join(self._spec_dir, "dfbatch", "kernel.json"), "w") as f:
+            json.dump({
+                "argv": [sys.executable, "-m", "dfnotebook.kernel",
+                         "-f", "{connection_file}"] + self.kernel_args,
+                "display_name": "DFPython batch",
+                "language": "python",
+            }, f)
+        self.km = KernelManager(
+            kernel_name="dfbatch",
+            kernel_spec_manager=KernelSpecManager(kernel_dirs=[self._spec_dir]),
+        )
+        self.km.start_kernel(cwd=self.cwd)
+        self.kc = self.km.client()
+        self.kc.start_channels()
+        self.kc.wait_for_ready(timeout=60)
+        return self
+
+    def stop(self):
+        self.kc.stop_channels()
+        self.km.shutdown_kernel(now=True)
+        shutil.rmtree(self._spec_dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _code_data(self):
+        # the whole notebook the first time, then code deltas like the
+        # frontend sends: resending the saved code would not match the
+        # converted code the kernel keeps, and rerun every cell with refs
+        graph = self.graph
+        hashes = {c: content_hash(c, graph.code(c), graph.output_tags[c])
+                  for c in graph.cells}
+        if self.revision is None:
+            self.revision, self.hashes = 1, hashes
+            return {"code_dict": {c: graph.code(c) for c in graph.cells},
+                    "output_tags": graph.output_tags, "code_revision": 1}
+        delta = {
+            "base_revision": self.revision,
+            "revision": self.revision + 1,
+            "changed": {c: {"code": graph.code(c), "output_tags": graph.output_tags[c],
+                            "hash": h}
+                        for c, h in hashes.items() if self.hashes.get(c) != h},
+            "deleted": [c for c in self.hashes if c not in hashes],
+            "digest": sum(hashes.values()) & 0xFFFFFFFF,
+        }
+        self.revision, self.hashes = self.revision + 1, hashes
+        return {"code_delta": delta}
+
+    def execute(self, cid, _resync=True):
+        """Run cid, and whatever it needs, and return its status"""
+        graph = self.graph
+        data = {
+            "uuid": cid,
+            "input_tags": graph.input_tags,
+            "auto_update_flags": {},
+            "force_cached_flags": {},
+        }
+        data.update(self._code_data())
+        msg = self.kc.session.msg("execute_request", {
+            "code": graph.code(cid), "silent": False, "store_history": True,
+            "user_expressions": {"__dfkernel_data__": data},
+            "allow_stdin": False, "stop_on_error": True,
+        })
+        self.kc.shell_channel.send(msg)
+        msg_id = msg["header"]["msg_id"]
+
+        while True:
+            iopub = self.kc.get_iopub_msg(timeout=self.timeout)
+            if iopub["parent_header"].get("msg_id") != msg_id:
+                continue
+            if (iopub["msg_type"] == "status"
+                    and iopub["content"]["execution_state"] == "idle"):
+                break
+            count = iopub["content"].get("execution_count")
+            target = "{:08x}".format(count) if isinstance(count, int) else cid
+            if iopub["msg_type"] in ("clear_output", "execute_input"):
+                self.outputs[target] = []
+                continue
+            output = _output(iopub)
+            if output is None:
+                continue
+            outputs = self.outputs.setdefault(target, [])
+            if (output["output_type"] == "stream" and outputs
+                    and outputs[-1]["output_type"] == "stream"
+                    and outputs[-1]["name"] == output["name"]):
+                outputs[-1]["text"] += output["text"]
+            else:
+                outputs.append(output)
+
+        # every cell that ran sends a reply, all before the kernel went
+        # idle, and the requested cell's reply comes last
+        status = "error"
+        while True:
+            try:
+                reply = self.kc.get_shell_msg(timeout=1)
+            except Empty:
+                break
+            if reply["parent_header"].get("msg_id") != msg_id:
+                continue
+            content = reply["content"]
+            if content.get("ename") == "DataflowSyncError" and _resync:
+                # the kernel lost our revision, so send the whole notebook
+                self.revision = None
+                return self.execute(cid, _resync=False)
+            status = content["status"]
+            count = content.get("execution_count")
+            if isinstance(count, int):
+                self.status["{:08x}".format(count)] = status
+                self.replies["{:08x}".format(count)] = content
+            if count == int(cid, 16):
+                break
+        self.status.setdefault(cid, status)
+        return status
+
+    def update_notebook(self):
+        """Write outputs and the refs the kernel found back into the cells"""
+        for cid, cell in self.graph.cells.items():
+            if cid not in self.status:
+                continue
+            cell["outputs"] = self.outputs.get(cid, [])
+            cell["execution_count"] = int(cid, 16)
+            content = self.replies.get(cid, {})
+            dfmetadata = cell["metadata"].setdefault("dfmetadata", {})
+            if (content.get("persistent_code") or {}).get(cid):
+                dfmetadata["persistentCode"] = content["persistent_code"][cid]
+            if cid in (content.get("identifier_refs") or {}):
+                refs = content["identifier_refs"][cid]
+                dfmetadata["inputVars"] = {"ref": refs, "tag_refs": {
+                    pid: tag for tag, pid in self.graph.input_tags.items() if pid in refs}}
+            dfmetadata["outputVars"] = [
+                out["metadata"]["output_tag"] for out in cell["outputs"]
+                if "output_tag" in (out.get("metadata") or {})]
+
+
+def run(args):
+    with open(args.notebook) as f:
+        nb = json.load(f)
+    graph = NotebookGraph(nb)
+    if args.tags:
+        targets = {graph.resolve(name) for name in args.tags}
+    elif graph.has_references():
+        targets = set(graph.sinks())
+    else:
+        # nothing recorded about the references, so run everything in order
+        print("No dataflow references saved in {}; running every cell".format(args.notebook))
+        targets = set(graph.cells)
+    needed = graph.upstream(targets)
+
+    kernel_args = list(args.kernel_args)
+    if args.parallel:
+        kernel_args.append("--IPythonKernel.parallel_upstream=True")
+    start = time.perf_counter()
+    failed = None
+    cwd = os.path.dirname(os.path.abspath(args.notebook))
+    with BatchRunner(graph, kernel_args, args.timeout, cwd) as runner:
+        for cid in graph.cells:
+            if cid not in targets or cid in runner.status:
+                continue
+            if runner.execute(cid) != "ok":
+                failed = cid
+                if not args.allow_errors:
+                    break
+    elapsed = time.perf_counter() - start
+    runner.update_notebook()
+
+    output = args.output or os.path.splitext(args.notebook)[0] + ".dfrun.ipynb"
+    with open(output, "w") as f:
+        json.dump(nb, f, indent=1, ensure_ascii=False)
+        f.write("\n")
+
+    ran = [cid for cid in graph.cells if cid in runner.status]
+    errors = [cid for cid in ran if runner.status[cid] != "ok"]
+    if args.results_dir:
+        os.makedirs(args.results_dir, exist_ok=True)
+        for cid in ran:
+            with open(os.path.join(args.results_dir, cid + ".json"), "w") as f:
+                json.dump({"cell_id": cid, "status": runner.status[cid],
+                           "output_tags": graph.cells[cid]["metadata"]["dfmetadata"]["outputVars"],
+                           "outputs": graph.cells[cid]["outputs"]}, f, indent=1)
+        with open(os.path.join(args.results_dir, "run.json"), "w") as f:
+            json.dump({"notebook": args.notebook, "targets": sorted(targets),
+                       "ran": ran, "errors": errors,
+                       "skipped": [cid for cid in graph.cells if cid not in needed],
+                       "seconds": elapsed}, f, indent=1)
+
+    print("Ran {} of {} code cells in {:.2f}s, wrote {}".format(
+        len(ran), len(graph.cells), elapsed, output))
+    for cid in errors:
+        print("Cell {} failed".format(cid), file=sys.stderr)
+    return 1 if failed is not None else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m dfnotebook.kernel.batch",
+        description="Run the cells of a dataflow notebook that the given names need")
+    parser.add_argument("notebook")
+    parser.add_argument("--tags", nargs="+", default=[],
+                        help="Output tags, cell tags, or cell ids to compute "
+                             "(default: every cell no other cell references)")
+    parser.add_argument("-o", "--output",
+                        help="Notebook to write (default: NOTEBOOK.dfrun.ipynb)")
+    parser.add_argument("--results-dir", help="Also write each cell's outputs here as JSON")
+    parser.add_argument("--parallel", action="store_true",
+                        help="Run independent upstream cells concurrently")
+    parser.add_argument("--allow-errors", action="store_true",
+                        help="Keep running the other requested cells after an error")
+    parser.add_argument("--timeout", type=float, default=None,
+                        help="Seconds to wait for a cell before giving up")
+    parser.add_argument("--kernel-args", nargs=argparse.REMAINDER, default=[],
+                        help="Extra kernel arguments")
+    return run(parser.parse_args(argv))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
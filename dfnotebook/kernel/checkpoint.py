@@ -0,0 +1,224 @@
+"""Save and restore the dataflow state of a kernel
+
+A checkpoint is a stream of pickles written one after another: a header,
+the dependency graph and links, then one record per cell output and per
+namespace value. Values are pickled straight to the file one at a time, so
+a checkpoint never needs memory for more than the value being written.
+Objects held by more than one of them, such as a variable that is also a
+cell output, are written once before the others, which refer to them by
+id, so they are neither stored twice nor restored as separate copies.
+Values that cannot be pickled are skipped and listed in the report; on
+restore, skipped cell outputs are recomputed when next referenced.
+"""
+
+from collections import OrderedDict
+import pickle
+import types
+
+from .dflink import LinkedResult
+
+CHECKPOINT_VERSION = 2
+# version 1 did not write shared objects separately
+_READABLE_VERSIONS = (1, 2)
+DEFAULT_PATH = "dfkernel.checkpoint"
+
+_GRAPH_FIELDS = [
+    "code_cache", "code_stale", "func_cached", "last_calculated",
+    "last_calculated_ctr", "dep_parents", "dep_children",
+    "dep_semantic_parents", "auto_update_flags", "force_cached_flags",
+    "compute_times", "run_stats",
+]
+_LINK_FIELDS = ["links", "all_links", "rev_links"]
+
+
+# values whose identity does not matter, never written separately
+_ATOMS = (type(None), bool, int, float, complex)
+
+
+class CheckpointError(Exception):
+    pass
+
+
+class _Pickler(pickle.Pickler):
+    """Pickles the shared objects other than root as references to them"""
+
+    def __init__(self, f, shared, failed, root):
+        super().__init__(f, protocol=pickle.HIGHEST_PROTOCOL)
+        self.shared = shared
+        self.failed = failed
+        self.root = root
+
+    def persistent_id(self, obj):
+        if obj is self.root:
+            return None
+        if id(obj) in self.failed:
+            raise pickle.PicklingError(self.failed[id(obj)])
+        return self.shared.get(id(obj))
+
+
+class _Unpickler(pickle.Unpickler):
+    def __init__(self, f, objects):
+        super().__init__(f)
+        self.objects = objects
+
+    def persistent_load(self, pid):
+        try:
+            return self.objects[pid]
+        except KeyError:
+            raise CheckpointError("Shared object {} is missing".format(pid))
+
+
+def _user_items(shell):
+    hidden = shell.user_ns_hidden
+    for name, value in list(shell.user_ns.items()):
+        if (name.startswith("_") or name in hidden
+                or isinstance(value, types.ModuleType)):
+            continue
+        yield name, value
+
+
+def _shared_objects(values):
+    """The objects that appear more than once among values and the outputs
+    of the linked results in values, outputs before their results"""
+    seen = {}
+    for value in values:
+        members = [value]
+        if isinstance(value, LinkedResult):
+            # not value.values(), which records dependencies
+            members[:0] = OrderedDict.values(value)
+        for obj in members:
+            if not isinstance(obj, _ATOMS):
+                count, _ = seen.get(id(obj), (0, obj))
+                seen[id(obj)] = (count + 1, obj)
+    return [obj for count, obj in seen.values() if count > 1]
+
+
+def _dump_record(f, record, shared, failed, root=None):
+    """Pickle record to f, rolling the file back if it cannot be pickled.
+
+    Shared objects other than root are written as references. Returns the
+    error, or None if the record was written."""
+    pos = f.tell()
+    try:
+        if shared or failed:
+            _Pickler(f, shared, failed, root).dump(record)
+        else:
+            pickle.dump(record, f, protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception as e:
+        f.seek(pos)
+        f.truncate()
+        return "{}: {}".format(type(e).__name__, e)
+    return None
+
+
+def save_checkpoint(shell, path):
+    """Write the dataflow state of shell to path and return a report"""
+    history = shell.dataflow_history_manager
+    state = shell.dataflow_state
+    report = {"path": path, "values": 0, "namespace": 0, "skipped": []}
+    with open(path, "wb") as f:
+        pickle.dump({"checkpoint": CHECKPOINT_VERSION}, f)
+        graph = {field: getattr(history, field) for field in _GRAPH_FIELDS}
+        graph.update((field, getattr(state, field)) for field in _LINK_FIELDS)
+        # every cell with a result, restored or recomputed on load
+        graph["evicted"] = set(history.value_cache) | history.evicted
+        pickle.dump(("graph", graph), f, protocol=pickle.HIGHEST_PROTOCOL)
+        values = list(history.value_cache.items())
+        names = list(_user_items(shell))
+        # ids of the shared objects written, and of those that failed
+        shared, failed = {}, {}
+        for obj in _shared_objects([v for _, v in values] + [v for _, v in names]):
+            error = _dump_record(f, ("obj", len(shared), obj), shared, failed, obj)
+            if error is None:
+                shared[id(obj)] = len(shared)
+            else:
+                # the records that refer to it are skipped with this error
+                failed[id(obj)] = error
+        for key, value in values:
+            error = _dump_record(f, ("value", key, value), shared, failed)
+            if error is None:
+                report["values"] += 1
+            else:
+                report["skipped"].append({"kind": "value", "name": key, "error": error})
+        for name, value in names:
+            error = _dump_record(f, ("ns", name, value), shared, failed)
+            if error is None:
+                report["namespace"] += 1
+            else:
+                report["skipped"].append({"kind": "namespace", "name": name, "error": error})
+    return report
+
+
+def _records(f, objects):
+    while True:
+        try:
+            yield _Unpickler(f, objects).load()
+        except EOFError:
+            return
+
+
+def load_checkpoint(shell, path):
+    """Replace the dataflow state of shell with the checkpoint at path"""
+    history = shell.dataflow_history_manager
+    state = shell.dataflow_state
+    report = {"path": path, "values": 0, "namespace": 0, "skipped": []}
+    with open(path, "rb") as f:
+        objects = {}
+        records = _records(f, objects)
+        try:
+            header = next(records, None)
+        except Exception:
+            header = None
+        if not isinstance(header, dict) or "checkpoint" not in header:
+            raise CheckpointError("'{}' is not a dataflow checkpoint".format(path))
+        if header["checkpoint"] not in _READABLE_VERSIONS:
+            raise CheckpointError(
+                "'{}' is a version {} checkpoint; this kernel reads versions {}".format(
+                    path, header["checkpoint"],
+                    ", ".join(str(v) for v in _READABLE_VERSIONS)))
+        record = next(records, None)
+        if (not isinstance(record, tuple) or len(record) != 2 or record[0] != "graph"
+                or not isinstance(record[1], dict)
+                or any(field not in record[1] for field in _LINK_FIELDS + ["evicted"])):
+            raise CheckpointError(
+                "'{}' does not start with a dependency graph; it may be truncated".format(path))
+        graph = record[1]
+        history.clear()
+        state.clear()
+        for field in _GRAPH_FIELDS:
+            # fields added since a checkpoint was written keep their defaults
+            if field in graph:
+                setattr(history, field, graph[field])
+        # links are also accepted as lists of cell ids, as older versions saved
+        state.links.update((tag, dict.fromkeys(cells)) for tag, cells in graph["links"].items())
+        state.all_links.update(graph["all_links"])
+        state.rev_links.update(graph["rev_links"])
+        state.rebuild_index()
+        state.changed_links.update(state.all_links)
+        # outputs that are not in the checkpoint are recomputed when referenced
+        history.evicted.update(graph["evicted"])
+        for record in records:
+            if record[0] == "obj":
+                _, pid, value = record
+                objects[pid] = value
+            elif record[0] == "value":
+                _, key, value = record
+                if isinstance(value, LinkedResult):
+                    value.__sethist__(history)
+                history.restore_value(key, value)
+                report["values"] += 1
+            elif record[0] == "ns":
+                _, name, value = record
+                shell.user_ns[name] = value
+                report["namespace"] += 1
+    report["skipped"] = [{"kind": "value", "name": key, "error": "not saved"}
+                         for key in sorted(history.evicted)]
+    return report
+
+
+def format_report(report, action="Saved"):
+    lines = ["{} {} cell outputs and {} namespace values ({})".format(
+        action, report["values"], report["namespace"], report["path"])]
+    for skipped in report["skipped"]:
+        lines.append("  skipped {kind} {name}: {error}".format(**skipped))
+    return "\n".join(lines)
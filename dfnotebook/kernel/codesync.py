@@ -0,0 +1,165 @@
+"""Incremental sync of the notebook's code between the frontend and the kernel
+
+The frontend sends the full code_dict once and afterwards only the cells that
+changed or were deleted since the last revision the kernel acknowledged. Each
+changed cell carries a content hash, and every message carries a digest of the
+whole notebook (the sum of the cell hashes) so that the kernel can detect when
+the two views have drifted apart and ask for a full sync.
+
+In the other direction, execute replies carry the dependency graph. Once the
+frontend reports the graph revision it last applied, replies only include the
+cell order, downstream edges, and closures that changed since then.
+"""
+
+import uuid
+import zlib
+
+
+class DataflowSyncError(Exception):
+    """The frontend's code delta does not apply to the kernel's revision"""
+
+
+def content_hash(cell_id, code, output_tags=()):
+    """CRC32 of a cell's id, code, and output tags (UTF-8 encoded)"""
+    data = "\0".join((cell_id, code, ",".join(output_tags)))
+    return zlib.crc32(data.encode("utf-8"))
+
+
+class CodeSync(object):
+    """The kernel's record of the notebook revision the frontend last sent"""
+
+    def __init__(self):
+        # bumped whenever tag_cells changes
+        self.tags_version = 0
+        self.clear()
+
+    def clear(self):
+        self.revision = None
+        self.digest = 0
+        self.hashes = {}
+        self.output_tags = {}
+        # tag -> ids of the cells that output it
+        self.tag_cells = {}
+        self.tags_version += 1
+
+    def reset(self, code_dict, output_tags, revision=None):
+        """Replace the record with a full sync of the notebook"""
+        self.clear()
+        for cid, code in code_dict.items():
+            tags = output_tags.get(cid) or []
+            self._set_cell(cid, content_hash(cid, code, tags), tags)
+        self.revision = revision
+
+    def apply_delta(self, delta):
+        """Apply a code delta and return the (code_dict, output_tags, deleted)
+        that changed. Raises DataflowSyncError, and forgets the current
+        revision, if the delta is not based on it or the digests disagree."""
+        try:
+            return self._apply_delta(delta)
+        except DataflowSyncError:
+            self.clear()
+            raise
+
+    def _apply_delta(self, delta):
+        if self.revision is None or delta.get("base_revision") != self.revision:
+            raise DataflowSyncError(
+                "Code delta is based on revision {} but the kernel has {}".format(
+                    delta.get("base_revision"), self.revision))
+        code_dict = {}
+        output_tags = {}
+        for cid, entry in delta.get("changed", {}).items():
+            code = entry["code"]
+            tags = entry.get("output_tags") or []
+            cell_hash = content_hash(cid, code, tags)
+            if cell_hash != entry.get("hash"):
+                raise DataflowSyncError("Hash mismatch for cell '{}'".format(cid))
+            self._set_cell(cid, cell_hash, tags)
+            code_dict[cid] = code
+            output_tags[cid] = tags
+        deleted = []
+        for cid in delta.get("deleted", []):
+            if cid in self.hashes:
+                self.digest = (self.digest - self.hashes.pop(cid)) & 0xFFFFFFFF
+                self._set_tags(cid, [])
+                deleted.append(cid)
+        if self.digest != delta.get("digest"):
+            raise DataflowSyncError("Notebook digest mismatch")
+        self.revision = delta.get("revision")
+        return code_dict, output_tags, deleted
+
+    def _set_cell(self, cid, cell_hash, tags):
+        self.digest = (self.digest - self.hashes.get(cid, 0) + cell_hash) & 0xFFFFFFFF
+        self.hashes[cid] = cell_hash
+        self._set_tags(cid, tags)
+
+    def _set_tags(self, cid, tags):
+        if self.output_tags.get(cid, []) == list(tags):
+            return
+        self.tags_version += 1
+        for tag in self.output_tags.pop(cid, []):
+            cells = self.tag_cells.get(tag)
+            if cells is not None:
+                cells.discard(cid)
+                if not cells:
+                    del self.tag_cells[tag]
+        if tags:
+            self.output_tags[cid] = list(tags)
+            for tag in tags:
+                self.tag_cells.setdefault(tag, set()).add(cid)
+
+
+class GraphSync(object):
+    """Revisions of the dependency graph sent in execute replies.
+
+    Every reply starts a revision. Values are recorded per (kind, cell id)
+    along with the revision they last changed in, so a client that applied
+    revision base only needs the entries changed after it.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        # distinguishes the revisions of this kernel from an earlier one
+        self.epoch = uuid.uuid4().hex
+        self.revision = 0
+        # the last execution counter recorded for the cell order
+        self.counter = -1
+        # kind -> cell id -> value
+        self.values = {}
+        # (kind, cell id) -> revision, oldest change first
+        self.changed = {}
+
+    def next_revision(self):
+        self.revision += 1
+        return self.revision
+
+    def is_current(self, epoch, base):
+        """Whether a client at revision base of epoch can apply a diff"""
+        return (epoch == self.epoch and isinstance(base, int)
+                and 0 < base <= self.revision)
+
+    def _mark(self, key):
+        self.changed.pop(key, None)
+        self.changed[key] = self.revision
+
+    def update(self, kind, cid, value):
+        values = self.values.setdefault(kind, {})
+        if cid not in values or values[cid] != value:
+            values[cid] = value
+            self._mark((kind, cid))
+
+    def remove(self, kind, cid):
+        if cid in self.values.get(kind, {}):
+            del self.values[kind][cid]
+            self._mark((kind, cid))
+
+    def changed_since(self, base):
+        """The (kind, cell id) keys changed after revision base, oldest first"""
+        keys = []
+        for key in reversed(self.changed):
+            if self.changed[key] <= base:
+                break
+            keys.append(key)
+        keys.reverse()
+        return keys
@@ -1,7 +1,107 @@
-from collections import defaultdict, namedtuple
+from bisect import bisect_left, insort
+from collections import defaultdict, deque, namedtuple
 from collections.abc import KeysView, ItemsView, ValuesView, MutableMapping
 from .dflink import LinkedResult
+import contextvars
+import hashlib
 import itertools
+import sys
+
+# execution state of the branch running in the current asyncio task, set
+# only while the scheduler runs independent upstream cells concurrently
+_branch_state = contextvars.ContextVar('dfkernel_branch_state', default=None)
+
+def start_branch():
+    """Give the current context its own copy of all branch_local attributes"""
+    _branch_state.set({})
+
+def estimate_size(value, _depth=0):
+    """Rough size of value in bytes, counting array and frame buffers"""
+    try:
+        memory_usage = getattr(value, 'memory_usage', None)
+        if callable(memory_usage):
+            # pandas objects
+            usage = memory_usage(deep=True)
+            return int(getattr(usage, 'sum', lambda: usage)())
+        nbytes = getattr(value, 'nbytes', None)
+        if isinstance(nbytes, int):
+            return max(nbytes, sys.getsizeof(value))
+        size = sys.getsizeof(value)
+    except Exception:
+        return 0
+    if _depth < 2 and isinstance(value, (list, tuple, set, frozenset, dict)):
+        items = value.items() if isinstance(value, dict) else value
+        # estimate large containers from a sample
+        sample = list(itertools.islice(items, 1000))
+        if sample:
+            total = sum(estimate_size(v, _depth + 1) for v in sample)
+            size += total * len(value) // len(sample)
+    return size
+
+def value_fingerprint(value, _depth=0):
+    """A cheap stand-in for value to compare with ==, or None if value
+    cannot be fingerprinted and has to be treated as changed"""
+    if value is None or isinstance(value, (bool, int, float, complex)):
+        return (type(value), value)
+    if isinstance(value, (str, bytes)):
+        data = value.encode("utf-8", "surrogatepass") if isinstance(value, str) else value
+        return (type(value), hashlib.blake2b(data, digest_size=16).digest())
+    if isinstance(value, (tuple, LinkedResult)) and _depth < 2:
+        items = value.items() if isinstance(value, LinkedResult) else enumerate(value)
+        parts = []
+        for key, item in items:
+            fingerprint = value_fingerprint(item, _depth + 1)
+            if fingerprint is None:
+                return None
+            parts.append((key, fingerprint))
+        return (type(value), tuple(parts))
+    try:
+        dtype = getattr(value, "dtype", None)
+        if hasattr(value, "__array_interface__") and not dtype.hasobject:
+            # numpy arrays
+            return (type(value), str(dtype), value.shape,
+                    hashlib.blake2b(value.tobytes(), digest_size=16).digest())
+        pandas = sys.modules.get("pandas")
+        if pandas is not None and isinstance(value, (pandas.DataFrame, pandas.Series)):
+            hashes = pandas.util.hash_pandas_object(value, index=True).values
+            columns = getattr(value, "columns", None)
+            return (type(value), str(value.dtypes), None if columns is None else tuple(columns),
+                    hashlib.blake2b(hashes.tobytes(), digest_size=16).digest())
+    except Exception:
+        pass
+    return None
+
+# one execution of a cell: seconds of wall and CPU time, growth of the
+# process's peak memory in bytes (None where unknown), and result size
+RunStats = namedtuple('RunStats', 'wall cpu peak_memory output_size success')
+
+class branch_local(object):
+    """An attribute that concurrently running branches keep separately.
+
+    Outside of a branch this behaves like a plain instance attribute. Inside
+    a branch, reads fall back to the instance value until the branch sets its
+    own; writes go to both so that readers outside the branch (e.g. the
+    iopub thread) still see the latest value.
+    """
+    def __init__(self, default=None):
+        self.default = default
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        state = _branch_state.get()
+        if state is not None and (id(obj), self.name) in state:
+            return state[(id(obj), self.name)]
+        return obj.__dict__.get(self.name, self.default)
+
+    def __set__(self, obj, value):
+        state = _branch_state.get()
+        if state is not None:
+            state[(id(obj), self.name)] = value
+        obj.__dict__[self.name] = value
 
 class DataflowCellException(Exception):
     def __init__(self, cid):
@@ -21,11 +121,23 @@ class DataflowInvalidRefError(DataflowCellException):
 
 class DataflowHistoryManager(object):
     deleted_cells = []
-    storeditems = []
+    storeditems = branch_local()
     tup_flag = False
 
+    # memory budget in bytes for value_cache, 0 for no limit
+    cache_limit = 0
+    # optional SpillStore that evicted values are written to
+    spill_store = None
+    # optional Metrics, set when the kernel exports metrics
+    metrics = None
+    # number of runs kept per cell in run_stats
+    run_history_length = 10
+    # leave downstream cells as they were when a recomputed value is unchanged
+    early_cutoff = False
+
     def __init__(self, shell, **kwargs):
         self.shell = shell
+        self.storeditems = []
         self.flags = dict(kwargs)
         self.auto_update_flags = {}
         self.force_cached_flags = {}
@@ -36,12 +148,17 @@ class DataflowHistoryManager(object):
         self.flags.update(kwargs)
         # self.flags['silent'] = True
 
-    def update_code(self, key, code):        
+    def update_code(self, key, code, mark_stale=True):
         # print("CALLING UPDATE CODE", key, code)
         # if code is empty, remove the code_cache, remove links
-        if code == '' and key in self.value_cache and key in self.code_cache:
-            self.set_stale(key)
-            del self.value_cache[key]
+        # mark_stale=False is for callers that already marked key and its
+        # downstream cells stale, see update_codes
+        if code == '' and self.has_value(key) and key in self.code_cache:
+            if mark_stale:
+                self.set_stale(key)
+            self.drop_value(key)
+            self.code_changed.discard(key)
+            self.fingerprints.pop(key, None)
             del self.code_cache[key]
             for child in self.all_downstream(key):
                 self.remove_dependencies(key, child)
@@ -57,19 +174,36 @@ class DataflowHistoryManager(object):
             self.shell.dataflow_state.reset_cell(key)
             self.func_cached[key] = False
             self.code_cache[key] = code
-            self.set_stale(key)
+            self.code_changed.add(key)
+            if mark_stale:
+                self.set_stale(key)
             if key not in self.auto_update_flags:
                 self.auto_update_flags[key] = False;
             if key not in self.force_cached_flags:
                 self.force_cached_flags[key] = False;
 
-    def update_codes(self, code_dict):
-        existing_keys = set(self.code_cache.keys())
-        deleted_keys = existing_keys.difference(code_dict.keys())
+    def update_codes(self, code_dict, deleted_keys=None):
+        """Update the code of the cells in code_dict and clear deleted_keys.
+
+        If deleted_keys is None, code_dict is the whole notebook and every
+        other known cell is treated as deleted.
+        """
+        if deleted_keys is None:
+            existing_keys = set(self.code_cache.keys())
+            deleted_keys = existing_keys.difference(code_dict.keys())
+        else:
+            deleted_keys = [k for k in deleted_keys if k in self.code_cache]
+        # mark everything the changes reach in one traversal, before deleted
+        # cells lose their links
+        changed = [k for k, code in code_dict.items()
+                   if k not in self.code_cache or self.code_cache[k] != code]
+        changed.extend(k for k in deleted_keys
+                       if self.has_value(k) or self.code_cache[k] != '')
+        self.set_stale_cells(changed)
         for key, val in code_dict.items():
-            self.update_code(key, val)
+            self.update_code(key, val, mark_stale=False)
         for key in deleted_keys:
-            self.update_code(key, '')
+            self.update_code(key, '', mark_stale=False)
 
     def update_auto_update(self, flags):
         self.auto_update_flags.update(flags)
@@ -80,38 +214,256 @@ class DataflowHistoryManager(object):
     def set_stale(self, key):
         self.code_stale[key] = True
         # need to make sure everything downstream also gets set to stale
-        for cid in self.all_downstream(key):
+        downstream = self.all_downstream(key)
+        for cid in downstream:
+            self.code_stale[cid] = True
+        if self.metrics is not None:
+            self.metrics.observe("stale_propagation_cells", len(downstream) + 1)
+
+    def set_stale_cells(self, keys):
+        """Mark keys and everything downstream of any of them stale in a
+        single walk of the graph"""
+        marked = set()
+        frontier = deque(keys)
+        while frontier:
+            cid = frontier.popleft()
+            if cid in marked:
+                continue
+            marked.add(cid)
             self.code_stale[cid] = True
+            frontier.extend(c for c in self.dep_children.get(cid, ()) if c not in marked)
+        if self.metrics is not None and marked:
+            self.metrics.observe("stale_propagation_cells", len(marked))
 
     def set_not_stale(self, key):
         self.code_stale[key] = False
+        self.code_changed.discard(key)
 
     def is_stale(self, key):
         return key in self.code_stale and self.code_stale[key]
 
-    def update_value(self, key, value):
+    def update_value(self, key, value, compute_time=None):
 
-        self.value_cache[key] = value
+        self.drop_value(key)
+        # move key to the end so last_calculated stays in execution order
+        previous = self.last_calculated.pop(key, None)
         self.last_calculated[key] = self.last_calculated_ctr
         self.last_calculated_ctr += 1
+        if compute_time is not None:
+            self.compute_times[key] = compute_time
+        self.restore_value(key, value)
+        if self.early_cutoff:
+            fingerprint = value_fingerprint(value)
+            unchanged = (fingerprint is not None
+                         and self.fingerprints.get(key) == fingerprint)
+            self.fingerprints[key] = fingerprint
+            if unchanged:
+                self.cut_off(key, previous)
+
+    def cut_off(self, key, previous):
+        """key was recomputed to the value it had after its run at counter
+        previous, so the cells that are stale only because of it are up to
+        date again.
+
+        A cell is left stale if its own code changed, it has no value, any
+        of its parents is still stale, or it was last computed before one
+        of its parents produced its current value (before previous for key),
+        since it then used a value that may differ.
+        """
+        self.set_not_stale(key)
+        count = 0
+        frontier = deque(self.dep_children.get(key, ()))
+        while frontier:
+            cid = frontier.popleft()
+            if (not self.is_stale(cid) or cid in self.code_changed
+                    or cid not in self.code_cache or not self.has_value(cid)
+                    or any(self.is_stale(pid) for pid in self.dep_parents[cid])
+                    or not self._used_current_values(cid, key, previous)):
+                continue
+            self.code_stale[cid] = False
+            count += 1
+            # children are queued again by each parent that is cut off,
+            # so they are checked once all of their parents are
+            frontier.extend(self.dep_children.get(cid, ()))
+        if self.metrics is not None and count:
+            self.metrics.inc("early_cutoff_cells", count)
+
+    def _used_current_values(self, cid, key, previous):
+        calculated = self.last_calculated.get(cid)
+        if calculated is None:
+            return False
+        for pid in self.dep_parents[cid]:
+            produced = previous if pid == key else self.last_calculated.get(pid)
+            if produced is None or produced > calculated:
+                return False
+        return True
+
+    def record_run(self, key, wall, cpu, peak_memory, output_size, success):
+        runs = self.run_stats.get(key)
+        if runs is None or runs.maxlen != self.run_history_length:
+            runs = self.run_stats[key] = deque(runs or (), self.run_history_length)
+        runs.append(RunStats(wall, cpu, peak_memory, output_size, success))
+
+    def run_history(self, key):
+        """The recorded runs of key, oldest first"""
+        return list(self.run_stats.get(key, ()))
+
+    def run_summary(self, keys=None):
+        """Statistics over the recorded runs of keys (default: every cell),
+        slowest cells first"""
+        if keys is None:
+            keys = self.run_stats.keys()
+        summary = {}
+        for key in keys:
+            runs = self.run_stats.get(key)
+            if not runs:
+                continue
+            memory = [r.peak_memory for r in runs if r.peak_memory is not None]
+            summary[key] = {
+                "runs": len(runs),
+                "failures": sum(not r.success for r in runs),
+                "wall_last": runs[-1].wall,
+                "wall_mean": sum(r.wall for r in runs) / len(runs),
+                "wall_max": max(r.wall for r in runs),
+                "cpu_mean": sum(r.cpu for r in runs) / len(runs),
+                "peak_memory_max": max(memory) if memory else None,
+                "output_size": runs[-1].output_size,
+            }
+        return dict(sorted(summary.items(), key=lambda item: -item[1]["wall_mean"]))
+
+    def restore_value(self, key, value):
+        self.evicted.discard(key)
+        self.value_cache[key] = value
+        if self.cache_limit:
+            self.value_sizes[key] = estimate_size(value)
+            self.cache_size += self.value_sizes[key]
+            self.touch_value(key)
+            self.cull_cache(keep=(key,))
+
+    def has_value(self, key):
+        """Whether key has a result, even if it was evicted"""
+        return key in self.value_cache or key in self.evicted
+
+    def drop_value(self, key):
+        self.value_cache.pop(key, None)
+        self.evicted.discard(key)
+        if self.spill_store is not None:
+            self.spill_store.discard(key)
+        self.cache_size -= self.value_sizes.pop(key, 0)
+        self.cache_priority.pop(key, None)
+
+    def touch_value(self, key):
+        # GreedyDual-Size: recently used values that are slow to compute
+        # but small stay the longest
+        if key in self.value_sizes:
+            cost = self.compute_times.get(key, 0.001)
+            self.cache_priority[key] = (self.cache_clock
+                                        + cost / max(self.value_sizes[key], 1))
+
+    def evict(self, key):
+        """Drop the value of key, spilling it to disk if there is a store.
+
+        It is reloaded or recomputed when next accessed."""
+        value = self.value_cache.get(key)
+        self.drop_value(key)
+        if self.spill_store is not None:
+            self.spill_store.put(key, value)
+        self.evicted.add(key)
+
+    def reload(self, key):
+        """Bring back an evicted value from disk, or recompute it"""
+        if self.spill_store is not None:
+            try:
+                value = self.spill_store.get(key)
+            except KeyError:
+                pass
+            else:
+                if isinstance(value, LinkedResult):
+                    value.__sethist__(self)
+                self.restore_value(key, value)
+                return value
+        return self.refresh(key)
+
+    def cache_stats(self):
+        stats = {"size": self.cache_size, "limit": self.cache_limit,
+                 "cached": len(self.value_cache), "evicted": len(self.evicted)}
+        if self.spill_store is not None:
+            stats.update(("spill_" + k, v) for k, v in self.spill_store.stats().items())
+        return stats
+
+    def cull_cache(self, keep=()):
+        """Evict values until the cache fits in cache_limit.
+
+        Stale values go first, then those with the lowest priority. Cells
+        with force_cached set and those in keep are never evicted.
+        """
+        evicted = []
+        if self.cache_limit:
+            # values stored before a limit was set
+            for k in self.value_cache.keys() - self.value_sizes.keys():
+                self.value_sizes[k] = estimate_size(self.value_cache[k])
+                self.cache_size += self.value_sizes[k]
+                self.touch_value(k)
+        while self.cache_limit and self.cache_size > self.cache_limit:
+            candidates = [k for k in self.value_sizes if k not in keep
+                          and not self.force_cached_flags.get(k, False)]
+            if not candidates:
+                break
+            victim = min(candidates, key=lambda k: (not self.is_stale(k),
+                                                    self.cache_priority.get(k, 0)))
+            self.cache_clock = max(self.cache_clock,
+                                   self.cache_priority.get(victim, 0))
+            self.evict(victim)
+            evicted.append(victim)
+        return evicted
 
     def sorted_keys(self):
-        return (k2 for (v2, k2) in sorted((v, k) for (k, v) in self.last_calculated.items()))
+        return iter(self.last_calculated)
+
+    def calculated_since(self, ctr):
+        """The cells calculated after counter ctr, in execution order"""
+        keys = []
+        for k in reversed(self.last_calculated):
+            if self.last_calculated[k] <= ctr:
+                break
+            keys.append(k)
+        keys.reverse()
+        return keys
 
     def clear(self):
         self.func_cached = {}
         self.code_cache = {}
         self.code_stale = {}
         self.value_cache = {}
+        # cells whose values were evicted to stay within cache_limit
+        self.evicted = set()
+        self.value_sizes = {}
+        self.cache_size = 0
+        self.compute_times = {}
+        # cells stale because their own code changed, not an upstream cell's
+        self.code_changed = set()
+        # cell -> value_fingerprint of its value, kept with early_cutoff
+        self.fingerprints = {}
+        # cell -> deque of RunStats for its last run_history_length runs
+        self.run_stats = {}
+        self.cache_priority = {}
+        self.cache_clock = 0.0
+        # cell -> execution counter, in execution order
         self.last_calculated = {}
         # dependencies are a DAG
         self.dep_parents = defaultdict(set) # child -> list(parent)
         self.dep_children = defaultdict(set) # parent -> list(child)
         self.dep_semantic_parents = defaultdict(dict)
         self.last_calculated_ctr = 0
+        # memoized transitive closures (cell id -> frozenset of cell ids),
+        # maintained by update_dependencies/remove_dependencies
+        self.upstream_closures = {}
+        self.downstream_closures = {}
 
     def update_dependencies(self, parent, child):
         self.storeditems.append({'parent':parent, 'child':child})
+        if parent not in self.dep_parents[child]:
+            self.invalidate_closures(parent, child)
         self.dep_parents[child].add(parent)
         self.dep_children[parent].add(child)
         if parent not in self.dep_semantic_parents[child]:
@@ -122,8 +474,22 @@ class DataflowHistoryManager(object):
             self.dep_semantic_parents[child][parent].add(item)
 
     def remove_dependencies(self, parent, child):
+        if parent in self.dep_parents[child]:
+            self.invalidate_closures(parent, child)
         self.remove_dep(parent, child, self.dep_parents, self.dep_children)
 
+    def invalidate_closures(self, parent, child):
+        # an edge parent -> child can only change the upstream closures
+        # that contain child and the downstream closures that contain parent
+        stale_ups = [k for k, ups in self.upstream_closures.items()
+                     if k == child or child in ups]
+        for k in stale_ups:
+            del self.upstream_closures[k]
+        stale_downs = [k for k, downs in self.downstream_closures.items()
+                       if k == parent or parent in downs]
+        for k in stale_downs:
+            del self.downstream_closures[k]
+
     def remove_semantic_dependencies(self, parent, child,item=None):
         if parent in self.dep_semantic_parents[child]:
             if item:
@@ -146,37 +512,40 @@ class DataflowHistoryManager(object):
 
 
     def get_all_upstreams(self, k, semantic=False):
-        visited = set()
-        res = set(self.get_semantic_upstream(k)) if semantic else set()
-        frontier = list(self.dep_parents[k])
-        while frontier:
-            cid = frontier.pop(0)
-            visited.add(cid)
-            if semantic:
+        if semantic:
+            res = set(self.get_semantic_upstream(k))
+            for cid in self.upstream_closure(k):
                 res.update(self.get_semantic_upstream(cid))
-            else:
-                res.add(cid)
-            for pid in self.dep_parents[cid]:
-                if pid not in visited:
-                    frontier.append(pid)
-        return list(res)
+            return list(res)
+        return list(self.upstream_closure(k))
 
+    def upstream_closure(self, k):
+        if k not in self.upstream_closures:
+            self.upstream_closures[k] = self.compute_closure(k, self.dep_parents)
+        return self.upstream_closures[k]
 
     def all_downstream(self, k):
         return self.get_all_downstream(k)
 
     def get_all_downstream(self, k):
-        visited = set()
+        return list(self.downstream_closure(k))
+
+    def downstream_closure(self, k):
+        if k not in self.downstream_closures:
+            self.downstream_closures[k] = self.compute_closure(k, self.dep_children)
+        return self.downstream_closures[k]
+
+    @staticmethod
+    def compute_closure(k, edges):
         res = set()
-        frontier = list(self.dep_children[k])
+        frontier = deque(edges.get(k, ()))
         while frontier:
-            cid = frontier.pop(0)
-            visited.add(cid)
+            cid = frontier.popleft()
+            if cid in res:
+                continue
             res.add(cid)
-            for pid in self.dep_children[cid]:
-                if pid not in visited:
-                    frontier.append(pid)
-        return list(res)
+            frontier.extend(pid for pid in edges.get(cid, ()) if pid not in res)
+        return frozenset(res)
 
     def get_downstream(self, k):
         return list(self.dep_children[k])
@@ -207,6 +576,110 @@ class DataflowHistoryManager(object):
                 # stack that are internal (get_item, etc.)
                 retval.raise_error()
 
+    def needs_refresh(self, k):
+        return (self.is_stale(k) and k in self.code_cache
+                and not self.force_cached_flags.get(k, False))
+
+    def stale_upstream(self, k, parents=None):
+        """Return the stale ancestors of k in topological order.
+
+        Walks dep_parents from k (or from the given parents) through stale
+        cells only, since a fresh cell cannot have stale ancestors.
+        """
+        return self._topological_order(
+            self._stale_ancestors(k, parents, self.needs_refresh))
+
+    def _stale_ancestors(self, k, parents, needs_refresh):
+        if parents is None:
+            parents = self.dep_parents[k]
+        stale = set()
+        frontier = deque(pid for pid in parents if pid != k)
+        while frontier:
+            cid = frontier.popleft()
+            if cid in stale or not needs_refresh(cid):
+                continue
+            stale.add(cid)
+            frontier.extend(pid for pid in self.dep_parents.get(cid, ())
+                            if pid != k and pid not in stale)
+        return stale
+
+    def plan_execution(self, k, parents=None, changed=()):
+        """Return what executing k would run, without running anything.
+
+        The cells in changed, whose code was edited since the kernel last
+        saw it, and their descendants are counted as stale. Each cell in the
+        plan, the stale ancestors in the order they would run followed by k,
+        is estimated to take as long as its last run; cells that have not
+        run yet have no estimate and are listed under unestimated.
+        """
+        assumed = set()
+        for cid in changed:
+            assumed.add(cid)
+            assumed.update(self.downstream_closure(cid))
+        needs_refresh = lambda cid: self.needs_refresh(cid) or (
+            cid in assumed and cid in self.code_cache
+            and not self.force_cached_flags.get(cid, False))
+        order = self._topological_order(
+            self._stale_ancestors(k, parents, needs_refresh))
+        order.append(k)
+        cells = [{"uuid": cid, "seconds": self.compute_times.get(cid)}
+                 for cid in order]
+        return {
+            "cells": cells,
+            "estimated_seconds": sum(c["seconds"] for c in cells
+                                     if c["seconds"] is not None),
+            "unestimated": [c["uuid"] for c in cells if c["seconds"] is None],
+        }
+
+    def make_plan(self, keys):
+        """Return (plan, fresh) for bringing the cells in keys up to date.
+
+        plan lists the stale cells among keys and their stale ancestors in
+        topological order; fresh is the set of cells the walk stopped at
+        because they were already up to date.
+        """
+        stale = set()
+        fresh = set()
+        frontier = deque(keys)
+        while frontier:
+            cid = frontier.popleft()
+            if cid in stale or cid in fresh:
+                continue
+            if not self.needs_refresh(cid):
+                fresh.add(cid)
+                continue
+            stale.add(cid)
+            frontier.extend(self.dep_parents.get(cid, ()))
+        return self._topological_order(stale), fresh
+
+    def _topological_order(self, stale):
+        # Kahn's algorithm, ties broken by the previous execution order
+        order_key = lambda cid: (self.last_calculated.get(cid, -1), cid)
+        in_degree = {cid: len(self.dep_parents[cid] & stale) for cid in stale}
+        ready = deque(sorted((cid for cid, deg in in_degree.items() if deg == 0),
+                             key=order_key))
+        res = []
+        while ready:
+            cid = ready.popleft()
+            res.append(cid)
+            for child in sorted(self.dep_children[cid] & stale, key=order_key):
+                in_degree[child] -= 1
+                if in_degree[child] == 0:
+                    ready.append(child)
+        if len(res) < len(stale):
+            raise CyclicalCallError(next(cid for cid in stale if cid not in res))
+        return res
+
+    def refresh(self, k):
+        # run every stale ancestor exactly once, parents first, so that
+        # executing k never has to recurse back into get_item
+        stale = self.stale_upstream(k)
+        if self.metrics is not None:
+            self.metrics.inc("reexecutions", len(stale) + 1)
+        for cid in stale:
+            self.execute_cell(cid)
+        return self.execute_cell(k)
+
     def execute_cell(self, k, **flags):
         # print("EXECUTING CELL", k)
         local_flags = dict(self.flags)
@@ -256,14 +729,23 @@ class DataflowHistoryManager(object):
             if k not in self.value_cache:
                 raise DataflowCacheError(k)
             # print("returning cache", k)
+            if self.metrics is not None:
+                self.metrics.inc("value_cache_hits")
             return self.value_cache[k]
 
         # check if we need to recompute
-        if not self.is_stale(k):
+        if not self.is_stale(k) and k not in self.evicted:
             # print("returning not stale cache", k)
+            if self.metrics is not None:
+                self.metrics.inc("value_cache_hits")
+            self.touch_value(k)
             return self.value_cache[k]
+        if self.metrics is not None:
+            self.metrics.inc("value_cache_misses")
+        if not self.is_stale(k):
+            return self.reload(k)
         # print('executing cell', k)
-        return self.execute_cell(k)
+        return self.refresh(k)
 
     def __setitem__(self, key, value):
         class InvalidCellModification(KeyError):
@@ -378,11 +860,22 @@ class DuplicateNameError(Exception):
         return "name '{}' has already been defined in Cell '{}'".format(self.var_name,self.cell_id)
 
 class DataflowState:
+    cur_cell_id = branch_local()
+
     def __init__(self, history):
         self.history = history
-        self.links = defaultdict(list)
-        self.all_links = defaultdict(set) # most recent is last
+        # tag -> cells that made it current, as dict keys; most recent is last
+        self.links = defaultdict(dict)
+        self.all_links = defaultdict(set)
         self.rev_links = defaultdict(set)
+        # names whose links changed since the last pop_changed_links
+        self.changed_links = set()
+        # bumped on every change to the links, for caches to validate against
+        self.version = 0
+        # sorted names with at least one cell in all_links, for completion
+        self.link_names = []
+        self._input_tags = {}
+        self._input_tags_by_cell = {}
         self.cur_cell_id = None
 
     def set_cur_cell_id(self, cell_id):
@@ -428,6 +921,10 @@ class DataflowState:
         for (cell_id, tag_list) in output_tags.items():
             for tag in tag_list:
                 # print("OUTER ADD_LINKS:", cell_id, tag)
+                # tags already linked to the cell, with a current link, are
+                # left alone so this stays cheap when called on every execution
+                if cell_id in self.all_links.get(tag, ()) and self.has_current_link(tag):
+                    continue
                 self.add_link(tag, cell_id, make_current=False)
                 new_tags.add(tag)
         for tag in new_tags:
@@ -435,34 +932,48 @@ class DataflowState:
                 # can make current because unambiguous
                 cell_id = next(iter(self.all_links[tag]))
                 # print('ADDING TAG (ADD_LINKS):', cell_id, tag)
-                self.links[tag].append(cell_id)
+                self.links[tag][cell_id] = None
+                self.changed_links.add(tag)
+                self.version += 1
 
     def add_link(self, tag, cell_id, make_current=True):
         # print("OUTER ADD_LINK:", cell_id, tag)
         if isinstance(tag, str):
+            if make_current or cell_id not in self.all_links[tag]:
+                self.changed_links.add(tag)
+                self.version += 1
+            if not self.all_links[tag]:
+                insort(self.link_names, tag)
             self.all_links[tag].add(cell_id)
             self.rev_links[cell_id].add(tag)
             if make_current:
                 # print('ADDING TAG (ADD_LINK):', cell_id, tag)
-                self.links[tag].append(cell_id)
+                # re-adding moves the cell to the end
+                self.links[tag].pop(cell_id, None)
+                self.links[tag][cell_id] = None
 
     def reset_cell(self, cell_id):
         # print(f"{cell_id} LINKS: {self.links} REV LINKS: {self.rev_links} ALL_LINKS: {self.all_links}")
         if cell_id in self.rev_links:
+            self.changed_links.update(self.rev_links[cell_id])
             for name in self.rev_links[cell_id]:
-                if cell_id in self.links[name]:
-                    self.links[name].remove(cell_id)
-                self.all_links[name].discard(cell_id)
+                self.links[name].pop(cell_id, None)
+                cell_ids = self.all_links[name]
+                if cell_id in cell_ids:
+                    cell_ids.discard(cell_id)
+                    if not cell_ids:
+                        del self.link_names[bisect_left(self.link_names, name)]
             del self.rev_links[cell_id]
+            self.version += 1
 
     def has_current_link(self, k):
         # print("HAS CURRENT LINK:", k, self.links[k])
-        return k in self.links and len(self.links[k]) > 0
+        return len(self.links.get(k, ())) > 0
 
     def get_current_link(self, k):
         if not self.has_current_link(k):
             raise DataflowCellException(f"No cell defines '{k}'")
-        return self.links[k][-1]
+        return next(reversed(self.links[k]))
 
     def has_external_link(self, k, cur_id):
         return self.has_current_link(k) and self.get_current_link(k) != cur_id
@@ -471,6 +982,7 @@ class DataflowState:
     def get_external_link(self, k, cur_id):
         if not self.has_external_link(k, cur_id):
             raise DataflowCellException(f"No external link to '{k}'")
+        # cur_id is in the links at most once, so this looks at two cells
         for cell_id in reversed(self.links[k]):
             if cell_id != cur_id:
                 return cell_id
@@ -481,28 +993,49 @@ class DataflowState:
         cell_start = None
         if '$' in text:
             id_start, cell_start = text.split('$',maxsplit=1)
-        import sys
-        # print(f"COMPLETER INTERNAL: '{id_start}' '{cell_start}'", file=sys.__stdout__)
-        for link, cell_ids in self.all_links.items():
-            if link.startswith(id_start):
-                if cell_start:
-                    results.extend(link + '$' + input_tag
-                                   for input_tag, cell_id in input_tags.items()
-                                   if input_tag.startswith(cell_start) and cell_id in cell_ids)
-                    results.extend(link + '$' + cell_id
-                                   for cell_id in cell_ids
-                                   if cell_id.startswith(cell_start))
-                else:
-                    if cell_start is None:
-                        results.append(link)
-                    results.extend(link + '$' + input_tag for input_tag, cell_id in input_tags.items() if cell_id in cell_ids)
-                    results.extend(link + '$' + cell_id for cell_id in cell_ids)
+        names = self.link_names
+        i = bisect_left(names, id_start)
+        tags_by_cell = self._tags_by_cell(input_tags)
+        while i < len(names) and names[i].startswith(id_start):
+            link = names[i]
+            cell_ids = self.all_links[link]
+            i += 1
+            if cell_start is None:
+                results.append(link)
+            results.extend(link + '$' + input_tag
+                           for cell_id in cell_ids
+                           for input_tag in tags_by_cell.get(cell_id, ())
+                           if not cell_start or input_tag.startswith(cell_start))
+            results.extend(link + '$' + cell_id
+                           for cell_id in cell_ids
+                           if not cell_start or cell_id.startswith(cell_start))
         return results
 
+    def _tags_by_cell(self, input_tags):
+        # the input tags only change between requests, so keep the inverse
+        if self._input_tags != input_tags:
+            self._input_tags = dict(input_tags)
+            self._input_tags_by_cell = defaultdict(list)
+            for input_tag, cell_id in input_tags.items():
+                self._input_tags_by_cell[cell_id].append(input_tag)
+        return self._input_tags_by_cell
+
+    def rebuild_index(self):
+        """Recompute link_names after all_links was replaced wholesale"""
+        self.link_names = sorted(name for name, cell_ids in self.all_links.items() if cell_ids)
+
+    def pop_changed_links(self):
+        """Return the names whose links changed since the last call"""
+        changed, self.changed_links = self.changed_links, set()
+        return changed
+
     def clear(self):
+        self.changed_links.update(self.all_links)
         self.links.clear()
         self.all_links.clear()
         self.rev_links.clear()
+        self.link_names.clear()
+        self.version += 1
 
 class DataflowNamespace(dict):
     def clear(self):
@@ -1,4 +1,7 @@
 from collections import OrderedDict
+import importlib
+import types
+
 class LinkedResult(OrderedDict):
     __dfhist__ = None
     def __init__(self, __uuid, __libs, __none_flag, k_v_tuples):
@@ -54,6 +57,27 @@ class LinkedResult(OrderedDict):
     def __sethist__(self, hist):
         self.__dfhist__ = hist
 
+    def __reduce__(self):
+        # drop the history (it holds the shell) and pickle modules by name
+        items = [(k, _ModuleRef(v.__name__) if isinstance(v, types.ModuleType) else v)
+                 for k, v in self.items()]
+        return (_restore_linked_result, (self.__uuid__, self.__libs__, items))
+
+
+class _ModuleRef(object):
+    def __init__(self, name):
+        self.name = name
+
+
+def _restore_linked_result(uuid, libs, items):
+    res = LinkedResult.__new__(LinkedResult)
+    OrderedDict.__init__(res, [
+        (k, importlib.import_module(v.name) if isinstance(v, _ModuleRef) else v)
+        for k, v in items])
+    res.__libs__ = libs
+    res.__uuid__ = uuid
+    return res
+
 
 class DFTuple(tuple):
     def __new__(self, __linked, *args, **kwargs):
@@ -1,18 +1,30 @@
 """Replacements for ipykernel.displayhook."""
 
+from collections import OrderedDict
 import sys
 
 from ipykernel.displayhook import ZMQShellDisplayHook as ipyZMQShellDisplayHook
 from ipykernel.displayhook import ZMQDisplayHook
 from ipykernel.jsonutil import encode_images, json_clean
+from IPython.utils.dir2 import get_real_method
 
+from .dataflow import branch_local
 from .dflink import LinkedResult
+from .profiler import phase
 
 # Updated to consider format_dict/md_dict as a dictionary of dictionaries
 # This allows us to follow the original code, adding loops
 # to handle multiple outputs
 
 class ZMQShellDisplayHook(ipyZMQShellDisplayHook):
+    # each concurrently running branch fills in its own ExecutionResult
+    exec_result = branch_local()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # cell id -> (last_calculated counter, {(output tag, mimetype): (data, metadata)})
+        self.rendered = {}
+
     def get_execution_count(self):
         raise NotImplementedError()
 
@@ -37,13 +49,78 @@ class ZMQShellDisplayHook(ipyZMQShellDisplayHook):
             # make non-linked result look like a linked result
             result = {None: result}
         for i, (res_tag, res) in enumerate(result.items()):
-            format_dict, md_dict = super().compute_format_data(res)
+            with phase("format"):
+                if self.shell.lazy_formats and not self._formats_itself(res):
+                    # other mimetypes are rendered by render_format on request
+                    format_dict, md_dict = self.shell.display_formatter.format(
+                        res, include=("text/plain",))
+                    md_dict["lazy_formats"] = self.available_formats(res)
+                else:
+                    format_dict, md_dict = super().compute_format_data(res)
             if res_tag is not None:
                 md_dict["output_tag"] = res_tag
             format_dicts[i] = format_dict
             md_dicts[i] = md_dict
         return format_dicts, md_dicts
 
+    @staticmethod
+    def _formats_itself(obj):
+        # these choose their own mimetypes, so they are formatted eagerly
+        return (get_real_method(obj, "_repr_mimebundle_") is not None
+                or get_real_method(obj, "_ipython_display_") is not None)
+
+    def available_formats(self, obj):
+        """The mimetypes other than text/plain that obj could be formatted as"""
+        formats = []
+        for mimetype, formatter in self.shell.display_formatter.formatters.items():
+            if mimetype == "text/plain" or not formatter.enabled:
+                continue
+            try:
+                formatter.lookup(obj)
+            except KeyError:
+                if get_real_method(obj, formatter.print_method) is None:
+                    continue
+            formats.append(mimetype)
+        return formats
+
+    def render_format(self, uuid, tag, mimetype):
+        """Format the output tag of cell uuid as mimetype.
+
+        Returns (data, metadata) for the mimetype, either of which may be
+        None if the object has no such representation. Results are cached
+        until the cell is computed again, see prune_rendered.
+
+        This and the dfformat comm serve clients that send lazy_formats in
+        __dfkernel_data__; the notebook frontend does not use them yet and
+        always receives every format.
+        """
+        history = self.shell.dataflow_history_manager
+        if uuid not in history.value_cache:
+            raise LookupError("Cell '{}' has no output to format".format(uuid))
+        version = history.last_calculated.get(uuid)
+        if self.rendered.get(uuid, (None,))[0] != version:
+            self.rendered[uuid] = (version, {})
+        cache = self.rendered[uuid][1]
+        if (tag, mimetype) not in cache:
+            result = history.value_cache[uuid]
+            if isinstance(result, LinkedResult):
+                if tag not in result:
+                    raise LookupError("Cell '{}' has no output '{}'".format(uuid, tag))
+                # not result[tag], which records a dependency on the running cell
+                result = OrderedDict.__getitem__(result, tag)
+            with phase("format"):
+                format_dict, md_dict = self.shell.display_formatter.format(
+                    result, include=(mimetype,))
+            format_dict = json_clean(encode_images(format_dict))
+            cache[tag, mimetype] = (format_dict.get(mimetype), md_dict.get(mimetype))
+        return cache[tag, mimetype]
+
+    def prune_rendered(self):
+        """Forget what was rendered for cells whose output is gone"""
+        value_cache = self.shell.dataflow_history_manager.value_cache
+        for uuid in [uuid for uuid in self.rendered if uuid not in value_cache]:
+            del self.rendered[uuid]
+
     # from ipykernel.ipykernel.displayhook
     def write_format_data(self, format_dicts, md_dicts=None):
         if self.msg:
@@ -61,10 +138,20 @@ class ZMQShellDisplayHook(ipyZMQShellDisplayHook):
         if self.msg and self.msg["content"]["data"] and self.session:
             format_dicts = self.msg["content"]["data"]
             md_dicts = self.msg["content"]["metadata"]            
-            for i, format_data in format_dicts.items():
-                self.msg["content"]["data"] = format_data
-                self.msg["content"]["metadata"] = md_dicts.get(i, None)
+            if len(format_dicts) > 1 and self.shell.batch_outputs:
+                # a single message with every output under "outputs"; the
+                # first is also sent as usual for clients that ignore them
+                outputs = [{"data": format_data, "metadata": md_dicts.get(i, None)}
+                           for i, format_data in format_dicts.items()]
+                self.msg["content"]["data"] = outputs[0]["data"]
+                self.msg["content"]["metadata"] = outputs[0]["metadata"]
+                self.msg["content"]["outputs"] = outputs
                 self.session.send(self.pub_socket, self.msg, ident=self.topic)
+            else:
+                for i, format_data in format_dicts.items():
+                    self.msg["content"]["data"] = format_data
+                    self.msg["content"]["metadata"] = md_dicts.get(i, None)
+                    self.session.send(self.pub_socket, self.msg, ident=self.topic)
         self.msg = None
 
     # from IPython.core.displayhook
@@ -97,8 +184,7 @@ class ZMQShellDisplayHook(ipyZMQShellDisplayHook):
             gc.collect()
 
     def cull_cache(self):
-        # FIXME need to decide what to do here
-        # due to the dataflow, we can't necessarily remove
-        # whatever we feel like here...
-        pass
+        # due to the dataflow, we can't remove whatever we feel like here;
+        # evicted values are recomputed when they are referenced again
+        self.shell.dataflow_history_manager.cull_cache()
 
@@ -1,8 +1,11 @@
 import ipykernel.iostream
 
 class OutStream(ipykernel.iostream.OutStream):
+    # execution count of the cell whose output is currently buffered
+    _buffered_execution_count = None
+
     def uuid_hook(self, msg):
-        msg['content']['execution_count'] = self.get_execution_count()
+        msg['content']['execution_count'] = self._buffered_execution_count
         return msg
 
     def add_uuid_hook(self, get_execution_count):
@@ -16,3 +19,15 @@ class OutStream(ipykernel.iostream.OutStream):
 
     def get_execution_count(self):
         raise NotImplementedError("Should be added by the kernelapp");
+
+    def write(self, string):
+        # look up the cell when writing, not when flushing on the iopub
+        # thread, so output from interleaved cells is attributed correctly
+        try:
+            execution_count = self.get_execution_count()
+        except NotImplementedError:
+            execution_count = None
+        if execution_count != self._buffered_execution_count:
+            self.flush()
+            self._buffered_execution_count = execution_count
+        return super().write(string)
@@ -8,11 +8,15 @@ from tokenize import TokenError
 """The IPython kernel implementation"""
 
 import ast
+import builtins
+import getpass
+import hashlib
+import re
 import sys
 import time
 import inspect
 
-from traitlets import Type
+from traitlets import Bool, Integer, Type, Unicode
 from ipykernel.jsonutil import json_clean
 
 from ipykernel.comm import Comm
@@ -23,6 +27,11 @@ try:
 except ImportError:
     _asyncio_runner = None
 
+from .checkpoint import load_checkpoint, save_checkpoint
+from .codesync import CodeSync, DataflowSyncError, GraphSync
+from .dataflow import DataflowCellException
+from . import profiler
+from .spill import ResultStore
 from .zmqshell import ZMQInteractiveShell
 from dfnbutils import (
     ground_refs,
@@ -43,10 +52,76 @@ def _accepts_cell_id(meth):
     )
 
 
+# any identifier in the code, including those in strings and comments
+_name_re = re.compile(r"[^\W\d]\w*")
+
+
+class ConvertedCell(object):
+    """The result of converting the references in a cell's code"""
+
+    def __init__(self, source, input_key):
+        self.source = source
+        self.input_key = input_key
+        self.names = []
+        self.deps = ()
+        # (links version, output tags version) when deps were last checked
+        self.versions = None
+        self.parsed_code = ''
+        self.identifier_refs = None
+        self.persistent_code = None
+        self.display_code = None
+        # code with identifiers converted (stored as the cell's code)
+        self.code = source
+        # code ready to execute
+        self.ref_code = source
+
+
+class CommCell(object):
+    """A cell as last converted by update_code_cells"""
+
+    def __init__(self, code, executed_code, refs):
+        self.code = code
+        self.executed_code = executed_code
+        self.refs = refs
+        self.names = set(_name_re.findall(code))
+        if executed_code:
+            self.names.update(_name_re.findall(executed_code))
+
+
 class IPythonKernel(ipykernel.ipkernel.IPythonKernel):
     shell_class = Type(ZMQInteractiveShell)
     execution_count = None
 
+    parallel_upstream = Bool(
+        False,
+        help="""Run independent stale upstream cells concurrently.
+
+        Each branch of the stale upstream graph runs in its own asyncio task,
+        so cells that await (e.g. `await asyncio.to_thread(pd.read_csv, ...)`)
+        overlap with each other. Cells that do not await still run one at a
+        time.""",
+    ).tag(config=True)
+
+    result_store_dir = Unicode(
+        "",
+        help="""Directory where cell results are kept across kernel restarts.
+
+        Results are keyed by the cell's code and the keys of the upstream
+        results it references, so an unchanged upstream cell can be loaded
+        instead of executed. Empty (the default) disables the store.""",
+    ).tag(config=True)
+
+    result_store_limit = Integer(
+        2**30,
+        help="""Size cap in bytes for result_store_dir; the least recently
+        used results are removed beyond it (0 for no cap).""",
+    ).tag(config=True)
+
+    profile_history = Integer(
+        20,
+        help="""Number of cell timing trees kept for %dfprofile.""",
+    ).tag(config=True)
+
     def __init__(self, **kwargs):
         super(IPythonKernel, self).__init__(**kwargs)
         self.shell.displayhook.get_execution_count = lambda: int(
@@ -56,6 +131,25 @@ class IPythonKernel(ipykernel.ipkernel.IPythonKernel):
             self.execution_count, 16
         )
         get_ipython().kernel.comm_manager.register_target('dfcode', self.dfcode_comm)
+        get_ipython().kernel.comm_manager.register_target('dfcheckpoint', self.checkpoint_comm)
+        get_ipython().kernel.comm_manager.register_target('dfformat', self.format_comm)
+        get_ipython().kernel.comm_manager.register_target('dfmake', self.make_comm)
+        self.code_sync = CodeSync()
+        self.graph_sync = GraphSync()
+        self.profiler = profiler.Profiler(self.profile_history)
+        # set by the kernel app when metrics are exported
+        self.metrics = None
+        self._conversion_cache = {}
+        self._comm_cells = {}
+        self._comm_input_tags = {}
+        self._comm_output_tags = {}
+        self.result_store = None
+        if self.result_store_dir:
+            self.result_store = ResultStore(self.result_store_dir, self.result_store_limit)
+        # cell id -> key of its current result in result_store
+        self._result_keys = {}
+        self._stored_results = {}
+        self._no_store = set()
         
         # # first use nest_ayncio for nested async, then add asyncio.Future to tornado
         # nest_asyncio.apply()
@@ -91,22 +185,241 @@ class IPythonKernel(ipykernel.ipkernel.IPythonKernel):
         @comm.on_msg
         def _recv(msg):
             try:
-                update_latest_executed_code = False
-                dfMetadata = msg['content']['data']['dfMetadata']
-                self.shell.input_tags = dfMetadata['input_tags']
+                reply = {}
+                data = msg['content']['data']
+                if 'dfMetadata' in data:
+                    update_latest_executed_code = False
+                    dfMetadata = data['dfMetadata']
+                    self.shell.input_tags = dfMetadata['input_tags']
+
+                    if data.get('updateExecutedCode') and data['updateExecutedCode']:
+                        update_latest_executed_code = True
+
+                    code_dict, executed_code_dict = self.update_code_cells(dfMetadata, update_latest_executed_code)
+                    reply.update(code_dict=code_dict, executed_code_dict=executed_code_dict)
+                if data.get('plan'):
+                    reply['plan'] = self.plan_execution(data['plan'], data)
+                if 'stats' in data:
+                    # a list of cell ids, or anything falsy for every cell
+                    reply['stats'] = self.run_stats(data['stats'] or None)
+                comm.send(json_clean(reply))
+            except Exception as e:
+                self.log.error('Error in conversion')
+                self.log.error(e)
+                comm.send({'error': str(e)})
+            finally:
+                comm.close()
 
-                if msg['content']['data'].get('updateExecutedCode') and msg['content']['data']['updateExecutedCode']:
-                    update_latest_executed_code = True
+    def plan_execution(self, uuid, data):
+        """What executing uuid would run, with estimated durations.
+
+        data may list the cells edited since they were last executed under
+        changed_cells, and the refs the frontend has for uuid under
+        dfMetadata's all_refs.
+        """
+        history = self.shell.dataflow_history_manager
+        refs = (data.get('dfMetadata') or {}).get('all_refs') or {}
+        parents = set(history.dep_parents.get(uuid, ())).union(
+            (refs.get(uuid) or {}).get('ref') or ())
+        return history.plan_execution(
+            uuid, parents, changed=data.get('changed_cells') or ())
+
+    def run_stats(self, uuids=None):
+        """Summaries of the recent runs of uuids (default: every cell), and
+        for cells asked for by id, the runs themselves"""
+        history = self.shell.dataflow_history_manager
+        stats = {'summary': history.run_summary(uuids)}
+        if uuids is not None:
+            stats['runs'] = {uuid: [run._asdict() for run in history.run_history(uuid)]
+                             for uuid in uuids}
+        return stats
+
+    def checkpoint_comm(self, comm, msg):
+        @comm.on_msg
+        def _recv(msg):
+            try:
+                data = msg['content']['data']
+                if data['action'] == 'save':
+                    report = self.save_checkpoint(data['path'])
+                elif data['action'] == 'restore':
+                    report = self.restore_checkpoint(data['path'])
+                else:
+                    raise ValueError("Unknown checkpoint action '{}'".format(data['action']))
+                comm.send(json_clean(report))
+            except Exception as e:
+                self.log.error('Error in checkpoint')
+                self.log.error(e)
+                comm.send({'error': str(e)})
+            finally:
+                comm.close()
 
-                code_dict, executed_code_dict = self.update_code_cells(dfMetadata, update_latest_executed_code)
-                comm.send({'code_dict': code_dict, 'executed_code_dict': executed_code_dict})
+    def format_comm(self, comm, msg):
+        # kernel-side only for now, see ZMQShellDisplayHook.render_format
+        @comm.on_msg
+        def _recv(msg):
+            try:
+                data = msg['content']['data']
+                format_data, md = self.shell.displayhook.render_format(
+                    data['uuid'], data.get('output_tag'), data['mimetype'])
+                comm.send({
+                    'uuid': data['uuid'],
+                    'output_tag': data.get('output_tag'),
+                    'mimetype': data['mimetype'],
+                    'data': format_data,
+                    'metadata': md,
+                })
             except Exception as e:
-                self.log.error('Error in conversion')
+                self.log.error('Error in formatting')
                 self.log.error(e)
                 comm.send({'error': str(e)})
             finally:
                 comm.close()
 
+    def make_comm(self, comm, msg):
+        @comm.on_msg
+        def _recv(msg):
+            try:
+                history = self.shell.dataflow_history_manager
+                # cells run from a comm send their replies and outputs
+                # against the comm message
+                self._set_outer_request(
+                    self.shell_stream,
+                    self._parent_ident.get("shell", b""),
+                    msg,
+                    {"code_dict": dict(history.code_cache),
+                     "input_tags": self.shell.input_tags},
+                    stop_on_error=False,
+                )
+                report = self.make(msg['content']['data']['names'])
+                comm.send(json_clean(report))
+            except Exception as e:
+                self.log.error('Error in make')
+                self.log.error(e)
+                comm.send({'error': str(e)})
+            finally:
+                comm.close()
+
+    def resolve_name(self, name):
+        """The cell for an output tag, name$cell reference, or cell id"""
+        history = self.shell.dataflow_history_manager
+        state = self.shell.dataflow_state
+        if "$" in name:
+            name, cid = name.split("$", 1)
+            if cid not in history.code_cache:
+                raise LookupError("No cell '{}'".format(cid))
+            return cid
+        if state.has_current_link(name):
+            return state.get_current_link(name)
+        if name in history.code_cache:
+            return name
+        raise LookupError("No cell defines '{}'".format(name))
+
+    def make(self, names):
+        """Bring the cells that define names up to date.
+
+        Only the stale cells among them and their stale ancestors are run,
+        parents first. Returns a report with the cell for each name, the
+        cells that ran, the fresh cells the search stopped at, the cell
+        that failed, if any, and the time taken.
+        """
+        history = self.shell.dataflow_history_manager
+        targets = {name: self.resolve_name(name) for name in names}
+        plan, fresh = history.make_plan(list(targets.values()))
+        start = time.perf_counter()
+        ran = []
+        failed = None
+        for cid in plan:
+            if not history.needs_refresh(cid):
+                fresh.add(cid)
+                continue
+            try:
+                history.execute_cell(cid)
+            except DataflowCellException:
+                failed = cid
+                break
+            ran.append(cid)
+        return {
+            "targets": targets,
+            "ran": ran,
+            "fresh": sorted(fresh, key=lambda cid: history.last_calculated.get(cid, -1)),
+            "failed": failed,
+            "seconds": time.perf_counter() - start,
+        }
+
+    def save_checkpoint(self, path):
+        """Write the cells' code, outputs, and links to path"""
+        return save_checkpoint(self.shell, path)
+
+    def restore_checkpoint(self, path):
+        """Replace the dataflow state with the checkpoint at path"""
+        report = load_checkpoint(self.shell, path)
+        # the checkpoint's code may differ from the notebook's, so ask the
+        # frontend for a full sync and convert every cell again
+        self.code_sync.clear()
+        self.graph_sync.clear()
+        self.shell.displayhook.rendered.clear()
+        self._conversion_cache.clear()
+        self._comm_cells.clear()
+        self._result_keys.clear()
+        self._stored_results.clear()
+        return report
+
+    def graph_reply(self, uuid, res, dfkernel_data):
+        """The cell order and dependency lists for an execute reply.
+
+        If the frontend reports the graph revision it last applied, only
+        what changed since then is included and graph_diff is set: cells
+        that ran since are in cells_moved, in execution order, and cells
+        that were removed are in cells_removed. Every reply to a request
+        diffs against the same revision, so it does not matter which of
+        them the frontend applies.
+        """
+        graph = self.graph_sync
+        base = dfkernel_data.get("graph_revision")
+        diff = graph.is_current(dfkernel_data.get("graph_epoch"), base)
+        graph.next_revision()
+
+        history = self.shell.dataflow_history_manager
+        last_calculated = history.last_calculated
+        for cid in history.calculated_since(graph.counter):
+            graph.update("cell", cid, last_calculated[cid])
+            graph.counter = last_calculated[cid]
+        # every calculated cell is recorded, so any extra ones were removed
+        if len(graph.values.get("cell", ())) > len(last_calculated):
+            for cid in list(graph.values["cell"]):
+                if cid not in last_calculated:
+                    graph.remove("cell", cid)
+                    graph.remove("down", cid)
+        for entry in res.update_downstreams:
+            graph.update("down", entry["key"], entry["data"])
+
+        # the closures of the executed cell are always sent, they do not
+        # grow with the notebook
+        reply = {
+            "graph_epoch": graph.epoch,
+            "graph_revision": graph.revision,
+            "upstream_deps": res.all_upstream_deps,
+            "downstream_deps": res.all_downstream_deps,
+        }
+        if not diff:
+            reply["cells"] = res.cells
+            reply["update_downstreams"] = res.update_downstreams
+            return reply
+
+        changed = graph.changed_since(base)
+        cells = graph.values.get("cell", {})
+        downstreams = graph.values.get("down", {})
+        reply["graph_diff"] = True
+        reply["cells_moved"] = sorted(
+            (cid for kind, cid in changed if kind == "cell" and cid in cells),
+            key=cells.get)
+        reply["cells_removed"] = [
+            cid for kind, cid in changed if kind == "cell" and cid not in cells]
+        reply["update_downstreams"] = [
+            {"key": cid, "data": downstreams[cid]}
+            for kind, cid in changed if kind == "down" and cid in downstreams]
+        return reply
+
     async def execute_request(self, stream, ident, parent):
         """handle an execute_request"""
         try:
@@ -130,25 +443,38 @@ class IPythonKernel(ipykernel.ipkernel.IPythonKernel):
         input_tags = dfkernel_data.get("input_tags", {})
         # print("SETTING INPUT TAGS:", input_tags, file=sys.__stdout__)
 
-        output_tags= defaultdict(set)
-        if dfkernel_data.get('output_tags'):
-            for op_id, op_tags in dfkernel_data['output_tags'].items():
-                for tag in op_tags:
-                    output_tags[tag].add(op_id)
-            
-        
-        self._output_tags = dict(output_tags)
+        try:
+            self.sync_code(dfkernel_data)
+        except DataflowSyncError as e:
+            # the frontend resends the full code_dict on this reply
+            self.log.info("Requesting full code sync: %s", e)
+            reply_content = {
+                "status": "error",
+                "ename": type(e).__name__,
+                "evalue": str(e),
+                "traceback": [],
+                "code_revision": None,
+                "execution_count": int(dfkernel_data.get("uuid") or "1", 16),
+                "user_expressions": {},
+                "payload": [],
+            }
+            self.session.send(
+                stream,
+                "execute_reply",
+                reply_content,
+                parent,
+                metadata=self.init_metadata(parent),
+                ident=ident,
+            )
+            return
+
+        self._output_tags = self.code_sync.tag_cells
         self.shell.input_tags = input_tags
+        self.shell.batch_outputs = bool(dfkernel_data.get("batch_outputs"))
+        self.shell.lazy_formats = bool(dfkernel_data.get("lazy_formats"))
 
-        self._outer_stream = stream
-        self._outer_ident = ident
-        self._outer_parent = parent
-        self._outer_stop_on_error = stop_on_error
-        self._outer_allow_stdin = allow_stdin
-        self._outer_dfkernel_data = dfkernel_data
-        self._identifier_refs = {}
-        self._persistent_code = {}
-        self._expectedUUID = dfkernel_data.get("expectedUUID")
+        self._set_outer_request(stream, ident, parent, dfkernel_data,
+                                stop_on_error, allow_stdin)
         
         res = await self.inner_execute_request(
             code,
@@ -165,8 +491,54 @@ class IPythonKernel(ipykernel.ipkernel.IPythonKernel):
         # self._outer_allow_stdin = None
         # self._outer_dfkernel_data = None
 
+    def _set_outer_request(self, stream, ident, parent, dfkernel_data,
+                           stop_on_error=True, allow_stdin=False):
+        # the request that cells executed by inner_execute_request reply to
+        self._outer_stream = stream
+        self._outer_ident = ident
+        self._outer_parent = parent
+        self._outer_stop_on_error = stop_on_error
+        self._outer_allow_stdin = allow_stdin
+        self._outer_dfkernel_data = dfkernel_data
+        self._identifier_refs = {}
+        self._persistent_code = {}
+        self._upstream_tasks = {}
+        self._expectedUUID = dfkernel_data.get("expectedUUID")
+        self._requested_uuid = dfkernel_data.get("uuid")
+        self._no_store = set(dfkernel_data.get("no_store") or ())
+
+    def sync_code(self, dfkernel_data):
+        """Bring the kernel's view of the notebook up to date with dfkernel_data.
+
+        A code_delta replaces code_dict and output_tags with just the cells
+        that changed, and lists the removed cells in deleted_cells; anything
+        else is a full sync.
+        """
+        delta = dfkernel_data.pop("code_delta", None)
+        if delta is None:
+            self.code_sync.reset(
+                dfkernel_data.setdefault("code_dict", {}),
+                dfkernel_data.get("output_tags") or {},
+                dfkernel_data.get("code_revision"),
+            )
+        else:
+            code_dict, output_tags, deleted = self.code_sync.apply_delta(delta)
+            dfkernel_data["code_dict"] = code_dict
+            dfkernel_data["output_tags"] = output_tags
+            dfkernel_data["deleted_cells"] = deleted
+            for cid in deleted:
+                self._conversion_cache.pop(cid, None)
+
     async def inner_execute_request(
         self, code, uuid, silent, store_history=True, user_expressions=None
+    ):
+        with self.profiler.profile("cell", cell=uuid):
+            return await self._inner_execute_request(
+                code, uuid, silent, store_history, user_expressions
+            )
+
+    async def _inner_execute_request(
+        self, code, uuid, silent, store_history=True, user_expressions=None
     ):
         stream = self._outer_stream
         ident = self._outer_ident
@@ -188,58 +560,53 @@ class IPythonKernel(ipykernel.ipkernel.IPythonKernel):
             # FIXME for debugging
             uuid = "1"
             execution_count = 1
-        dollar_converted = False
-        orig_code = code
-        parsed_code = ''
-        try:
-            code = convert_dollar(
-                code, self.shell.dataflow_state, uuid, identifier_replacer, input_tags
-            )
-            dollar_converted = True
-            parsed_code = code;
-            code = ground_refs(
-                code, self.shell.dataflow_state, uuid, identifier_replacer, input_tags, output_tags=self._output_tags
-            )
-            self._identifier_refs[uuid] = get_references(code)
-            self._persistent_code[uuid] = convert_identifier(code, dollar_replacer, input_tags={})
-
-            code = convert_identifier(code, dollar_replacer, input_tags=input_tags)
-            dollar_converted = False
-        except SyntaxError as e:
-            if dollar_converted:
-                code = orig_code
-                parsed_code = ''
-            pass
-        except TokenError as e:
-            # ignore this for now, catch it in do_execute
-            parsed_code = ''
-            pass
+        start_time = time.perf_counter()
+        with profiler.phase("convert"):
+            converted, cached = self.convert_cell(code, uuid, input_tags, display=not silent)
+        conversion_time = time.perf_counter() - start_time
+        if self.metrics is not None:
+            self.metrics.inc("executions")
+            self.metrics.observe("conversion_seconds", conversion_time)
+        if converted.identifier_refs is not None:
+            self._identifier_refs[uuid] = converted.identifier_refs
+            self._persistent_code[uuid] = converted.persistent_code
 
         #print("FIRST CODE:", code)
         if not silent:
-            if len(parsed_code) > 0:
-                display_code = ground_refs(parsed_code, self.shell.dataflow_state, uuid, identifier_replacer, input_tags, output_tags=self._output_tags, display_code=True)
-                display_code = convert_identifier(display_code, dollar_replacer, input_tags=input_tags)
-                self._publish_execute_input(display_code, parent, execution_count)
-            else:
-                self._publish_execute_input(code, parent, execution_count)
+            self._publish_execute_input(converted.display_code, parent, execution_count)
 
         # update the code_dict with the modified code
-        dfkernel_data["code_dict"][uuid] = code
+        dfkernel_data["code_dict"][uuid] = converted.code
         # convert all tilded code
-        try:
-            code = convert_dollar(
-                code, self.shell.dataflow_state, uuid, ref_replacer, input_tags
-            )
-        except SyntaxError as e:
-            # ignore this for now, catch it in do_execute
-            pass
-        except TokenError as e:
-            # ignore this for now, catch it in do_execute
-            pass
+        code = converted.ref_code
 
         # print("SECOND CODE:", code)
 
+        # bring stale upstream cells up to date before this cell runs so
+        # that its references do not recurse back into the kernel
+        failed = None
+        if store_history and not self.shell.uuid_stack:
+            with profiler.phase("upstream"):
+                failed = await self.refresh_upstream(uuid, dfkernel_data, silent)
+
+        # load unchanged upstream results kept from an earlier run
+        result_key = self.result_key(uuid, converted) if store_history else None
+        self._result_keys.pop(uuid, None)
+        loaded = False
+        if failed is not None:
+            # fail as the cell would have when its reference to the failed
+            # cell was evaluated
+            code = "get_ipython().kernel.raise_upstream_error({!r})".format(failed)
+            result_key = None
+        elif result_key is not None and uuid != self._requested_uuid:
+            try:
+                self._stored_results[uuid] = self.result_store.get(result_key)
+            except KeyError:
+                pass
+            else:
+                code = "get_ipython().kernel.pop_stored_result({!r})".format(uuid)
+                loaded = True
+
         cell_id = (parent.get("metadata") or {}).get("cellId")
         if _accepts_cell_id(self.do_execute):
             reply_content = self.do_execute(
@@ -269,6 +636,11 @@ class IPythonKernel(ipykernel.ipkernel.IPythonKernel):
         # need to unpack
         reply_content, res = reply_content
 
+        if result_key is not None and res.success:
+            value = self.shell.dataflow_history_manager.value_cache.get(uuid)
+            if loaded or self.result_store.put(result_key, value):
+                self._result_keys[uuid] = result_key
+
         # Flush output before sending the reply.
         sys.stdout.flush()
         sys.stderr.flush()
@@ -279,7 +651,11 @@ class IPythonKernel(ipykernel.ipkernel.IPythonKernel):
             time.sleep(self._execute_sleep)
 
         # Send the reply.
-        reply_content = json_clean(reply_content)
+        with profiler.phase("json_clean"):
+            reply_content = json_clean(reply_content)
+        metadata["conversion_time"] = conversion_time
+        metadata["conversion_cached"] = cached
+        metadata["profile"] = profiler.snapshot()
         metadata = self.finish_metadata(parent, metadata, reply_content)
 
         reply_msg = self.session.send(
@@ -298,6 +674,201 @@ class IPythonKernel(ipykernel.ipkernel.IPythonKernel):
 
         return res
 
+    def convert_cell(self, code, uuid, input_tags, display=True):
+        """Run the reference conversions on a cell's code.
+
+        Returns (ConvertedCell, cached). The result is reused while the code,
+        the input tags, and the links and output tags of every name in the
+        code are unchanged; those are only compared if the links or output
+        tags changed at all since the entry was last checked.
+        """
+        state = self.shell.dataflow_state
+        input_key = frozenset(input_tags.items())
+        versions = (state.version, self.code_sync.tags_version)
+        entry = self._conversion_cache.get(uuid)
+        if (entry is not None and entry.source == code
+                and entry.input_key == input_key
+                and (entry.versions == versions
+                     or entry.deps == self._conversion_deps(entry.names, uuid))):
+            entry.versions = versions
+            if display and entry.display_code is None:
+                entry.display_code = self._display_code(entry, uuid, input_tags)
+            return entry, True
+
+        entry = ConvertedCell(code, input_key)
+        entry.names = sorted(set(_name_re.findall(code)))
+        entry.deps = self._conversion_deps(entry.names, uuid)
+        entry.versions = versions
+        dollar_converted = False
+        try:
+            code = convert_dollar(
+                code, state, uuid, identifier_replacer, input_tags
+            )
+            dollar_converted = True
+            entry.parsed_code = code
+            code = ground_refs(
+                code, state, uuid, identifier_replacer, input_tags, output_tags=self._output_tags
+            )
+            entry.identifier_refs = get_references(code)
+            entry.persistent_code = convert_identifier(code, dollar_replacer, input_tags={})
+
+            code = convert_identifier(code, dollar_replacer, input_tags=input_tags)
+            dollar_converted = False
+        except SyntaxError as e:
+            if dollar_converted:
+                code = entry.source
+                entry.parsed_code = ''
+        except TokenError as e:
+            # ignore this for now, catch it in do_execute
+            entry.parsed_code = ''
+        entry.code = code
+
+        if display:
+            entry.display_code = self._display_code(entry, uuid, input_tags)
+
+        # convert all tilded code
+        try:
+            code = convert_dollar(
+                code, state, uuid, ref_replacer, input_tags
+            )
+        except SyntaxError as e:
+            # ignore this for now, catch it in do_execute
+            pass
+        except TokenError as e:
+            # ignore this for now, catch it in do_execute
+            pass
+        entry.ref_code = code
+
+        self._conversion_cache[uuid] = entry
+        return entry, False
+
+    def result_key(self, uuid, converted):
+        """The result_store key for running the converted code of uuid.
+
+        None if the store is disabled, the cell opted out, or a referenced
+        upstream cell has no stored result.
+        """
+        if (self.result_store is None or uuid in self._no_store
+                or converted.persistent_code is None):
+            return None
+        history = self.shell.dataflow_history_manager
+        parts = [uuid, converted.persistent_code]
+        for pid in sorted(converted.identifier_refs):
+            if pid == uuid:
+                continue
+            key = self._result_keys.get(pid)
+            if key is None or history.is_stale(pid):
+                return None
+            parts.append(key)
+        return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
+    def raise_upstream_error(self, uuid):
+        raise DataflowCellException(uuid)
+
+    def pop_stored_result(self, uuid):
+        """Return the loaded result of uuid, recording its dependencies as
+        running its code would have"""
+        history = self.shell.dataflow_history_manager
+        for pid, names in self._identifier_refs.get(uuid, {}).items():
+            if pid == uuid:
+                continue
+            history.update_dependencies(pid, uuid)
+            for name in names:
+                history.update_semantic_dependencies(pid, uuid, name)
+            history.remove_semantic_dependencies(pid, uuid)
+        return self._stored_results.pop(uuid)
+
+    def _conversion_deps(self, names, uuid):
+        state = self.shell.dataflow_state
+        return tuple(
+            (state.get_external_link(name, uuid)
+             if state.has_external_link(name, uuid) else None,
+             frozenset(self._output_tags.get(name, ())))
+            for name in names
+        )
+
+    def _display_code(self, entry, uuid, input_tags):
+        if len(entry.parsed_code) > 0:
+            display_code = ground_refs(entry.parsed_code, self.shell.dataflow_state, uuid, identifier_replacer, input_tags, output_tags=self._output_tags, display_code=True)
+            return convert_identifier(display_code, dollar_replacer, input_tags=input_tags)
+        return entry.code
+
+    async def refresh_upstream(self, uuid, dfkernel_data, silent=False):
+        """Execute the stale ancestors of uuid once each, in topological order.
+
+        Returns the id of the first cell that failed, or None.
+        """
+        history = self.shell.dataflow_history_manager
+        self.shell.update_dataflow_data(dfkernel_data)
+        refs = self._identifier_refs.get(uuid)
+        if refs is not None and uuid in history.code_changed:
+            # the parents it had when it last ran may no longer be used
+            parents = set(refs)
+        else:
+            parents = set(refs or ()).union(history.dep_parents.get(uuid, ()))
+        plan = history.stale_upstream(uuid, parents)
+        if self.parallel_upstream and len(plan) > 1:
+            return await self.refresh_upstream_parallel(plan, silent)
+        for cid in plan:
+            if not history.needs_refresh(cid):
+                # brought up to date by an early cutoff upstream
+                continue
+            if cid in self._upstream_tasks:
+                # already being run by another branch
+                res = await self._upstream_tasks[cid]
+            else:
+                if self.metrics is not None:
+                    self.metrics.inc("reexecutions")
+                res = await self.inner_execute_request(
+                    history.code_cache[cid], cid, silent, store_history=True
+                )
+            if res is not None and not res.success:
+                return cid
+        return None
+
+    async def refresh_upstream_parallel(self, plan, silent=False):
+        """Execute the cells of plan, each as soon as its planned parents finish.
+
+        Returns the id of the first cell that failed, or None.
+        """
+        history = self.shell.dataflow_history_manager
+        planned = set(plan)
+        waits_on = {cid: history.dep_parents[cid] & planned for cid in plan}
+
+        async def run_branch(cid):
+            for pid in waits_on[cid]:
+                res = await self._upstream_tasks[pid]
+                if res is not None and not res.success:
+                    return res
+            if not history.needs_refresh(cid):
+                return None
+            if self.metrics is not None:
+                self.metrics.inc("reexecutions")
+            self.shell.enter_branch()
+            return await self.inner_execute_request(
+                history.code_cache[cid], cid, silent, store_history=True
+            )
+
+        # do_execute forwards and restores input per cell, which does not
+        # nest when branches interleave
+        saved_input = builtins.input, getpass.getpass
+        try:
+            for cid in plan:
+                self._upstream_tasks[cid] = asyncio.ensure_future(run_branch(cid))
+            results = await asyncio.gather(
+                *(self._upstream_tasks[cid] for cid in plan)
+            )
+        finally:
+            builtins.input, getpass.getpass = saved_input
+            for cid in plan:
+                self._upstream_tasks.pop(cid, None)
+        # a branch whose parent failed returns the parent's result, and
+        # comes after it in plan
+        return next(
+            (cid for cid, res in zip(plan, results)
+             if res is not None and not res.success), None
+        )
+
     async def do_execute(
         self,
         code,
@@ -341,7 +912,8 @@ class IPythonKernel(ipykernel.ipkernel.IPythonKernel):
             # not just asyncio
             preprocessing_exc_tuple = None
             try:
-                transformed_cell = self.shell.transform_cell(code)
+                with profiler.phase("transform_cell"):
+                    transformed_cell = self.shell.transform_cell(code)
             except Exception:
                 transformed_cell = code
                 preprocessing_exc_tuple = sys.exc_info()
@@ -427,16 +999,13 @@ class IPythonKernel(ipykernel.ipkernel.IPythonKernel):
                 reply_content["executed_cell_uuid"] = uuid
                 reply_content["nodes"] = res.nodes
                 reply_content["links"] = res.links
-                reply_content["cells"] = res.cells
                 reply_content["identifier_refs"] = self._identifier_refs
                 reply_content["persistent_code"] = self._persistent_code
 
-                reply_content["upstream_deps"] = res.all_upstream_deps
-                reply_content["downstream_deps"] = res.all_downstream_deps
                 reply_content["imm_upstream_deps"] = res.imm_upstream_deps
                 reply_content["imm_downstream_deps"] = res.imm_downstream_deps
-                reply_content["update_downstreams"] = res.update_downstreams
                 reply_content["internal_nodes"] = res.internal_nodes
+                reply_content.update(self.graph_reply(uuid, res, dfkernel_data))
         else:
             reply_content["status"] = "error"
 
@@ -458,6 +1027,8 @@ class IPythonKernel(ipykernel.ipkernel.IPythonKernel):
 
         # Return the execution counter so clients can display prompts
         reply_content["execution_count"] = int(uuid, 16)
+        # lets the frontend send deltas against this revision
+        reply_content["code_revision"] = self.code_sync.revision
         # reply_content['execution_count'] = shell.execution_count - 1
 
         if "traceback" in reply_content:
@@ -486,7 +1057,14 @@ class IPythonKernel(ipykernel.ipkernel.IPythonKernel):
 
         return reply_content, res
 
-    def update_code_cells(self, dfmetadata, update_latest_executed_code=False):	
+    def update_code_cells(self, dfmetadata, update_latest_executed_code=False):
+        """Convert the references in the cells of dfmetadata for display.
+
+        Only cells whose code or refs changed since the last call, or that
+        mention a name whose links or output tags changed, are converted
+        again. Returns the (code_dict, executed_code_dict) of changed cells.
+        """
+        input_tags = dfmetadata.get("input_tags", {})
         curr_output_tags = defaultdict(set)
         updated_code_dict = {}
         updated_executed_code_dict = {}
@@ -494,19 +1072,34 @@ class IPythonKernel(ipykernel.ipkernel.IPythonKernel):
         for id, tags in dfmetadata['output_tags'].items():
             for tag in tags:
                 curr_output_tags[tag].add(id)
-    
+
+        changed_names = self.shell.dataflow_state.pop_changed_links()
+        if dfmetadata['all_refs']:
+            # rounds that only update the input tags send no output tags
+            changed_names.update(
+                tag for tag in set(curr_output_tags).union(self._comm_output_tags)
+                if curr_output_tags.get(tag) != self._comm_output_tags.get(tag))
+            self._comm_output_tags = dict(curr_output_tags)
+        if input_tags != self._comm_input_tags:
+            self._comm_input_tags = dict(input_tags)
+            self._comm_cells.clear()
+        elif changed_names:
+            for uuid, entry in list(self._comm_cells.items()):
+                if not changed_names.isdisjoint(entry.names):
+                    del self._comm_cells[uuid]
+
         def convert_code(code, uuid, refs):
             try:
                 tag_refs = { value: key for key, value in refs['tag_refs'].items() }
                 code = convert_dollar(
-                    code, self.shell.dataflow_state, uuid, identifier_replacer, dfmetadata.get("input_tags", {}), reversion=True, tag_refs=tag_refs
+                    code, self.shell.dataflow_state, uuid, identifier_replacer, input_tags, reversion=True, tag_refs=tag_refs
                 )
 
                 code = ground_refs(
-                    code, self.shell.dataflow_state, uuid, identifier_replacer, dfmetadata.get("input_tags", {}), output_tags=dict(curr_output_tags), cell_refs=dict(code_refs), reversion=True
+                    code, self.shell.dataflow_state, uuid, identifier_replacer, input_tags, output_tags=dict(curr_output_tags), cell_refs=dict(code_refs), reversion=True
                 )
 
-                code = convert_identifier(code, dollar_replacer, input_tags=dfmetadata.get("input_tags", {}))
+                code = convert_identifier(code, dollar_replacer, input_tags=input_tags)
                 return code
             except Exception as e:
                 self.log.error(f'Error in conversion for cell: {uuid}')
@@ -515,20 +1108,31 @@ class IPythonKernel(ipykernel.ipkernel.IPythonKernel):
 
 
         for uuid, refs in dfmetadata['all_refs'].items():
+            code = dfmetadata['code_dict'].get(uuid)
+            if not code:
+                continue
+            executed_code = dfmetadata['executed_code'].get(uuid) if update_latest_executed_code else None
+            entry = self._comm_cells.get(uuid)
+            if (entry is not None and entry.code == code and entry.refs == refs
+                    and entry.executed_code == executed_code):
+                continue
+
             code_refs = defaultdict(set)
             for ref_id, ref_tags in refs['ref'].items():
                 for tag in ref_tags:
                     code_refs[tag].add(ref_id)
-            
-            if dfmetadata['code_dict'].get(uuid):
-                code = convert_code(dfmetadata['code_dict'][uuid], uuid, refs)
-                if code is not None and code != dfmetadata['code_dict'][uuid]:
-                    updated_code_dict[uuid] = code
-
-                if update_latest_executed_code and dfmetadata['executed_code'].get(uuid):
-                    code = convert_code(dfmetadata['executed_code'][uuid],  uuid, refs)
-                    if code is not None and code != dfmetadata['executed_code'][uuid]:
-                        updated_executed_code_dict[uuid] = code
+
+            new_code = convert_code(code, uuid, refs)
+            if new_code is not None and new_code != code:
+                updated_code_dict[uuid] = code = new_code
+
+            if executed_code:
+                new_code = convert_code(executed_code,  uuid, refs)
+                if new_code is not None and new_code != executed_code:
+                    updated_executed_code_dict[uuid] = executed_code = new_code
+
+            # remember the code the frontend will have after this reply
+            self._comm_cells[uuid] = CommCell(code, executed_code, refs)
 
         return updated_code_dict, updated_executed_code_dict
 
@@ -9,10 +9,11 @@ import sys
 
 from IPython.core.profiledir import ProfileDir
 from traitlets import (
-    DottedObjectName, Type
+    DottedObjectName, Integer, Type, Unicode
 )
 from .ipkernel import IPythonKernel
 from jupyter_client.session import Session
+from .metrics import Metrics, MeteredSession, start_exporter
 from .zmqshell import ZMQInteractiveShell
 
 #-----------------------------------------------------------------------------
@@ -43,8 +44,48 @@ class IPKernelApp(ipykernel.kernelapp.IPKernelApp):
     displayhook_class = DottedObjectName('dfnotebook.kernel.displayhook.ZMQDisplayHook',
         help="The importstring for the DisplayHook factory").tag(config=True)
 
+    metrics_port = Integer(0,
+        help="""Port to serve Prometheus metrics on (at /metrics); 0 disables
+        metrics, which then cost nothing during execution."""
+    ).tag(config=True)
+
+    metrics_ip = Unicode('127.0.0.1',
+        help="""Address the metrics exporter listens on."""
+    ).tag(config=True)
+
+    metrics = None
+
+    def _session_default(self):
+        if not self.metrics_port:
+            return super(IPKernelApp, self)._session_default()
+        self.metrics = Metrics()
+        session = MeteredSession(parent=self)
+        session.metrics = self.metrics
+        return session
+
+    def init_metrics(self):
+        """Hook the kernel up to the metrics and start the exporter"""
+        metrics = self.metrics
+        history = self.kernel.shell.dataflow_history_manager
+        self.kernel.metrics = metrics
+        history.metrics = metrics
+        metrics.add_gauge("graph_nodes", lambda: len(history.code_cache),
+                          "Cells known to the kernel")
+        metrics.add_gauge("graph_edges",
+                          lambda: sum(map(len, list(history.dep_children.values()))),
+                          "Dependencies between cells")
+        metrics.add_gauge("value_cache_bytes", lambda: history.cache_size,
+                          "Estimated size of the value cache (with a cache limit)")
+        metrics.add_gauge("value_cache_entries", lambda: len(history.value_cache),
+                          "Cell results held in memory")
+        self.metrics_server = start_exporter(metrics, self.metrics_port, self.metrics_ip)
+        self.log.info("Serving dataflow metrics at http://%s:%i/metrics",
+                      self.metrics_ip, self.metrics_server.server_port)
+
     def init_kernel(self):
         super(IPKernelApp, self).init_kernel()
+        if self.metrics is not None:
+            self.init_metrics()
 
         # self.display_pub.get_execution_count = lambda: kernel.execution_count
         get_execution_count = lambda: int(self.kernel.execution_count, 16) if self.kernel.execution_count else None
@@ -0,0 +1,156 @@
+"""Prometheus-style metrics for the dataflow kernel
+
+Counters and histograms are plain ints and lists updated without locks; the
+exporter thread copies them when scraped, so a scrape may be a few updates
+behind (and an IOPub count racing the output thread may be lost) but never
+blocks execution. Gauges are callables evaluated at scrape time.
+"""
+
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+
+from jupyter_client.session import Session
+
+_SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+_TIME_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+_BYTE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # one count per bucket plus +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Metrics(object):
+    """The kernel's counters, histograms, and gauges"""
+
+    def __init__(self):
+        self.counters = {
+            "executions": 0,
+            "reexecutions": 0,
+            "value_cache_hits": 0,
+            "value_cache_misses": 0,
+            "early_cutoff_cells": 0,
+        }
+        self.histograms = {
+            "stale_propagation_cells": Histogram(_SIZE_BUCKETS),
+            "conversion_seconds": Histogram(_TIME_BUCKETS),
+            "reply_bytes": Histogram(_BYTE_BUCKETS),
+        }
+        # msg_type -> count, for messages sent on IOPub
+        self.iopub_messages = {}
+        self.gauges = {}
+        self.help = {
+            "executions": "Cell executions, including upstream cells",
+            "reexecutions": "Stale upstream cells executed to bring a "
+                            "referencing cell up to date",
+            "value_cache_hits": "References served from the value cache",
+            "value_cache_misses": "References that were stale or evicted",
+            "early_cutoff_cells": "Stale cells left as they were because an "
+                                  "upstream result did not change",
+            "stale_propagation_cells": "Cells marked stale by one code change",
+            "conversion_seconds": "Time converting a cell's references",
+            "reply_bytes": "Size of serialized execute replies",
+            "iopub_messages": "Messages sent on IOPub",
+        }
+
+    def inc(self, name, n=1):
+        self.counters[name] += n
+
+    def observe(self, name, value):
+        self.histograms[name].observe(value)
+
+    def add_gauge(self, name, func, help=""):
+        self.gauges[name] = func
+        self.help[name] = help
+
+    def count_message(self, msg_type, nbytes):
+        if msg_type == "execute_reply":
+            self.observe("reply_bytes", nbytes)
+        elif not msg_type.endswith("_reply") and msg_type != "input_request":
+            self.iopub_messages[msg_type] = self.iopub_messages.get(msg_type, 0) + 1
+
+    def render(self, prefix="dfkernel_"):
+        """The metrics in the Prometheus text exposition format"""
+        lines = []
+
+        def header(name, kind, full_name):
+            if name in self.help:
+                lines.append("# HELP {} {}".format(full_name, self.help[name]))
+            lines.append("# TYPE {} {}".format(full_name, kind))
+
+        for name, value in dict(self.counters).items():
+            full_name = prefix + name + "_total"
+            header(name, "counter", full_name)
+            lines.append("{} {}".format(full_name, value))
+        full_name = prefix + "iopub_messages_total"
+        header("iopub_messages", "counter", full_name)
+        for msg_type, value in sorted(dict(self.iopub_messages).items()):
+            lines.append('{}{{msg_type="{}"}} {}'.format(full_name, msg_type, value))
+        for name, hist in self.histograms.items():
+            full_name = prefix + name
+            header(name, "histogram", full_name)
+            counts = list(hist.counts)
+            total = 0
+            for bound, count in zip(hist.buckets + ("+Inf",), counts):
+                total += count
+                lines.append('{}_bucket{{le="{}"}} {}'.format(full_name, bound, total))
+            lines.append("{}_sum {}".format(full_name, hist.sum))
+            lines.append("{}_count {}".format(full_name, total))
+        for name, func in list(self.gauges.items()):
+            try:
+                value = func()
+            except Exception:
+                continue
+            full_name = prefix + name
+            header(name, "gauge", full_name)
+            lines.append("{} {}".format(full_name, value))
+        return "\n".join(lines) + "\n"
+
+
+class MeteredSession(Session):
+    """A Session that counts the messages it serializes"""
+
+    metrics = None
+
+    def serialize(self, msg, ident=None):
+        to_send = super().serialize(msg, ident)
+        if self.metrics is not None:
+            self.metrics.count_message(msg["header"]["msg_type"],
+                                       sum(len(part) for part in to_send))
+        return to_send
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_exporter(metrics, port, ip="127.0.0.1"):
+    """Serve metrics over HTTP from a daemon thread; returns the server"""
+    server = ThreadingHTTPServer((ip, port), _MetricsHandler)
+    server.daemon_threads = True
+    server.metrics = metrics
+    thread = threading.Thread(target=server.serve_forever, name="dfkernel-metrics",
+                              daemon=True)
+    thread.start()
+    return server
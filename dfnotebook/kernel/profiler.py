@@ -0,0 +1,104 @@
+"""Timing trees for cell executions
+
+Each executed cell gets a tree of the phases it went through (reference
+conversion, upstream refreshes, transforms, user code, formatting, ...),
+with the cells it executed recursively nested where they ran. The current
+node is kept in a context variable so that cells running concurrently in
+their own branches build separate subtrees.
+"""
+
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+_current = ContextVar("dfprofile_node", default=None)
+
+
+def _start(name, info, parent):
+    # time stays None while the node is running
+    node = {"name": name, "time": None, "children": [], "_start": time.perf_counter()}
+    node.update(info)
+    if parent is not None:
+        parent["children"].append(node)
+    return node
+
+
+def _stop(node):
+    node["time"] = time.perf_counter() - node["_start"]
+
+
+@contextmanager
+def phase(name, **info):
+    """Time a phase of the cell being profiled; does nothing outside one"""
+    parent = _current.get()
+    if parent is None:
+        yield None
+        return
+    node = _start(name, info, parent)
+    token = _current.set(node)
+    try:
+        yield node
+    finally:
+        _stop(node)
+        _current.reset(token)
+
+
+def record(name, seconds, **info):
+    """Add a phase that was timed by the caller"""
+    parent = _current.get()
+    if parent is not None:
+        node = _start(name, info, parent)
+        node["time"] = seconds
+
+
+def _copy(node):
+    tree = {k: v for k, v in node.items() if k not in ("_start", "children")}
+    if tree["time"] is None:
+        tree["time"] = time.perf_counter() - node["_start"]
+    if node["children"]:
+        tree["children"] = [_copy(child) for child in node["children"]]
+    return tree
+
+
+def snapshot():
+    """A copy of the tree of the innermost running cell, or None"""
+    node = _current.get()
+    return _copy(node) if node is not None else None
+
+
+class Profiler(object):
+    """Profiles cell executions and keeps the most recent trees"""
+
+    def __init__(self, history=20):
+        self.trees = deque(maxlen=history)
+
+    @contextmanager
+    def profile(self, name, **info):
+        """Time a cell execution, nested in the running one if there is one"""
+        parent = _current.get()
+        node = _start(name, info, parent)
+        token = _current.set(node)
+        try:
+            yield node
+        finally:
+            _stop(node)
+            _current.reset(token)
+            if parent is None:
+                self.trees.append(_copy(node))
+
+    def last(self, n=None):
+        trees = list(self.trees)
+        return trees if n is None else trees[-n:]
+
+
+def format_tree(tree, depth=0):
+    label = tree["name"]
+    if tree.get("cell"):
+        label += " " + tree["cell"]
+    lines = ["{}{:<{}} {:10.3f} ms".format("  " * depth, label,
+                                           max(32 - 2 * depth, 1),
+                                           tree["time"] * 1000)]
+    for child in tree.get("children", ()):
+        lines.append(format_tree(child, depth + 1))
+    return "\n".join(lines)
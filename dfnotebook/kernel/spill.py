@@ -0,0 +1,225 @@
+"""On-disk stores for cell outputs
+
+Values are written with pickle protocol 5, with out-of-band buffers (e.g.
+NumPy arrays and the blocks of pandas frames) written straight from memory
+after the pickle stream. Loading memory-maps the file copy-on-write so those
+buffers are read back without copying.
+
+SpillStore holds values evicted from the in-memory cache for the life of the
+kernel; ResultStore keeps results across restarts, keyed by content.
+"""
+
+import atexit
+import mmap
+import os
+import pickle
+import shutil
+import struct
+import tempfile
+
+_MAGIC = b"DFSP"
+# magic, number of buffers, pickle length
+_HEADER = struct.Struct("<4sIQ")
+_LENGTH = struct.Struct("<Q")
+_ALIGN = 64
+
+
+def _padding(offset):
+    return -offset % _ALIGN
+
+
+def dump(value, path):
+    """Write value to path, returning False if it cannot be pickled"""
+    buffers = []
+    try:
+        data = pickle.dumps(value, protocol=5, buffer_callback=buffers.append)
+        raws = [buf.raw() for buf in buffers]
+    except Exception:
+        return False
+    try:
+        with open(path, "wb") as f:
+            f.write(_HEADER.pack(_MAGIC, len(raws), len(data)))
+            for raw in raws:
+                f.write(_LENGTH.pack(raw.nbytes))
+            offset = _HEADER.size + _LENGTH.size * len(raws)
+            f.write(data)
+            offset += len(data)
+            for raw in raws:
+                f.write(b"\0" * _padding(offset))
+                offset += _padding(offset)
+                f.write(raw)
+                offset += raw.nbytes
+    except OSError:
+        _remove(path)
+        return False
+    return True
+
+
+def load(path):
+    """Read a value written by dump, memory-mapping its buffers"""
+    with open(path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    view = memoryview(mm)
+    magic, nbufs, data_len = _HEADER.unpack_from(view)
+    if magic != _MAGIC:
+        raise ValueError("Not a dataflow result file: '{}'".format(path))
+    offset = _HEADER.size
+    lengths = []
+    for _ in range(nbufs):
+        lengths.append(_LENGTH.unpack_from(view, offset)[0])
+        offset += _LENGTH.size
+    data = view[offset:offset + data_len]
+    offset += data_len
+    buffers = []
+    for length in lengths:
+        offset += _padding(offset)
+        buffers.append(view[offset:offset + length])
+        offset += length
+    return pickle.loads(data, buffers=buffers)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class SpillStore(object):
+    """A directory of spilled values, removed when the kernel exits"""
+
+    def __init__(self, parent_dir=None):
+        if parent_dir:
+            os.makedirs(parent_dir, exist_ok=True)
+        self.path = tempfile.mkdtemp(prefix="dfkernel-spill-", dir=parent_dir or None)
+        self.keys = set()
+        self.hits = 0
+        self.misses = 0
+        atexit.register(self.close)
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def _file(self, key):
+        return os.path.join(self.path, key + ".pkl")
+
+    def put(self, key, value):
+        """Write value to disk, returning False if it cannot be pickled"""
+        if not dump(value, self._file(key)):
+            return False
+        self.keys.add(key)
+        return True
+
+    def get(self, key):
+        """Load and remove the value for key; raises KeyError if it was not
+        spilled or cannot be read back"""
+        if key in self.keys:
+            try:
+                value = load(self._file(key))
+            except Exception:
+                pass
+            else:
+                self.hits += 1
+                return value
+            finally:
+                # the mapping outlives the file
+                self.discard(key)
+        self.misses += 1
+        raise KeyError(key)
+
+    def discard(self, key):
+        self.keys.discard(key)
+        _remove(self._file(key))
+
+    def stats(self):
+        return {"spilled": len(self.keys), "hits": self.hits, "misses": self.misses}
+
+    def close(self):
+        self.keys.clear()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+class ResultStore(object):
+    """A content-addressed directory of results that survives restarts.
+
+    Files are named by key and their modification time records the last
+    use, so the least recently used are removed once the directory grows
+    past size_limit bytes.
+    """
+
+    def __init__(self, path, size_limit=0):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.size_limit = size_limit
+        self.hits = 0
+        self.misses = 0
+        # key -> size in bytes
+        self.sizes = {}
+        for name in os.listdir(path):
+            if name.endswith(".pkl"):
+                try:
+                    self.sizes[name[:-4]] = os.path.getsize(os.path.join(path, name))
+                except OSError:
+                    pass
+        self.size = sum(self.sizes.values())
+
+    def __contains__(self, key):
+        return key in self.sizes
+
+    def _file(self, key):
+        return os.path.join(self.path, key + ".pkl")
+
+    def put(self, key, value):
+        """Store value under key, returning False if it cannot be pickled"""
+        if key in self.sizes:
+            return True
+        # write then rename so that other kernels never read a partial file
+        tmp_path = self._file(key) + ".tmp"
+        if not dump(value, tmp_path):
+            return False
+        try:
+            os.replace(tmp_path, self._file(key))
+            self.sizes[key] = os.path.getsize(self._file(key))
+        except OSError:
+            _remove(tmp_path)
+            return False
+        self.size += self.sizes[key]
+        self.collect(keep=(key,))
+        return True
+
+    def get(self, key):
+        """Load the value for key; raises KeyError if it is not stored"""
+        if key in self.sizes:
+            try:
+                value = load(self._file(key))
+                os.utime(self._file(key))
+            except Exception:
+                self.discard(key)
+            else:
+                self.hits += 1
+                return value
+        self.misses += 1
+        raise KeyError(key)
+
+    def discard(self, key):
+        self.size -= self.sizes.pop(key, 0)
+        _remove(self._file(key))
+
+    def collect(self, keep=()):
+        """Remove the least recently used results until under size_limit"""
+        if not self.size_limit or self.size <= self.size_limit:
+            return
+        def last_used(key):
+            try:
+                return os.path.getmtime(self._file(key))
+            except OSError:
+                return 0
+        for key in sorted(self.sizes, key=last_used):
+            if self.size <= self.size_limit:
+                break
+            if key not in keep:
+                self.discard(key)
+
+    def stats(self):
+        return {"stored": len(self.sizes), "size": self.size,
+                "hits": self.hits, "misses": self.misses}
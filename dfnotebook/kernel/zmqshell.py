@@ -13,6 +13,7 @@ from functools import partial
 import inspect
 import nest_asyncio
 import sys
+import time
 import types
 from IPython.core import magic_arguments
 from IPython.core.interactiveshell import InteractiveShellABC, \
@@ -21,18 +22,23 @@ try:
     from IPython.core.interactiveshell import _asyncio_runner
 except ImportError:
     _asyncio_runner = None
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
 from IPython.core.interactiveshell import ExecutionResult, ExecutionInfo
 from IPython.core.compilerop import CachingCompiler
 from IPython.core.magic import magics_class, Magics, cell_magic, line_magic, \
     needs_local_scope
 from IPython.core.history import HistoryManager
-from IPython.core.error import InputRejected
+from IPython.core.error import InputRejected, UsageError
 from ipykernel.jsonutil import json_clean, encode_images
 from dfnotebook.kernel.dflink import LinkedResult
 from dfnotebook.kernel.displayhook import ZMQShellDisplayHook
 from dfnotebook.kernel.safe_attr import safe_attr
 from traitlets import (
-    Integer, Instance, Type, Unicode, validate
+    Bool, Integer, Instance, Type, Unicode, observe, validate
 )
 from warnings import warn
 from typing import List as ListType, Tuple, Iterable, Optional
@@ -42,8 +48,13 @@ from ast import AST
 import importlib
 
 from .dataflow import DataflowHistoryManager, DataflowFunctionManager, \
-    DataflowNamespace, DataflowCellException, DataflowState, DuplicateNameError
+    DataflowNamespace, DataflowCellException, DataflowState, DuplicateNameError, \
+    branch_local, start_branch, estimate_size
+from .checkpoint import DEFAULT_PATH as DEFAULT_CHECKPOINT, \
+    format_report as format_checkpoint_report
 from .dflink import build_linked_result
+from . import profiler
+from .spill import SpillStore
 
 # Python 3.10 removed the alias from collections
 from collections.abc import Mapping
@@ -52,6 +63,14 @@ from collections.abc import Mapping
 # Functions and classes
 #-----------------------------------------------------------------------------
 
+def peak_memory():
+    """Peak resident memory of the process in bytes, or None if unknown"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes everywhere but macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
 class ZMQDisplayPublisher(ipykernel.zmqshell.ZMQDisplayPublisher):
     """A display publisher that publishes data using a ZeroMQ PUB socket."""
 
@@ -211,6 +230,66 @@ class OutputMagics(Magics):
         """
         return self.display(line, local_ns)
 
+@magics_class
+class DataflowMagics(Magics):
+    @magic_arguments.magic_arguments()
+    @magic_arguments.argument('path', nargs='?', default=DEFAULT_CHECKPOINT,
+        help="""Checkpoint file"""
+    )
+    @line_magic
+    def dfcheckpoint(self, line):
+        """Save the cells' code, outputs, links, and namespace to a file.
+        Values that cannot be pickled are skipped and listed."""
+        args = magic_arguments.parse_argstring(self.dfcheckpoint, line)
+        report = self.shell.kernel.save_checkpoint(args.path)
+        print(format_checkpoint_report(report, "Saved"))
+
+    @magic_arguments.magic_arguments()
+    @magic_arguments.argument('path', nargs='?', default=DEFAULT_CHECKPOINT,
+        help="""Checkpoint file"""
+    )
+    @line_magic
+    def dfrestore(self, line):
+        """Restore the state saved by %dfcheckpoint. Outputs that were
+        not saved are recomputed when next referenced."""
+        args = magic_arguments.parse_argstring(self.dfrestore, line)
+        report = self.shell.kernel.restore_checkpoint(args.path)
+        print(format_checkpoint_report(report, "Restored"))
+
+    @magic_arguments.magic_arguments()
+    @magic_arguments.argument('-n', type=int, default=1,
+        help="""Number of recent cell executions to show"""
+    )
+    @line_magic
+    def dfprofile(self, line):
+        """Show where the time of the last cell executions went, with the
+        upstream cells they executed nested under them."""
+        args = magic_arguments.parse_argstring(self.dfprofile, line)
+        for tree in self.shell.kernel.profiler.last(max(args.n, 1)):
+            print(profiler.format_tree(tree))
+
+    @magic_arguments.magic_arguments()
+    @magic_arguments.argument('names', nargs='+',
+        help="""Output tags, name$cell references, or cell ids"""
+    )
+    @line_magic
+    def dfmake(self, line):
+        """Recompute the cells that define the given names, running only
+        the stale ones and the stale cells they depend on."""
+        args = magic_arguments.parse_argstring(self.dfmake, line)
+        try:
+            report = self.shell.kernel.make(args.names)
+        except LookupError as e:
+            raise UsageError(str(e))
+        print("Ran {} cell{} in {:.3f}s{}".format(
+            len(report["ran"]), "" if len(report["ran"]) == 1 else "s",
+            report["seconds"],
+            ": " + ", ".join(report["ran"]) if report["ran"] else ""))
+        if report["fresh"]:
+            print("Up to date:", ", ".join(report["fresh"]))
+        if report["failed"] is not None:
+            print("Cell {} failed".format(report["failed"]))
+
 # TODO move to its own package
 def expr2id(node):
     """Convert ast node to valid python identifier.
@@ -282,11 +361,54 @@ class ZMQInteractiveShell(ipykernel.zmqshell.ZMQInteractiveShell):
     displayhook_class = Type(ZMQShellDisplayHook)
     display_pub_class = Type(ZMQDisplayPublisher)
 
-    execution_count = Integer(0)
+    execution_count = branch_local(0)
     # UUID passed from notebook interface
-    uuid = Unicode(allow_none=True)
+    _uuid = branch_local()
+    # stacks to deal with recursion, per branch when run concurrently
+    uuid_stack = branch_local()
+    result_stack = branch_local()
+    execution_count_stack = branch_local()
+    _last_traceback = branch_local()
+    # wall and CPU time of the cells run from inside the running one
+    _nested_run_times = branch_local((0.0, 0.0))
     dataflow_history_manager = Instance(DataflowHistoryManager)
     dataflow_function_manager = Instance(DataflowFunctionManager)
+    dataflow_cache_limit = Integer(0,
+        help="""Memory budget in bytes for cached cell outputs (0 for no limit).
+
+        When the estimated size of the outputs exceeds this, outputs that are
+        cheap to recompute relative to their size and not recently used are
+        evicted and recomputed when next referenced. Cells marked as force
+        cached are never evicted.""",
+    ).tag(config=True)
+
+    dataflow_spill_dir = Unicode('',
+        help="""Directory to spill evicted cell outputs to, instead of
+        recomputing them. Outputs that cannot be pickled are still
+        recomputed. Empty (the default) disables spilling.""",
+    ).tag(config=True)
+
+    dataflow_run_history = Integer(10,
+        help="""Number of recent runs of each cell whose wall and CPU time,
+        peak memory growth, and output size are kept, see
+        Out.run_history and Out.run_summary.""",
+    ).tag(config=True)
+
+    dataflow_early_cutoff = Bool(False,
+        help="""Leave downstream cells up to date when a re-run cell produces
+        the same value as before, judged by a fingerprint of the value
+        (a hash of the data of arrays and frames, or the value itself for
+        numbers and strings). Values that cannot be fingerprinted always
+        count as changed.""",
+    ).tag(config=True)
+
+    @observe('dataflow_cache_limit')
+    def _dataflow_cache_limit_changed(self, change):
+        # config is loaded before init_history creates the manager
+        history = self._trait_values.get('dataflow_history_manager')
+        if history is not None:
+            history.cache_limit = change['new']
+            history.cull_cache()
 
     def __init__(self, *args, **kwargs):
         if 'user_ns' not in kwargs or kwargs['user_ns'] is None:
@@ -299,6 +421,11 @@ class ZMQInteractiveShell(ipykernel.zmqshell.ZMQInteractiveShell):
         self.result_stack = [] # [None]
         self.execution_count_stack = []
         self.input_tags = {}
+        # send the outputs of a LinkedResult in one execute_result message
+        self.batch_outputs = False
+        # send only text/plain and list the other mimetypes, see render_format
+        self.lazy_formats = False
+        # shared by all branches so that counts handed out stay increasing
         self.max_execution_count = 0
 
         #FIXME: This is really just a simple fix to turn it on with Kernel boot, but this seems like a bandaid fix
@@ -313,7 +440,6 @@ class ZMQInteractiveShell(ipykernel.zmqshell.ZMQInteractiveShell):
                       text=None,
                       full_text=None) -> Tuple[
             str, ListType[str], ListType[str], Iterable[_FakeJediCompletion]]:
-            print("RUNNING NEW COMPLETE", file=sys.__stdout__)
             if cursor_pos is None:
                 cursor_pos = len(line_buffer) if text is None else len(text)
 
@@ -329,14 +455,11 @@ class ZMQInteractiveShell(ipykernel.zmqshell.ZMQInteractiveShell):
             use_jedi = self.use_jedi
             if '$' in text:
                 # only deal with our matchers
-                print("ONLY OUR MATCHERS!", file=sys.__stdout__)
                 def get_matchers(self):
                     return [*self.custom_matchers]
                 self.__class__._old_matchers = self.__class__.matchers
                 self.__class__.matchers = property(get_matchers)
                 self.use_jedi = False
-            else:
-                print("NO STAR", file=sys.__stdout__)
             try:
                 return self._old_complete(cursor_line=cursor_line, cursor_pos=cursor_pos,
                                                     line_buffer=line_buffer, text=text,
@@ -351,10 +474,7 @@ class ZMQInteractiveShell(ipykernel.zmqshell.ZMQInteractiveShell):
         # print("DELIMS:", self.Completer.splitter.delims, file=sys.__stdout__)
         #
         def cell_scope_completer(completer, text):
-            print("GOT COMPLETION REQUEST:", completer, text,
-                  file=sys.__stdout__)
-            results = self.dataflow_state.complete(text, self.input_tags)
-            return results
+            return self.dataflow_state.complete(text, self.input_tags)
         self.set_custom_completer(cell_scope_completer)
 
 
@@ -425,16 +545,33 @@ class ZMQInteractiveShell(ipykernel.zmqshell.ZMQInteractiveShell):
         super(ZMQInteractiveShell, self).init_magics()
         #self.register_magics(FunctionMagics)
         self.register_magics(OutputMagics)
+        self.register_magics(DataflowMagics)
+
+    @property
+    def uuid(self):
+        return self._uuid
 
-    # FIXME hack to be notified of change before it happens?
-    @validate('uuid')
-    def _uuid_to_change(self, proposal):
-        # print("UUID TO CHANGE TO", proposal['value'], file=sys.__stdout__)
+    @uuid.setter
+    def uuid(self, value):
+        # flush so pending output is attributed to the cell that wrote it
+        # print("UUID TO CHANGE TO", value, file=sys.__stdout__)
         if hasattr(sys.stdout, 'get_execution_count'):
             sys.stdout.flush()
         if hasattr(sys.stderr, 'get_execution_count'):
             sys.stderr.flush()
-        return proposal['value']
+        self._uuid = value
+
+    def enter_branch(self):
+        # called at the start of an asyncio task that runs cells concurrently
+        # with other tasks; the task gets its own uuid, execution count,
+        # stacks and traceback so that outputs and dependencies are recorded
+        # for the right cell
+        start_branch()
+        self.uuid_stack = []
+        self.result_stack = []
+        self.execution_count_stack = []
+        self._nested_run_times = (0.0, 0.0)
+        self.dataflow_history_manager.storeditems = []
 
     def push_uuid(self):
         # want self.uuid to be the current uuid at any time (stashing uuid there)
@@ -478,6 +615,17 @@ class ZMQInteractiveShell(ipykernel.zmqshell.ZMQInteractiveShell):
     # after recursive call, need to increment execution_count so don't step
     # need to reset self.execution_count to store history correctly
 
+    def update_dataflow_data(self, dfkernel_data):
+        code_dict = dfkernel_data.get("code_dict", {})
+        output_tags = dfkernel_data.get("output_tags", {})
+        auto_update_flags = dfkernel_data.get("auto_update_flags", [])
+        force_cached_flags = dfkernel_data.get("force_cached_flags", [])
+        self.dataflow_history_manager.update_codes(
+            code_dict, dfkernel_data.get("deleted_cells"))
+        self.dataflow_history_manager.update_auto_update(auto_update_flags)
+        self.dataflow_history_manager.update_force_cached(force_cached_flags)
+        self.dataflow_state.add_links(output_tags)
+
     def run_cell(self, raw_cell, uuid=None, dfkernel_data={},
                  store_history=False, silent=False, shell_futures=True, cell_id=None):
         # set partial on run_cell_async
@@ -500,9 +648,6 @@ class ZMQInteractiveShell(ipykernel.zmqshell.ZMQInteractiveShell):
                              cell_id=None) -> ExecutionResult:
 
         code_dict = dfkernel_data.get("code_dict", {})
-        output_tags = dfkernel_data.get("output_tags", {})
-        auto_update_flags = dfkernel_data.get("auto_update_flags", [])
-        force_cached_flags = dfkernel_data.get("force_cached_flags", [])
         # print("CODE_DICT:", code_dict)
         # print("ASYNC RUNNING CELL", uuid, raw_cell)
         # print("RUN_CELL USER_NS:", self.user_ns)
@@ -511,14 +656,11 @@ class ZMQInteractiveShell(ipykernel.zmqshell.ZMQInteractiveShell):
         old_deps = []
 
         if store_history:
-            self.dataflow_history_manager.update_codes(code_dict)
-            self.dataflow_history_manager.update_auto_update(auto_update_flags)
-            self.dataflow_history_manager.update_force_cached(force_cached_flags)
-            self.dataflow_state.add_links(output_tags)
+            self.update_dataflow_data(dfkernel_data)
             # also put the current cell into the cache and force recompute
             if uuid not in code_dict:
                 self.dataflow_history_manager.update_code(uuid, raw_cell)
-            if uuid in self.dataflow_history_manager.value_cache and uuid in self.dataflow_history_manager.dep_parents:
+            if self.dataflow_history_manager.has_value(uuid) and uuid in self.dataflow_history_manager.dep_parents:
                 old_deps = self.dataflow_history_manager.all_upstream(uuid)
                 for i in list(self.dataflow_history_manager.dep_parents[uuid]):
                     self.dataflow_history_manager.remove_dependencies(i,uuid)
@@ -554,6 +696,12 @@ class ZMQInteractiveShell(ipykernel.zmqshell.ZMQInteractiveShell):
         self.dataflow_state.set_cur_cell_id(self.uuid)
         self.push_result()
 
+        # cells run from this one through get_item record their own times
+        outer_nested = self._nested_run_times
+        self._nested_run_times = (0.0, 0.0)
+        start_time = time.perf_counter()
+        start_cpu = time.process_time()
+        start_peak = peak_memory()
         result = await super().run_cell_async(raw_cell,
                                               store_history=store_history,
                                               silent=silent,
@@ -562,6 +710,14 @@ class ZMQInteractiveShell(ipykernel.zmqshell.ZMQInteractiveShell):
                                               preprocessing_exc_tuple=preprocessing_exc_tuple,
                                               cell_id=cell_id
                                               )
+        wall_time = time.perf_counter() - start_time
+        cpu_time = time.process_time() - start_cpu
+        nested_wall, nested_cpu = self._nested_run_times
+        self._nested_run_times = (outer_nested[0] + wall_time,
+                                  outer_nested[1] + cpu_time)
+        compute_time = wall_time - nested_wall
+        cpu_time -= nested_cpu
+        peak_growth = None if start_peak is None else peak_memory() - start_peak
 
         self.pop_result()
         uuid = self.uuid
@@ -598,14 +754,18 @@ class ZMQInteractiveShell(ipykernel.zmqshell.ZMQInteractiveShell):
             if store_history:
                 # print("STORING HISTORY", cur_execution_count)
                 # print("STORING UPDATE VALUE:", uuid, result)
-                self.dataflow_history_manager.update_value(uuid, result.result)
+                self.dataflow_history_manager.update_value(uuid, result.result,
+                                                           compute_time)
                 self.dataflow_history_manager.set_not_stale(uuid)
+                output_size = self.dataflow_history_manager.value_sizes.get(uuid)
+                if output_size is None:
+                    output_size = estimate_size(result.result)
+                self.dataflow_history_manager.record_run(
+                    uuid, compute_time, cpu_time, peak_growth, output_size, True)
 
             if store_history:
-                cells = []
+                cells = list(self.dataflow_history_manager.sorted_keys())
                 nodes = []
-                for uid in self.dataflow_history_manager.sorted_keys():
-                    cells.append(uid)
                 if uuid in self.dataflow_history_manager.value_cache:
                     if(self.dataflow_history_manager.value_cache[uuid] is not None):
                         nodes.append('Out_'+uuid+'')
@@ -623,13 +783,18 @@ class ZMQInteractiveShell(ipykernel.zmqshell.ZMQInteractiveShell):
                 result.imm_upstream_deps = self.dataflow_history_manager.get_semantic_upstream(uuid)
                 result.all_upstream_deps = self.dataflow_history_manager.all_upstream(uuid)
                 result.update_downstreams = []
-                for i in set(self.dataflow_history_manager.all_upstream(uuid)+old_deps):
+                for i in set(result.all_upstream_deps+old_deps):
                     result.update_downstreams.append({'key':i, 'data':self.dataflow_history_manager.get_downstream(i)})
                 result.imm_downstream_deps = self.dataflow_history_manager.get_downstream(uuid)
                 result.all_downstream_deps = self.dataflow_history_manager.all_downstream(uuid)
 
             # run auto_updates
             self.dataflow_history_manager.run_auto_updates(uuid)
+        elif store_history:
+            self.dataflow_history_manager.record_run(
+                uuid, compute_time, cpu_time, peak_growth, 0, False)
+        # outputs may have been deleted or evicted during the run
+        self.displayhook.prune_rendered()
         return result
 
     # def run_cell(self, raw_cell, store_history=False, silent=False, shell_futures=True,
@@ -947,6 +1112,7 @@ class ZMQInteractiveShell(ipykernel.zmqshell.ZMQInteractiveShell):
         # import copy
         # orig_nodelist = copy.copy(nodelist)
         # self.push_result(result)
+        start_time = time.perf_counter()
         self.push_execution_count()
         self.push_uuid()
 
@@ -1072,7 +1238,8 @@ class ZMQInteractiveShell(ipykernel.zmqshell.ZMQInteractiveShell):
                     closure_expr = ast.Expr(ast.Await(ast.Call(ast.Name("__closure__", ast.Load()), [], [])))
                 else:
                     closure_expr = ast.Expr(ast.Call(ast.Name("__closure__", ast.Load()), [], []))
-                nodelist = [ast.FunctionDef("__closure__",ast.arguments(posonlyargs=[],args=[],vararg=None,kwonlyargs=[],kw_defaults=[],kwarg=None,defaults=[]),nodelist,[],None),closure_expr]
+                closure_def = ast.AsyncFunctionDef if has_await else ast.FunctionDef
+                nodelist = [closure_def("__closure__",ast.arguments(posonlyargs=[],args=[],vararg=None,kwonlyargs=[],kw_defaults=[],kwarg=None,defaults=[]),nodelist,[],None),closure_expr]
                 if future_elt:
                     nodelist = future_elt + nodelist
                 for node in nodelist:
@@ -1107,7 +1274,9 @@ class ZMQInteractiveShell(ipykernel.zmqshell.ZMQInteractiveShell):
         # mod = ast.Module(body=nodelist)
         # print(astor.to_source(mod))
         # print("END CODE")
-        res = await super().run_ast_nodes(nodelist, cell_name, interactivity, compiler, result)
+        profiler.record("rewrite_ast", time.perf_counter() - start_time)
+        with profiler.phase("user_code"):
+            res = await super().run_ast_nodes(nodelist, cell_name, interactivity, compiler, result)
         # print("DONE WITH AST NODES")
         self.pop_uuid()
         self.pop_execution_count()
@@ -1243,6 +1412,12 @@ class ZMQInteractiveShell(ipykernel.zmqshell.ZMQInteractiveShell):
         """Sets up the command history, and starts regular autosaves."""
         self.history_manager = HistoryManager(shell=self, parent=self)
         self.dataflow_history_manager = DataflowHistoryManager(shell=self)
+        self.dataflow_history_manager.cache_limit = self.dataflow_cache_limit
+        self.dataflow_history_manager.run_history_length = self.dataflow_run_history
+        self.dataflow_history_manager.early_cutoff = self.dataflow_early_cutoff
+        if self.dataflow_spill_dir:
+            self.dataflow_history_manager.spill_store = \
+                SpillStore(self.dataflow_spill_dir)
         self.dataflow_function_manager = \
             DataflowFunctionManager(self.dataflow_history_manager)
         self.configurables.append(self.history_manager)
@@ -0,0 +1,724 @@
+"""Tests for the dataflow history manager and state"""
+
+import asyncio
+import os
+import pickle
+from collections import OrderedDict
+from types import MethodType, SimpleNamespace
+
+import pytest
+
+from dfnotebook.benchmarks.notebooks import generate
+from dfnotebook.kernel.batch import BatchRunner, NotebookGraph
+from dfnotebook.kernel.checkpoint import CheckpointError, load_checkpoint, save_checkpoint
+from dfnotebook.kernel.codesync import CodeSync, DataflowSyncError, GraphSync, content_hash
+from dfnotebook.kernel import ipkernel
+from dfnotebook.kernel.ipkernel import IPythonKernel
+from dfnotebook.kernel.displayhook import ZMQShellDisplayHook
+from dfnotebook.kernel.dataflow import DataflowHistoryManager, DataflowState, start_branch
+from dfnotebook.kernel.dflink import LinkedResult
+from dfnotebook.kernel.metrics import Metrics
+from dfnotebook.kernel.profiler import Profiler, phase, snapshot
+from dfnotebook.kernel.spill import ResultStore, SpillStore
+from dfnotebook.kernel.zmqshell import ZMQInteractiveShell
+
+
+def make_history(edges=()):
+    history = DataflowHistoryManager(shell=SimpleNamespace(uuid=None))
+    for parent, child in edges:
+        history.update_dependencies(parent, child)
+    return history
+
+
+def test_closures():
+    history = make_history([("a", "b"), ("b", "c"), ("a", "d")])
+    assert sorted(history.all_upstream("c")) == ["a", "b"]
+    assert sorted(history.all_downstream("a")) == ["b", "c", "d"]
+    assert history.all_upstream("a") == []
+
+
+def test_closures_invalidated():
+    history = make_history([("a", "b"), ("b", "c")])
+    assert sorted(history.all_upstream("c")) == ["a", "b"]
+    assert sorted(history.all_downstream("a")) == ["b", "c"]
+
+    history.update_dependencies("x", "a")
+    assert sorted(history.all_upstream("c")) == ["a", "b", "x"]
+    assert sorted(history.all_downstream("x")) == ["a", "b", "c"]
+
+    history.remove_dependencies("a", "b")
+    assert history.all_upstream("c") == ["b"]
+    assert history.all_downstream("a") == []
+    assert history.all_downstream("x") == ["a"]
+
+
+class RecordingShell:
+    """Stands in for the shell, executing cells by marking them fresh"""
+
+    uuid = None
+
+    def __init__(self):
+        self.executed = []
+
+    def run_cell_as_execute_request(self, code, uuid, **kwargs):
+        self.executed.append(uuid)
+        self.dataflow_history_manager.update_value(uuid, code)
+        self.dataflow_history_manager.set_not_stale(uuid)
+        return SimpleNamespace(success=True, result=code)
+
+
+def make_stale_history(edges, cells):
+    shell = RecordingShell()
+    history = DataflowHistoryManager(shell=shell)
+    shell.dataflow_history_manager = history
+    shell.dataflow_state = DataflowState(history)
+    history.update_codes({cid: cid for cid in cells})
+    for parent, child in edges:
+        history.update_dependencies(parent, child)
+    return history
+
+
+def test_sorted_keys_execution_order():
+    history = make_history()
+    for cid in "abcb":
+        history.update_value(cid, cid)
+    assert list(history.sorted_keys()) == ["a", "c", "b"]
+    assert history.calculated_since(1) == ["c", "b"]
+    assert history.calculated_since(history.last_calculated["b"]) == []
+
+
+def test_stale_upstream_order():
+    # diamond: a -> (b, c) -> d -> e
+    edges = [("a", "b"), ("a", "c"), ("b", "d"), ("c", "d"), ("d", "e")]
+    history = make_stale_history(edges, "abcde")
+    order = history.stale_upstream("e")
+    assert sorted(order) == ["a", "b", "c", "d"]
+    for parent, child in edges:
+        if child != "e":
+            assert order.index(parent) < order.index(child)
+
+    history.set_not_stale("a")
+    assert "a" not in history.stale_upstream("e")
+
+
+def test_refresh_runs_each_cell_once():
+    edges = [("a", "b"), ("a", "c"), ("b", "d"), ("c", "d")]
+    history = make_stale_history(edges, "abcd")
+    assert history.get_item("d") == "d"
+    assert sorted(history.shell.executed) == ["a", "b", "c", "d"]
+    assert history.shell.executed[0] == "a"
+    assert history.shell.executed[-1] == "d"
+
+
+def test_make_plan_stops_at_fresh_cells():
+    # a -> b -> d, c -> d, with a and c up to date
+    edges = [("a", "b"), ("b", "d"), ("c", "d")]
+    history = make_stale_history(edges, "abcde")
+    history.set_not_stale("a")
+    history.set_not_stale("c")
+    plan, fresh = history.make_plan(["d"])
+    assert plan == ["b", "d"]
+    assert fresh == {"a", "c"}
+    history.set_not_stale("b")
+    history.set_not_stale("d")
+    assert history.make_plan(["d"]) == ([], {"d"})
+
+
+def test_plan_execution_estimates():
+    # a -> b -> c, with only b stale; a is about to be edited
+    edges = [("a", "b"), ("b", "c")]
+    history = make_stale_history(edges, "abc")
+    for cid, seconds in [("a", 1.0), ("b", 2.0), ("c", 4.0)]:
+        history.update_value(cid, cid, seconds)
+        history.set_not_stale(cid)
+    history.code_stale["b"] = True
+    plan = history.plan_execution("c")
+    assert [cell["uuid"] for cell in plan["cells"]] == ["b", "c"]
+    assert plan["estimated_seconds"] == 6.0
+    plan = history.plan_execution("c", changed=["a"])
+    assert [cell["uuid"] for cell in plan["cells"]] == ["a", "b", "c"]
+    assert not history.is_stale("a")
+    del history.compute_times["a"]
+    assert history.plan_execution("c", changed=["a"])["unestimated"] == ["a"]
+
+
+def test_run_stats_ring_buffer():
+    history = make_history()
+    history.run_history_length = 3
+    for i in range(5):
+        history.record_run("a", float(i), 0.5, None, 10 * i, i != 4)
+    history.record_run("b", 10.0, 9.0, 2048, 8, True)
+    assert [run.wall for run in history.run_history("a")] == [2.0, 3.0, 4.0]
+    summary = history.run_summary()
+    assert list(summary) == ["b", "a"]
+    assert summary["a"]["failures"] == 1
+    assert summary["a"]["wall_mean"] == 3.0
+    assert summary["a"]["peak_memory_max"] is None
+    assert summary["b"]["peak_memory_max"] == 2048
+    assert history.run_summary(["a", "missing"]).keys() == {"a"}
+
+
+def test_early_cutoff_keeps_downstream_fresh():
+    # a -> b -> c, a -> c
+    edges = [("a", "b"), ("b", "c"), ("a", "c")]
+    history = make_stale_history(edges, "abc")
+    history.early_cutoff = True
+    for cid in "abc":
+        history.update_value(cid, 1)
+        history.set_not_stale(cid)
+
+    history.update_codes({"a": "a2", "b": "b", "c": "c"})
+    assert all(history.is_stale(cid) for cid in "abc")
+    history.update_value("a", 1)
+    assert not any(history.is_stale(cid) for cid in "abc")
+
+    # b's own code changed, so it and c still have to run
+    history.update_codes({"a": "a3", "b": "b2", "c": "c"})
+    history.update_value("a", 1)
+    assert not history.is_stale("a")
+    assert history.is_stale("b") and history.is_stale("c")
+
+    history.update_codes({"a": "a4", "b": "b2", "c": "c"})
+    history.update_value("a", 2)
+    assert history.is_stale("b")
+
+
+def test_early_cutoff_after_several_edits():
+    # a -> b -> c; a is edited twice, running only a, and its second value
+    # matches its first edit's but not the one b and c were computed from
+    history = make_stale_history([("a", "b"), ("b", "c")], "abc")
+    history.early_cutoff = True
+    for cid, value in [("a", 1), ("b", 2), ("c", 20)]:
+        history.update_value(cid, value)
+        history.set_not_stale(cid)
+
+    history.update_codes({"a": "a = 2", "b": "b", "c": "c"})
+    history.update_value("a", 2)
+    history.set_not_stale("a")
+    history.update_codes({"a": "a = 1 + 1", "b": "b", "c": "c"})
+    history.update_value("a", 2)
+    assert not history.is_stale("a")
+    assert history.is_stale("b") and history.is_stale("c")
+
+
+def test_branch_local_state():
+    state = DataflowState(None)
+    state.set_cur_cell_id("parent")
+
+    async def branch(cell_id):
+        start_branch()
+        state.set_cur_cell_id(cell_id)
+        await asyncio.sleep(0)
+        return state.cur_cell_id
+
+    async def main():
+        return await asyncio.gather(branch("a"), branch("b"))
+
+    assert asyncio.run(main()) == ["a", "b"]
+
+
+def test_branch_local_execution_count():
+    shell_attrs = ("execution_count", "execution_count_stack",
+                   "push_execution_count", "pop_execution_count")
+    Shell = type("Shell", (object,), {name: vars(ZMQInteractiveShell)[name]
+                                      for name in shell_attrs})
+    shell = Shell()
+    shell.max_execution_count = 0
+
+    async def branch(count):
+        start_branch()
+        shell.execution_count_stack = []
+        shell.execution_count = count
+        shell.push_execution_count()
+        await asyncio.sleep(0)
+        running = shell.execution_count
+        shell.pop_execution_count()
+        return running, shell.execution_count
+
+    async def main():
+        return await asyncio.gather(branch(10), branch(20))
+
+    assert asyncio.run(main()) == [(11, 10), (21, 20)]
+    assert shell.max_execution_count == 21
+
+
+def make_delta(base, revision, cells, changed=(), deleted=()):
+    hashes = {cid: content_hash(cid, code) for cid, code in cells.items()}
+    return {
+        "base_revision": base,
+        "revision": revision,
+        "changed": {cid: {"code": cells[cid], "hash": hashes[cid]} for cid in changed},
+        "deleted": list(deleted),
+        "digest": sum(hashes.values()) & 0xFFFFFFFF,
+    }
+
+
+def test_code_sync_delta():
+    sync = CodeSync()
+    cells = {"a": "x = 1", "b": "y = x"}
+    sync.reset(cells, {"a": ["x"], "b": ["y"]}, revision=1)
+    assert sync.tag_cells == {"x": {"a"}, "y": {"b"}}
+
+    cells = {"a": "x = 2"}
+    code_dict, output_tags, deleted = sync.apply_delta(
+        make_delta(1, 2, cells, changed=["a"], deleted=["b"]))
+    assert code_dict == {"a": "x = 2"}
+    assert deleted == ["b"]
+    assert sync.revision == 2
+    assert sync.tag_cells == {}
+
+
+def test_code_sync_mismatch():
+    sync = CodeSync()
+    sync.reset({"a": "x = 1", "b": "y = x"}, {}, revision=1)
+    with pytest.raises(DataflowSyncError):
+        sync.apply_delta(make_delta(0, 2, {"a": "x = 1"}, deleted=["b"]))
+    # the frontend missed that b was deleted
+    sync.reset({"a": "x = 1", "b": "y = x"}, {}, revision=1)
+    with pytest.raises(DataflowSyncError):
+        sync.apply_delta(make_delta(1, 2, {"a": "x = 1"}))
+    assert sync.revision is None
+
+
+def test_graph_sync_changed_since():
+    graph = GraphSync()
+    assert not graph.is_current(graph.epoch, None)
+    graph.next_revision()
+    graph.update("cell", "a", 0)
+    graph.update("cell", "b", 1)
+    base = graph.revision
+    assert graph.is_current(graph.epoch, base)
+    assert not graph.is_current("other", base)
+
+    graph.next_revision()
+    graph.update("cell", "a", 0)
+    graph.update("down", "a", ["b"])
+    graph.remove("cell", "b")
+    graph.next_revision()
+    graph.update("cell", "a", 2)
+    assert graph.changed_since(base) == [("down", "a"), ("cell", "b"), ("cell", "a")]
+    assert graph.changed_since(graph.revision) == []
+
+
+def test_update_codes_delta():
+    history = make_stale_history([("a", "b")], "abc")
+    for cid in "abc":
+        history.set_not_stale(cid)
+    history.update_codes({"c": "c2"}, deleted_keys=["x"])
+    assert not history.is_stale("a") and history.is_stale("c")
+    assert sorted(history.code_cache) == ["a", "b", "c"]
+
+
+def test_update_codes_marks_downstream_once():
+    history = make_stale_history([("a", "b"), ("b", "d"), ("c", "d"), ("d", "e")], "abcdef")
+    history.metrics = metrics = Metrics()
+    for cid in "abcdef":
+        history.set_not_stale(cid)
+    history.update_codes({"a": "a2", "c": "c2", "f": "f"})
+    assert [cid for cid in "abcdef" if history.is_stale(cid)] == list("abcde")
+    # a single walk over the closure of a and c
+    assert metrics.histograms["stale_propagation_cells"].counts[:4] == [0, 0, 1, 0]
+
+
+def make_converter():
+    kernel = SimpleNamespace(
+        shell=SimpleNamespace(dataflow_state=DataflowState(None)),
+        _output_tags={},
+        code_sync=CodeSync(),
+        _conversion_cache={},
+        _comm_cells={},
+        _comm_input_tags={},
+        _comm_output_tags={},
+        log=SimpleNamespace(error=print),
+    )
+    for name in ("convert_cell", "_conversion_deps", "_display_code",
+                 "update_code_cells"):
+        setattr(kernel, name, MethodType(getattr(IPythonKernel, name), kernel))
+    return kernel
+
+
+def test_convert_cell_cached():
+    kernel = make_converter()
+    state = kernel.shell.dataflow_state
+    state.add_link("x", "aaaaaaaa")
+    converted, cached = kernel.convert_cell("y = x + 1", "bbbbbbbb", {})
+    assert not cached
+    assert converted.persistent_code == "y = x$aaaaaaaa + 1"
+    assert kernel.convert_cell("y = x + 1", "bbbbbbbb", {})[1]
+
+    # a link for an unrelated name keeps the entry, one for x does not
+    state.add_link("z", "cccccccc")
+    assert kernel.convert_cell("y = x + 1", "bbbbbbbb", {})[1]
+    state.add_link("x", "cccccccc")
+    converted, cached = kernel.convert_cell("y = x + 1", "bbbbbbbb", {})
+    assert not cached
+    assert converted.persistent_code == "y = x$cccccccc + 1"
+
+
+def test_state_links_reused_name():
+    state = DataflowState(None)
+    for cid in ["a", "b", "c", "b"]:
+        state.add_link("df", cid)
+    assert list(state.links["df"]) == ["a", "c", "b"]
+    assert state.get_external_link("df", "d") == "b"
+    version = state.version
+    state.reset_cell("b")
+    assert state.version > version
+    assert state.get_external_link("df", "d") == "c"
+    version = state.version
+    # known links are skipped
+    state.add_links({"c": ["df"]})
+    assert state.version == version
+    state.reset_cell("a")
+    state.reset_cell("c")
+    assert not state.has_current_link("df")
+    state.add_links({"d": ["df"]})
+    assert state.get_current_link("df") == "d"
+
+
+def test_state_complete_prefix_index():
+    state = DataflowState(None)
+    state.add_link("df", "aaaaaaaa")
+    state.add_link("df", "abcdef01")
+    state.add_link("dfx", "bbbbbbbb")
+    state.add_link("e", "cccccccc")
+    input_tags = {"load": "aaaaaaaa", "other": "cccccccc"}
+    assert sorted(state.complete("d", input_tags)) == [
+        "df", "df$aaaaaaaa", "df$abcdef01", "df$load", "dfx", "dfx$bbbbbbbb"]
+    assert sorted(state.complete("df$a", input_tags)) == ["df$aaaaaaaa", "df$abcdef01"]
+    assert state.complete("df$l", input_tags) == ["df$load"]
+    state.reset_cell("bbbbbbbb")
+    assert state.link_names == ["df", "e"]
+    assert state.complete("dfx", input_tags) == []
+
+
+def test_update_code_cells_dirty(monkeypatch):
+    kernel = make_converter()
+    state = kernel.shell.dataflow_state
+    state.add_link("x", "aaaaaaaa")
+    state.add_link("w", "cccccccc")
+    refs = {"ref": {"aaaaaaaa": ["x"]}, "tag_refs": {}}
+    dfmetadata = {
+        "code_dict": {"aaaaaaaa": "x = 1", "bbbbbbbb": "y = x$aaaaaaaa + 1",
+                      "cccccccc": "w = 2"},
+        "output_tags": {"aaaaaaaa": ["x"], "bbbbbbbb": ["y"], "cccccccc": ["w"]},
+        "input_tags": {},
+        "all_refs": {"aaaaaaaa": {"ref": {}, "tag_refs": {}}, "bbbbbbbb": refs,
+                     "cccccccc": {"ref": {}, "tag_refs": {}}},
+        "executed_code": {},
+    }
+    code_dict, _ = kernel.update_code_cells(dfmetadata)
+    dfmetadata["code_dict"].update(code_dict)
+
+    converted = []
+    convert_dollar = ipkernel.convert_dollar
+    monkeypatch.setattr(ipkernel, "convert_dollar", lambda code, *args, **kwargs:
+                        converted.append(code) or convert_dollar(code, *args, **kwargs))
+    assert kernel.update_code_cells(dfmetadata) == ({}, {})
+    assert converted == []
+
+    # only the cells that mention x are converted again
+    state.reset_cell("aaaaaaaa")
+    state.add_link("x", "aaaaaaaa")
+    kernel.update_code_cells(dfmetadata)
+    assert sorted(converted) == ["x = 1", "y = x + 1"]
+
+
+def test_cache_limit_evicts_and_recomputes():
+    history = make_stale_history([("a", "b")], "abc")
+    history.cache_limit = 2000
+    history.force_cached_flags["c"] = True
+    history.update_value("c", bytearray(900))
+    history.update_value("a", bytearray(900), compute_time=10.0)
+    history.update_value("b", bytearray(900), compute_time=0.01)
+    for cid in "abc":
+        history.set_not_stale(cid)
+    # b is newest but c is pinned and a is more expensive to recompute
+    history.update_value("a", bytearray(900), compute_time=10.0)
+    assert history.evicted == {"b"}
+    assert not history.is_stale("b")
+    assert history.cache_size <= history.cache_limit
+
+    history.shell.uuid = "c"
+    assert history.get_item("b") == "b"
+    assert history.shell.executed == ["b"]
+    assert "b" not in history.evicted
+
+
+def test_spill_store(tmp_path):
+    np = pytest.importorskip("numpy")
+    store = SpillStore(str(tmp_path))
+    arr = np.arange(1000)
+    linked = LinkedResult("aaaaaaaa", ["np"], False, [("np", np), ("x", arr), ("y", "z")])
+    assert store.put("aaaaaaaa", linked)
+    assert not store.put("bbbbbbbb", lambda: 0)
+    value = dict(store.get("aaaaaaaa").items())
+    assert value["np"] is np and value["y"] == "z"
+    assert (value["x"] == arr).all()
+    with pytest.raises(KeyError):
+        store.get("aaaaaaaa")
+    assert store.stats() == {"spilled": 0, "hits": 1, "misses": 1}
+    store.close()
+
+
+def test_evicted_value_reloaded_from_spill(tmp_path):
+    history = make_stale_history([], "ab")
+    history.spill_store = SpillStore(str(tmp_path))
+    history.cache_limit = 1500
+    history.update_value("a", bytearray(1000))
+    history.update_value("b", bytearray(1000))
+    for cid in "ab":
+        history.set_not_stale(cid)
+    assert history.evicted == {"a"}
+    assert history.get_item("a") == bytearray(1000)
+    assert history.shell.executed == []
+    assert history.spill_store.hits == 1
+
+
+def test_result_store_lru(tmp_path):
+    store = ResultStore(str(tmp_path), size_limit=5000)
+    assert store.put("a", bytes(2000)) and store.put("b", bytes(2000))
+    os.utime(store._file("a"), (0, 0))
+    os.utime(store._file("b"), (1, 1))
+    assert store.get("a") == bytes(2000)
+    assert store.put("c", bytes(2000))
+    assert "b" not in store and "a" in store and "c" in store
+    # a new kernel sees the same results
+    assert ResultStore(str(tmp_path)).get("c") == bytes(2000)
+
+
+def test_checkpoint_round_trip(tmp_path):
+    history = make_stale_history([("a", "b")], "abc")
+    shell = history.shell
+    shell.dataflow_state.add_link("x", "a")
+    shell.user_ns = {"x": 1, "f": lambda: 0, "_hidden": 2}
+    shell.user_ns_hidden = {}
+    history.update_value("a", LinkedResult("a", [], False, [("x", 1)]))
+    history.update_value("b", lambda: 0)
+    for cid in "abc":
+        history.set_not_stale(cid)
+    path = str(tmp_path / "state.checkpoint")
+    report = save_checkpoint(shell, path)
+    assert report["values"] == 1 and report["namespace"] == 1
+    assert sorted(s["name"] for s in report["skipped"]) == ["b", "f"]
+
+    restored = make_stale_history([], "")
+    restored.shell.user_ns = {}
+    report = load_checkpoint(restored.shell, path)
+    assert report["values"] == 1 and restored.shell.user_ns == {"x": 1}
+    assert list(restored.shell.dataflow_state.links["x"]) == ["a"]
+    assert restored.all_downstream("a") == ["b"]
+    assert restored.get_item("a")["x"] == 1
+    # b could not be saved so it is recomputed
+    assert restored.evicted == {"b"}
+    assert restored.get_item("b") == "b"
+    assert restored.shell.executed == ["b"]
+
+
+def test_checkpoint_writes_shared_objects_once(tmp_path):
+    history = make_stale_history([], "ab")
+    shell = history.shell
+    data = [b"x" * 100000]
+    shell.user_ns = {"x": data, "y": data}
+    shell.user_ns_hidden = {}
+    history.update_value("a", LinkedResult("a", [], False, [("x", data)]))
+    history.update_value("b", data)
+    path = tmp_path / "state.checkpoint"
+    report = save_checkpoint(shell, str(path))
+    assert report["values"] == 2 and report["namespace"] == 2
+    assert path.stat().st_size < 2 * len(data[0])
+
+    restored = make_stale_history([], "")
+    restored.shell.user_ns = {}
+    load_checkpoint(restored.shell, str(path))
+    x = restored.shell.user_ns["x"]
+    assert x == data and x is restored.shell.user_ns["y"]
+    # not value_cache["a"]["x"], which records a dependency
+    assert OrderedDict.__getitem__(restored.value_cache["a"], "x") is x
+    assert restored.value_cache["b"] is x
+
+
+def test_checkpoint_skips_records_sharing_unpicklable_objects(tmp_path):
+    history = make_stale_history([], "a")
+    shell = history.shell
+    f = lambda: 0
+    shell.user_ns = {"f": f, "x": 1}
+    shell.user_ns_hidden = {}
+    history.update_value("a", LinkedResult("a", [], False, [("f", f)]))
+    report = save_checkpoint(shell, str(tmp_path / "state.checkpoint"))
+    assert report["values"] == 0 and report["namespace"] == 1
+    assert sorted(s["name"] for s in report["skipped"]) == ["a", "f"]
+
+
+@pytest.mark.parametrize("records,error", [
+    (None, "not a dataflow checkpoint"),
+    ([{"checkpoint": 99}], "version 99 checkpoint"),
+    ([{"checkpoint": 2}], "does not start with a dependency graph"),
+    ([{"checkpoint": 2}, ("value", "a", 1)], "does not start with a dependency graph"),
+])
+def test_checkpoint_rejects_other_files(tmp_path, records, error):
+    path = str(tmp_path / "state.checkpoint")
+    with open(path, "wb") as f:
+        if records is None:
+            f.write(b"not a checkpoint")
+        for record in records or ():
+            pickle.dump(record, f)
+    history = make_stale_history([], "a")
+    with pytest.raises(CheckpointError, match=error):
+        load_checkpoint(history.shell, path)
+    # nothing was cleared
+    assert "a" in history.code_cache
+
+
+def test_profiler_nests_cells():
+    profiler = Profiler(history=2)
+    with phase("ignored"):
+        assert snapshot() is None
+    with profiler.profile("cell", cell="b"):
+        with phase("upstream"):
+            with profiler.profile("cell", cell="a"):
+                with phase("user_code"):
+                    pass
+        assert snapshot()["children"][0]["name"] == "upstream"
+    tree, = profiler.last()
+    upstream, = tree["children"]
+    nested, = upstream["children"]
+    assert nested["cell"] == "a"
+    assert [child["name"] for child in nested["children"]] == ["user_code"]
+    assert tree["time"] >= nested["time"] > 0
+
+
+def test_metrics_counts_cache_and_staleness():
+    history = make_stale_history([("a", "b")], "ab")
+    history.metrics = metrics = Metrics()
+    history.shell.uuid = "c"
+    assert history.get_item("b") == "b"
+    assert history.get_item("b") == "b"
+    assert metrics.counters["value_cache_misses"] == 1
+    assert metrics.counters["value_cache_hits"] == 1
+    assert metrics.counters["reexecutions"] == 2
+    # a, b, and c, which referenced b
+    history.set_stale("a")
+    text = metrics.render()
+    assert "dfkernel_reexecutions_total 2" in text
+    assert 'dfkernel_stale_propagation_cells_bucket{le="2"} 0' in text
+    assert 'dfkernel_stale_propagation_cells_bucket{le="5"} 1' in text
+
+
+@pytest.mark.parametrize("shape", ["chain", "fanout", "fanin", "diamond", "random"])
+def test_benchmark_notebooks_reference_earlier_cells(shape):
+    nb = generate(shape, 40, refs="uuid", seed=1)
+    assert 0 < len(nb) <= 40
+    for cid in nb.cell_ids:
+        refs = sorted(ref.split("$")[1] for ref in nb.code[cid].split() if "$" in ref)
+        assert refs == nb.parents[cid]
+        assert all(parent < cid for parent in refs)
+    assert nb.sinks()
+
+
+@pytest.mark.parametrize("batch", [False, True])
+def test_displayhook_batches_outputs(batch):
+    sent = []
+    hook = SimpleNamespace(
+        shell=SimpleNamespace(batch_outputs=batch),
+        session=SimpleNamespace(send=lambda socket, msg, ident: sent.append(dict(msg["content"]))),
+        pub_socket=None,
+        topic=None,
+        msg={"content": {
+            "execution_count": 1,
+            "data": {0: {"text/plain": "1"}, 1: {"text/plain": "2"}},
+            "metadata": {0: {"output_tag": "a"}, 1: {"output_tag": "b"}},
+        }},
+    )
+    ZMQShellDisplayHook.finish_displayhook(hook)
+    if batch:
+        msg, = sent
+        assert msg["data"] == {"text/plain": "1"}
+        assert [out["metadata"]["output_tag"] for out in msg["outputs"]] == ["a", "b"]
+    else:
+        assert [msg["metadata"]["output_tag"] for msg in sent] == ["a", "b"]
+        assert "outputs" not in sent[0]
+
+
+def test_render_format_on_request():
+    from IPython.core.formatters import DisplayFormatter
+
+    class Html(object):
+        renders = 0
+
+        def _repr_html_(self):
+            Html.renders += 1
+            return "<b>{}</b>".format(Html.renders)
+
+    history = make_history()
+    history.update_value("a", LinkedResult("a", [], False, [("h", Html()), ("k", 5)]))
+    hook = SimpleNamespace(
+        shell=SimpleNamespace(display_formatter=DisplayFormatter(),
+                              dataflow_history_manager=history),
+        rendered={},
+    )
+    for name in ("available_formats", "render_format", "prune_rendered"):
+        setattr(hook, name, MethodType(getattr(ZMQShellDisplayHook, name), hook))
+    assert hook.available_formats(Html()) == ["text/html"]
+    assert hook.available_formats(5) == []
+    assert hook.render_format("a", "h", "text/html") == ("<b>1</b>", None)
+    assert hook.render_format("a", "h", "text/html") == ("<b>1</b>", None)
+    # recomputing the cell drops what was rendered
+    history.update_value("a", LinkedResult("a", [], False, [("h", Html())]))
+    assert hook.render_format("a", "h", "text/html") == ("<b>2</b>", None)
+    with pytest.raises(LookupError):
+        hook.render_format("a", "k", "text/html")
+    history.drop_value("a")
+    hook.prune_rendered()
+    assert hook.rendered == {}
+
+
+def test_notebook_graph_upstream():
+    def cell(cid, refs, outputs, tag=""):
+        dfmetadata = {"tag": tag, "inputVars": {"ref": refs, "tag_refs": {}},
+                      "outputVars": outputs}
+        return {"cell_type": "code", "id": cid + "-0000", "source": ["x = 1\n", "x"],
+                "metadata": {"dfmetadata": dfmetadata}, "outputs": []}
+
+    graph = NotebookGraph({"cells": [
+        cell("0000000a", {}, ["a"]),
+        cell("0000000b", {"0000000a": ["a"]}, ["b"], tag="load"),
+        cell("0000000c", {}, ["c"]),
+        {"cell_type": "markdown", "id": "m", "metadata": {}, "source": ""},
+        cell("0000000d", {"0000000b": ["b"]}, ["d"]),
+    ]})
+    assert list(graph.cells) == ["0000000a", "0000000b", "0000000c", "0000000d"]
+    assert graph.code("0000000a") == "x = 1\nx"
+    assert graph.resolve("load") == "0000000b"
+    assert graph.resolve("d") == graph.resolve("0000000d") == "0000000d"
+    with pytest.raises(LookupError):
+        graph.resolve("e")
+    assert graph.sinks() == ["0000000c", "0000000d"]
+    assert graph.upstream(["0000000d"]) == {"0000000a", "0000000b", "0000000d"}
+
+
+def test_batch_runner_runs_each_cell_once(tmp_path):
+    log = str(tmp_path / "ran")
+
+    def cell(cid, code):
+        source = "open({!r}, 'a').write({!r})\n{}".format(log, cid[-1], code)
+        return {"cell_type": "code", "id": cid + "-0000", "source": source,
+                "metadata": {}, "outputs": []}
+
+    # a feeds both b and c, which d combines
+    graph = NotebookGraph({"cells": [
+        cell("0000000a", "a = 1"),
+        cell("0000000b", "b = a + 1"),
+        cell("0000000c", "c = a * 10"),
+        cell("0000000d", "d = b + c\nd"),
+    ]})
+    with BatchRunner(graph, timeout=60) as runner:
+        for cid in graph.cells:
+            assert runner.execute(cid) == "ok"
+        # later requests send no changes, so nothing reruns
+        assert runner.execute("0000000d") == "ok"
+    with open(log) as f:
+        assert f.read() == "abcdd"
+    assert runner.outputs["0000000d"][0]["data"]["text/plain"] == "12"
+    assert runner.replies["0000000d"]["identifier_refs"]["0000000d"] == {
+        "0000000b": ["b"], "0000000c": ["c"]}
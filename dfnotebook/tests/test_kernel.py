@@ -4,6 +4,7 @@
 # Distributed under the terms of the Modified BSD License.
 
 import ast
+import json
 import os.path
 import platform
 import signal
@@ -20,13 +21,18 @@ import pytest
 from flaky import flaky
 from IPython.paths import locate_profile
 
+from dfnotebook.kernel import batch
+
 from .utils import (
     TIMEOUT,
     assemble_output,
+    comm_request,
     execute,
+    execute_cell,
     flush_channels,
     get_reply,
     kernel,
+    new_dataflow_kernel,
     new_kernel,
     wait_for_idle,
 )
@@ -716,3 +722,161 @@ def test_shutdown_subprocesses():
             child_newpg.terminate()
         except psutil.NoSuchProcess:
             pass
+
+
+def _counts(replies):
+    return ["{:08x}".format(r["content"]["execution_count"]) for r in replies]
+
+
+def test_upstream_dropped_reference_not_run():
+    with new_dataflow_kernel() as kc:
+        code = {"0000000a": "a = 1", "0000000b": "b = a + 1"}
+        for cid in code:
+            replies, _ = execute_cell(kc, cid, code)
+            assert replies[-1]["content"]["status"] == "ok"
+        # b no longer uses a, so a failing a does not matter to it
+        code.update({"0000000a": "a = 1/0", "0000000b": "b = 5"})
+        replies, _ = execute_cell(kc, "0000000b", code)
+        assert _counts(replies) == ["0000000b"]
+        assert replies[-1]["content"]["status"] == "ok"
+
+
+def test_upstream_failure_replies_for_requested_cell():
+    with new_dataflow_kernel() as kc:
+        code = {"0000000a": "a = 1", "0000000b": "b = a + 1", "0000000c": "c = b * 2"}
+        for cid in code:
+            execute_cell(kc, cid, code)
+        code["0000000a"] = "a = 1/0"
+        replies, _ = execute_cell(kc, "0000000c", code)
+        assert _counts(replies) == ["0000000a", "0000000c"]
+        assert replies[0]["content"]["ename"] == "ZeroDivisionError"
+        assert replies[1]["content"]["ename"] == "DataflowCellException"
+
+
+def test_parallel_upstream_branches_overlap():
+    argv = ["--IPythonKernel.parallel_upstream=True"]
+    with new_dataflow_kernel(argv) as kc:
+        # each branch reports the execution count it sees once it resumes
+        code = {
+            "0000000a": "import asyncio",
+            "0000000b": "b = (await asyncio.sleep(1), get_ipython().execution_count)[1]",
+            "0000000c": "c = (await asyncio.sleep(1), get_ipython().execution_count)[1]",
+            "0000000d": "d = b != c",
+        }
+        for cid in code:
+            replies, _ = execute_cell(kc, cid, code)
+            assert replies[-1]["content"]["status"] == "ok"
+        # b and c go stale together and are rerun side by side
+        code["0000000a"] = "import asyncio\nx = 0"
+        start = time.monotonic()
+        replies, iopub = execute_cell(kc, "0000000d", code)
+        assert time.monotonic() - start < 2
+        assert sorted(_counts(replies)) == ["0000000a", "0000000b", "0000000c", "0000000d"]
+        assert all(r["content"]["status"] == "ok" for r in replies)
+        results = {
+            "{:08x}".format(msg["content"]["execution_count"]): msg["content"]["data"]
+            for msg in iopub
+            if msg["msg_type"] == "execute_result"
+        }
+        assert results["0000000d"]["text/plain"] == "True"
+
+
+@pytest.mark.parametrize("flags,parallel", [([], "False"), (["--parallel"], "True")])
+def test_batch_parallel_opt_in(tmp_path, monkeypatch, flags, parallel):
+    # the kernel starts in the notebook's directory
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    paths = [root, os.environ.get("PYTHONPATH")]
+    monkeypatch.setenv("PYTHONPATH", os.pathsep.join(filter(None, paths)))
+
+    def cell(cid, source):
+        return {"cell_type": "code", "id": cid + "-0000", "source": source,
+                "metadata": {}, "outputs": []}
+
+    notebook = str(tmp_path / "nb.ipynb")
+    with open(notebook, "w") as f:
+        json.dump({"cells": [
+            cell("0000000a", "a = 1"),
+            cell("0000000b", "p = get_ipython().kernel.parallel_upstream, a\np"),
+        ], "metadata": {}, "nbformat": 4, "nbformat_minor": 5}, f)
+    results = str(tmp_path / "results")
+    argv = [notebook, "--results-dir", results, "--timeout", str(TIMEOUT)]
+    assert batch.main(argv + flags) == 0
+    with open(os.path.join(results, "0000000b.json")) as f:
+        outputs = json.load(f)["outputs"]
+    assert outputs[0]["data"]["text/plain"] == "({}, 1)".format(parallel)
+
+
+def test_nested_run_not_counted_in_compute_time():
+    # a tiny budget evicts a, so b recomputes it while b itself runs
+    argv = ["--ZMQInteractiveShell.dataflow_cache_limit=1"]
+    with new_dataflow_kernel(argv) as kc:
+        code = {"0000000a": "import time\ntime.sleep(1)\na = 1", "0000000b": "b = a + 1"}
+        for cid in code:
+            execute_cell(kc, cid, code)
+        code["0000000b"] = "b = a + 2"
+        replies, _ = execute_cell(kc, "0000000b", code)
+        assert _counts(replies) == ["0000000a", "0000000b"]
+        code["0000000c"] = "c = [run.wall for run in Out.run_history('0000000b')]"
+        _, iopub = execute_cell(kc, "0000000c", code)
+        walls = [
+            ast.literal_eval(msg["content"]["data"]["text/plain"])
+            for msg in iopub
+            if msg["msg_type"] == "execute_result"
+        ]
+        assert walls and max(walls[0]) < 0.5
+
+
+def test_rendered_formats_pruned_with_cell():
+    with new_dataflow_kernel() as kc:
+        code = {"0000000a": "class Bold:\n    def _repr_html_(self):\n        return '<b>a</b>'\nbold = Bold()"}
+        _, iopub = execute_cell(kc, "0000000a", code, lazy_formats=True)
+        data, = (msg["content"]["data"] for msg in iopub if msg["msg_type"] == "execute_result")
+        assert "text/html" not in data
+        request = {"uuid": "0000000a", "output_tag": "bold", "mimetype": "text/html"}
+        assert comm_request(kc, "dfformat", request)["data"] == "<b>a</b>"
+
+        def rendered(cid):
+            code[cid] = "len(get_ipython().displayhook.rendered)"
+            _, iopub = execute_cell(kc, cid, code)
+            return [msg["content"]["data"]["text/plain"]
+                    for msg in iopub if msg["msg_type"] == "execute_result"]
+
+        assert rendered("0000000b") == ["1"]
+        del code["0000000a"]
+        rendered("0000000c")
+        assert rendered("0000000d") == ["0"]
+
+
+def test_result_store_loads_upstream_after_restart(tmp_path):
+    log = str(tmp_path / "ran")
+    argv = ["--IPythonKernel.result_store_dir=" + str(tmp_path / "store")]
+    code = {"0000000a": "open({!r}, 'a').write('a')\na = 1".format(log), "0000000b": "b = a + 1"}
+    with new_dataflow_kernel(argv) as kc:
+        for cid in code:
+            replies, _ = execute_cell(kc, cid, code)
+            assert replies[-1]["content"]["status"] == "ok"
+    with new_dataflow_kernel(argv) as kc:
+        replies, iopub = execute_cell(kc, "0000000b", dict(code))
+    assert _counts(replies) == ["0000000a", "0000000b"]
+    assert all(r["content"]["status"] == "ok" for r in replies)
+    results = [msg["content"]["data"]["text/plain"]
+               for msg in iopub if msg["msg_type"] == "execute_result"]
+    assert results[-1] == "2"
+    # a's result was loaded, not computed again
+    with open(log) as f:
+        assert f.read() == "a"
+
+
+@pytest.mark.parametrize("batch", [False, True])
+def test_batch_outputs(batch):
+    with new_dataflow_kernel() as kc:
+        code = {"0000000a": "x, y = 1, 2"}
+        _, iopub = execute_cell(kc, "0000000a", code, batch_outputs=batch)
+    results = [msg["content"] for msg in iopub if msg["msg_type"] == "execute_result"]
+    if batch:
+        result, = results
+        outputs = result["outputs"]
+    else:
+        outputs = results
+    assert [out["metadata"]["output_tag"] for out in outputs] == ["x", "y"]
+    assert [out["data"]["text/plain"] for out in outputs] == ["1", "2"]
@@ -6,15 +6,18 @@ from __future__ import annotations
 
 import atexit
 import os
+import shutil
 import sys
 from contextlib import contextmanager
 from queue import Empty
 from subprocess import STDOUT
 from tempfile import TemporaryDirectory
 from time import time
+from uuid import uuid4
 
 from jupyter_client import manager
 from jupyter_client.blocking.client import BlockingKernelClient
+from jupyter_client.kernelspec import KernelSpecManager
 
 STARTUP_TIMEOUT = 60
 TIMEOUT = 100
@@ -184,6 +187,96 @@ def new_kernel(argv=None):
     return manager.run_kernel(**kwargs)
 
 
+@contextmanager
+def new_dataflow_kernel(argv=None):
+    """Context manager for a new dataflow kernel in a subprocess
+
+    Returns
+    -------
+    kernel_client: connected KernelClient instance
+    """
+    from dfnotebook.kernel.kernelspec import KERNEL_NAME, make_ipkernel_cmd, write_kernel_spec
+
+    path = write_kernel_spec(
+        overrides={"argv": make_ipkernel_cmd("dfnotebook.kernel", extra_arguments=argv)}
+    )
+    km = manager.KernelManager(
+        kernel_name=KERNEL_NAME,
+        kernel_spec_manager=KernelSpecManager(kernel_dirs=[os.path.dirname(path)]),
+    )
+    km.start_kernel(stderr=STDOUT)
+    kc = km.client()
+    kc.start_channels()
+    try:
+        kc.wait_for_ready(timeout=STARTUP_TIMEOUT)
+        yield kc
+    finally:
+        kc.stop_channels()
+        km.shutdown_kernel(now=True)
+        shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+
+
+def execute_cell(kc, uuid, code_dict, **dfkernel_data):
+    """Execute cell uuid of code_dict as the dataflow frontend does
+
+    Returns the replies of every cell that ran, the requested cell's last,
+    and the IOPub messages of the request up to idle. Like the frontend,
+    code_dict is updated with the persistent code of the cells that ran.
+    """
+    data = {
+        "uuid": uuid,
+        "code_dict": dict(code_dict),
+        "output_tags": {},
+        "input_tags": {},
+        "auto_update_flags": {},
+        "force_cached_flags": {},
+    }
+    data.update(dfkernel_data)
+    msg = kc.session.msg(
+        "execute_request",
+        {
+            "code": code_dict[uuid],
+            "silent": False,
+            "store_history": True,
+            "user_expressions": {"__dfkernel_data__": data},
+            "allow_stdin": False,
+            "stop_on_error": False,
+        },
+    )
+    kc.shell_channel.send(msg)
+    msg_id = msg["header"]["msg_id"]
+    iopub = []
+    while True:
+        msg = kc.get_iopub_msg(timeout=TIMEOUT)
+        if msg["parent_header"].get("msg_id") != msg_id:
+            continue
+        if msg["msg_type"] == "status" and msg["content"]["execution_state"] == "idle":
+            break
+        iopub.append(msg)
+    replies = []
+    while not replies or replies[-1]["content"].get("execution_count") != int(uuid, 16):
+        reply = kc.get_shell_msg(timeout=TIMEOUT)
+        if reply["parent_header"].get("msg_id") == msg_id:
+            replies.append(reply)
+    for reply in replies:
+        code_dict.update(reply["content"].get("persistent_code") or {})
+    return replies, iopub
+
+
+def comm_request(kc, target_name, data):
+    """Open a comm to target_name, send data on it, and return the data of
+    the kernel's first message back"""
+    comm_id = uuid4().hex
+    kc.shell_channel.send(
+        kc.session.msg("comm_open", {"comm_id": comm_id, "target_name": target_name, "data": {}})
+    )
+    kc.shell_channel.send(kc.session.msg("comm_msg", {"comm_id": comm_id, "data": data}))
+    while True:
+        msg = kc.get_iopub_msg(timeout=TIMEOUT)
+        if msg["msg_type"] == "comm_msg" and msg["content"]["comm_id"] == comm_id:
+            return msg["content"]["data"]
+
+
 def assemble_output(get_msg):
     """assemble stdout/err from an execution"""
     stdout = ""
@@ -270,6 +270,21 @@ export namespace DataflowCodeCell {
         }
       }
       
+      // outputs of a LinkedResult arrive in one message
+      if (dfData) {
+        dfData = { ...dfData, batch_outputs: true };
+      }
+
+      // let the kernel send only what changed since the graph we have
+      const graph = GraphManager.graphs[sessionContext.session.id];
+      if (dfData && graph?.graphEpoch) {
+        dfData = {
+          ...dfData,
+          graph_epoch: graph.graphEpoch,
+          graph_revision: graph.graphRevision ?? null
+        };
+      }
+
       const msgPromise = DataflowOutputArea.execute(
         code,
         cell.outputArea,
@@ -372,8 +387,18 @@ export namespace DataflowCodeCell {
           GraphManager.createGraph(sessId);
           graphUndefined = true;
         }
-        GraphManager.graphs[sessId].updateCellContents(dfData?.code_dict);
+        // code deltas only carry the changed cells
+        if (dfData?.code_dict) {
+          GraphManager.graphs[sessId].updateCellContents(dfData.code_dict);
+        }
+        if (content.graph_diff) {
+          cells = GraphManager.graphs[sessId].patchCells(content.cells_moved, content.cells_removed);
+        }
         GraphManager.graphs[sessId].updateGraph(cells,nodes,uplinks,downlinks,`${truncateCellId(cell.model.id) || ''}`,allUps,internalNodes);
+        if (content.graph_epoch) {
+          GraphManager.graphs[sessId].graphEpoch = content.graph_epoch;
+          GraphManager.graphs[sessId].graphRevision = content.graph_revision;
+        }
         if (!graphUndefined){
           GraphManager.updateDepViews(false);
         }
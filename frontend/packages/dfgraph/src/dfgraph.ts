@@ -184,6 +184,9 @@ export class Graph {
   cellOrder: any;
   states: any;
   executed: any;
+  // the kernel's graph revision last applied, for diffed replies
+  graphEpoch?: string;
+  graphRevision?: number;
 
   /*
    * Create a graph to contain all inner cell dependencies
@@ -432,6 +435,14 @@ export class Graph {
     this.cellContents = cellContents;
   }
 
+  /** @method patchCells applies the cells that ran or were removed since the last reply */
+  patchCells(this: Graph, moved: string[], removed: string[]) {
+    const changed = new Set(moved.concat(removed));
+    return this.cells
+      .filter((uuid: string) => !changed.has(uuid))
+      .concat(moved);
+  }
+
   /** @method updateDepLists */
   updateDepLists(this: Graph, allUps: string | any[], uuid: string | number) {
     let that: Graph = this;
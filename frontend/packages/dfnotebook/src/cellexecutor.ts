@@ -13,7 +13,7 @@ import { KernelError, INotebookModel, INotebookCellExecutor } from '@jupyterlab/
 import { DataflowCodeCell } from '@dfnotebook/dfcells';
 import { DataflowNotebookModel } from './model';
 import { Manager as GraphManager } from '@dfnotebook/dfgraph';
-import { truncateCellId } from '@dfnotebook/dfutils';
+import { contentHash, truncateCellId } from '@dfnotebook/dfutils';
 
 /**
  * Run a single notebook cell.
@@ -92,16 +92,24 @@ import { truncateCellId } from '@dfnotebook/dfutils';
                 dfData.dfMetadata.input_tags={};
               }
 
-              reply = await DataflowCodeCell.execute(
+              const kernelId = sessionContext.session?.kernel?.id ?? '';
+              const executeCell = () => DataflowCodeCell.execute(
                   cell as DataflowCodeCell,
                   sessionContext,
                   {
                   deletedCells,
                   recordTiming: notebookConfig.recordTiming
                   },
-                  dfData.dfMetadata,
+                  encodeCodeSync(notebook, kernelId, dfData.dfMetadata),
                   dfData.cellIdModelMap
               );
+              reply = await executeCell();
+              if (isCodeSyncError(reply)) {
+                // the kernel lost track of our revision, resend everything
+                codeSyncStates.delete(notebook);
+                reply = await executeCell();
+              }
+              ackCodeSync(notebook, kernelId, reply);
               
               resetCellPrompt(notebook, cell)
               
@@ -181,6 +189,68 @@ import { truncateCellId } from '@dfnotebook/dfutils';
     return Promise.resolve(true);
   }
 
+  interface ICodeSyncState {
+    kernelId: string;
+    // last revision sent, and the cell hashes it had
+    revision: number;
+    hashes: { [key: string]: number };
+    // whether the kernel has replied with a revision at all
+    acked: boolean;
+  }
+
+  const codeSyncStates = new WeakMap<DataflowNotebookModel, ICodeSyncState>();
+
+  /**
+   * Return the dfMetadata to send, with code_dict and output_tags replaced by
+   * a delta against the last revision sent once the kernel supports it.
+   */
+  function encodeCodeSync(notebook: DataflowNotebookModel, kernelId: string, dfMetadata: any): any {
+    const { code_dict, output_tags, ...rest } = dfMetadata;
+    const hashes: { [key: string]: number } = {};
+    let digest = 0;
+    for (const cId in code_dict) {
+      hashes[cId] = contentHash(cId, code_dict[cId], output_tags[cId]);
+      digest = (digest + hashes[cId]) >>> 0;
+    }
+
+    const prev = codeSyncStates.get(notebook);
+    if (!prev || prev.kernelId !== kernelId || !prev.acked) {
+      codeSyncStates.set(notebook, { kernelId, revision: 1, hashes, acked: false });
+      return { ...dfMetadata, code_revision: 1 };
+    }
+
+    const changed: { [key: string]: any } = {};
+    for (const cId in hashes) {
+      if (prev.hashes[cId] !== hashes[cId]) {
+        changed[cId] = { code: code_dict[cId], output_tags: output_tags[cId] || [], hash: hashes[cId] };
+      }
+    }
+    const deleted = Object.keys(prev.hashes).filter(cId => !(cId in hashes));
+    const revision = prev.revision + 1;
+    codeSyncStates.set(notebook, { kernelId, revision, hashes, acked: true });
+    return {
+      ...rest,
+      code_delta: { base_revision: prev.revision, revision, changed, deleted, digest }
+    };
+  }
+
+  function isCodeSyncError(reply: KernelMessage.IExecuteReplyMsg | void): boolean {
+    return (reply?.content as any)?.ename === 'DataflowSyncError';
+  }
+
+  function ackCodeSync(notebook: DataflowNotebookModel, kernelId: string, reply: KernelMessage.IExecuteReplyMsg | void) {
+    const state = codeSyncStates.get(notebook);
+    if (!state || state.kernelId !== kernelId) {
+      return;
+    }
+    if (typeof (reply?.content as any)?.code_revision === 'number') {
+      state.acked = true;
+    } else {
+      // older kernel, an aborted request, or a lost revision
+      codeSyncStates.delete(notebook);
+    }
+  }
+
   async function dfCommPostData(notebook: DataflowNotebookModel, sessionContext: ISessionContext): Promise<void> {
     const dfData = getCellsMetadata(notebook, '');
     
@@ -331,6 +401,7 @@ import { truncateCellId } from '@dfnotebook/dfutils';
     const inputTags: { [key: string]: string } = {};
     const allRefs: { [key: string]: { [key: string]: string[] } } = {};
     const executedCode: { [key: string]: string } = {};
+    const noStore: string[] = [];
     const cellsArray = Array.from(notebook.cells);
 
     cellsArray.forEach(cell => {
@@ -350,6 +421,9 @@ import { truncateCellId } from '@dfnotebook/dfutils';
         }
 
         codeDict[cId] = c.sharedModel.getSource();
+        if (dfmetadata?.noStore) {
+          noStore.push(cId);
+        }
         cellIdModelMap[cId] = c;
         outputTags[cId] = dfmetadata.outputVars;
         allRefs[cId] = dfmetadata.inputVars;
@@ -367,7 +441,8 @@ import { truncateCellId } from '@dfnotebook/dfutils';
       auto_update_flags: {},
       force_cached_flags: {},
       all_refs: allRefs,
-      executed_code: executedCode
+      executed_code: executedCode,
+      no_store: noStore
     };
     return { dfMetadata, cellIdModelMap };
   }
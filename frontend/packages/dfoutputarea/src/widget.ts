@@ -74,6 +74,22 @@ export class DataflowOutputArea extends OutputArea {
     const transient = ((msg.content as any).transient || {}) as JSONObject;
     const displayId = transient['display_id'] as string;
     let targets: number[];
+
+    // with batch_outputs, one execute_result carries every output of a cell
+    const outputs = (msg.content as any).outputs as
+      | { data: JSONObject; metadata: JSONObject }[]
+      | undefined;
+    if (msgType === 'execute_result' && Array.isArray(outputs)) {
+      const content = { ...(msg.content as any) };
+      delete content.outputs;
+      for (const { data, metadata } of outputs) {
+        this.onIOPub({
+          ...msg,
+          content: { ...content, data, metadata }
+        } as KernelMessage.IExecuteResultMsg);
+      }
+      return;
+    }
     
     switch (msgType) {
       case 'execute_result':
@@ -9,3 +9,29 @@ export function cellIdStrToInt(id: string): number {
 export function truncateCellId(id: string): string {
     return id.replace(/-/g, '').substring(0, 8);
 }
+
+const CRC32_TABLE = (() => {
+    const table = new Uint32Array(256);
+    for (let n = 0; n < 256; n++) {
+        let c = n;
+        for (let k = 0; k < 8; k++) {
+            c = c & 1 ? 0xedb88320 ^ (c >>> 1) : c >>> 1;
+        }
+        table[n] = c >>> 0;
+    }
+    return table;
+})();
+
+export function crc32(data: string): number {
+    const bytes = new TextEncoder().encode(data);
+    let crc = 0xffffffff;
+    for (let i = 0; i < bytes.length; i++) {
+        crc = CRC32_TABLE[(crc ^ bytes[i]) & 0xff] ^ (crc >>> 8);
+    }
+    return (crc ^ 0xffffffff) >>> 0;
+}
+
+// must match dfnotebook.kernel.codesync.content_hash
+export function contentHash(cellId: string, code: string, outputTags?: string[]): number {
+    return crc32([cellId, code, (outputTags || []).join(',')].join('\0'));
+}